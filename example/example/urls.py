@@ -1,5 +1,6 @@
 from django.conf.urls import include
 from django.contrib import admin
+from exampleapp.views import benchmark
 try:
     from django.conf.urls import url
 except ImportError:
@@ -11,6 +12,7 @@ except ImportError:
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
     url(r'^treewidget/', include('treewidget.urls')),
+    url(r'^benchmark/$', benchmark),
 ]
 
 from django.conf import settings
@@ -0,0 +1,324 @@
+"""
+Benchmark of the treewidget on the example tree models.
+
+Builds trees of the given shape in a fresh test database and measures
+query count, wall time, peak memory and output bytes of the widget
+preparation and rendering and of the ajax views. Prints the results as JSON.
+With `--parent-strategy index` the models get indexed (see `treewidget.index`)
+for the widgets and the ajax views.
+
+    $> ./manage.py benchmark --size 10000 --depth 5 --fanout 8 --output result.json
+"""
+import json
+import platform
+import sqlite3
+import tracemalloc
+from collections import deque
+from time import perf_counter
+
+import django
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from treewidget import views
+from treewidget.fields import TreeModelChoiceField
+from treewidget.formatters import SelectFormatter, CompactFormatter
+from treewidget.tree import TreeQuerySet, PARENT_SUBQUERY, PARENT_PYTHON, PARENT_INDEX
+from treewidget.index import rebuild_index
+from exampleapp.models import Mptt, Treebeardmp, Treebeardal, Treebeardns
+
+
+MODELS = {
+    'mptt': Mptt,
+    'treebeardmp': Treebeardmp,
+    'treebeardal': Treebeardal,
+    'treebeardns': Treebeardns,
+}
+
+FORMATTERS = {
+    'select': SelectFormatter,
+    'compact': CompactFormatter,
+}
+
+OPERATIONS = ['prepare_queryset', '_get_mixin_context', 'render', 'iterate_nodes', 'get_node', 'move_node']
+
+# filtered mode renders nodes with names ending in 3 plus their ancestors
+FILTER = {'name__endswith': '3'}
+
+
+def build_shape(size, depth, fanout, roots):
+    """
+    Returns the tree shape as list of `(parent index, depth, position)`
+    in depth first order. Levels are filled breadth first up to `size` nodes,
+    `depth` levels and `fanout` children per node.
+    """
+    children = {None: []}
+    queue = deque()
+    count = 0
+    for _ in range(min(roots, size)):
+        children[None].append(count)
+        queue.append((count, 1))
+        count += 1
+    while queue and count < size:
+        index, level = queue.popleft()
+        children[index] = []
+        if level >= depth:
+            continue
+        for _ in range(min(fanout, size - count)):
+            children[index].append(count)
+            queue.append((count, level + 1))
+            count += 1
+
+    # renumber depth first, so pk order equals tree order
+    shape = []
+    stack = [(index, None, 1, pos) for pos, index in reversed(list(enumerate(children[None], 1)))]
+    while stack:
+        index, parent, level, pos = stack.pop()
+        new_index = len(shape)
+        shape.append((parent, level, pos))
+        stack.extend((child, new_index, level + 1, child_pos)
+                     for child_pos, child in reversed(list(enumerate(children.get(index, []), 1))))
+    return shape
+
+
+def get_ranges(shape):
+    """
+    Returns nested set values `(tree_id, lft, rgt)` for the shape.
+    """
+    ranges = [None] * len(shape)
+    counter = 0
+    tree_id = 0
+    open_nodes = []
+    for index, (parent, level, _) in enumerate(shape):
+        while open_nodes and len(open_nodes) >= level:
+            closed = open_nodes.pop()
+            counter += 1
+            ranges[closed][2] = counter
+        if parent is None:
+            tree_id += 1
+            counter = 0
+        counter += 1
+        ranges[index] = [tree_id, counter, None]
+        open_nodes.append(index)
+    while open_nodes:
+        closed = open_nodes.pop()
+        counter += 1
+        ranges[closed][2] = counter
+    return ranges
+
+
+def create_tree(model, shape):
+    """
+    Bulk creates the nodes of `shape` for `model`, node `i` gets pk `i + 1`.
+    """
+    ranges = get_ranges(shape)
+    numchild = [0] * len(shape)
+    for parent, _, _ in shape:
+        if parent is not None:
+            numchild[parent] += 1
+    paths = []
+    objs = []
+    for index, (parent, level, pos) in enumerate(shape):
+        pk = index + 1
+        name = 'node %d' % pk
+        parent_pk = None if parent is None else parent + 1
+        tree_id, lft, rgt = ranges[index]
+        if model is Mptt:
+            objs.append(Mptt(pk=pk, name=name, parent_id=parent_pk, tree_id=tree_id,
+                             lft=lft, rght=rgt, level=level - 1))
+        elif model is Treebeardmp:
+            path = Treebeardmp._get_path(None if parent is None else paths[parent], level, pos)
+            paths.append(path)
+            objs.append(Treebeardmp(pk=pk, name=name, path=path, depth=level,
+                                    numchild=numchild[index]))
+        elif model is Treebeardal:
+            objs.append(Treebeardal(pk=pk, name=name, parent_id=parent_pk, sib_order=pos))
+        elif model is Treebeardns:
+            objs.append(Treebeardns(pk=pk, name=name, tree_id=tree_id, lft=lft, rgt=rgt, depth=level))
+    model.objects.all().delete()
+    model.objects.bulk_create(objs, batch_size=500)
+
+
+def measure(func, repeat):
+    """
+    Runs `func` once counting queries, `repeat` times for the wall time
+    and once more for the peak memory. `func` returns the output size in bytes.
+    """
+    with CaptureQueriesContext(connection) as queries:
+        output = func()
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    times.sort()
+    return {
+        'queries': len(queries),
+        'time_min': times[0],
+        'time_median': times[len(times) // 2],
+        'peak_memory': peak,
+        'bytes': output,
+    }
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the treewidget on the example tree models.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=1000, help='nodes per tree model')
+        parser.add_argument('--depth', type=int, default=5, help='maximum tree depth')
+        parser.add_argument('--fanout', type=int, default=8, help='children per node')
+        parser.add_argument('--roots', type=int, default=1, help='number of root nodes')
+        parser.add_argument('--repeat', type=int, default=5, help='timed runs per measurement')
+        parser.add_argument('--selected', type=int, default=10, help='number of selected nodes')
+        parser.add_argument('--models', nargs='+', choices=sorted(MODELS), default=sorted(MODELS))
+        parser.add_argument('--parent-strategy', choices=[PARENT_SUBQUERY, PARENT_PYTHON, PARENT_INDEX],
+                            default=PARENT_SUBQUERY)
+        parser.add_argument('--operations', nargs='+', choices=OPERATIONS, default=OPERATIONS)
+        parser.add_argument('--label', help='field name for the values-only render path')
+        parser.add_argument('--formatter', choices=sorted(FORMATTERS), default='select')
+        parser.add_argument('--output', help='write the JSON result to this file')
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            # benchmark the uncached code paths
+            indexed = []
+            if options['parent_strategy'] == PARENT_INDEX:
+                indexed = [MODELS[name]._meta.label for name in options['models']]
+            with override_settings(TREEWIDGET_CACHE=None, DEBUG=False, TREEWIDGET_INDEX_MODELS=indexed):
+                result = self.run(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        data = json.dumps(result, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(data)
+        else:
+            self.stdout.write(data)
+
+    def run(self, options):
+        shape = build_shape(options['size'], options['depth'], options['fanout'], options['roots'])
+        self.user = User.objects.create_superuser('benchmark', 'benchmark@example.com', 'benchmark')
+        results = []
+        for name in options['models']:
+            model = MODELS[name]
+            create_tree(model, shape)
+            if options['parent_strategy'] == PARENT_INDEX:
+                rebuild_index(model)
+            results.extend(self.run_model(model, shape, options))
+        return {
+            'meta': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'nodes': len(shape),
+                'levels': max(level for _, level, _ in shape) if shape else 0,
+                'options': dict((key, options[key]) for key in (
+                    'size', 'depth', 'fanout', 'roots', 'repeat', 'selected',
+                    'models', 'operations', 'parent_strategy', 'formatter', 'label')),
+            },
+            'results': results,
+        }
+
+    def run_model(self, model, shape, options):
+        appmodel = '%s.%s' % (model._meta.app_label, model._meta.model_name)
+        results = []
+
+        def run(func, mode, operation):
+            if operation in options['operations']:
+                results.append(dict(measure(func, options['repeat']), model=appmodel,
+                                    mode=mode, operation=operation))
+
+        # selection spread over the leaves of the deepest level
+        levels = max(level for _, level, _ in shape) if shape else 0
+        deepest = [index + 1 for index, (_, level, _) in enumerate(shape) if level == levels]
+        step = max(1, len(deepest) // max(1, options['selected']))
+        selected = deepest[::step][:options['selected']]
+
+        for mode in ('plain', 'filtered'):
+            settings = {
+                'parent_strategy': options['parent_strategy'],
+                'formatter': FORMATTERS[options['formatter']],
+            }
+            if options['label']:
+                settings['label'] = options['label']
+            queryset = model.objects.all()
+            if mode == 'filtered':
+                settings['filtered'] = True
+                queryset = queryset.filter(**FILTER)
+            widget = TreeModelChoiceField(queryset, settings=settings).widget
+
+            def prepare_queryset():
+                qs, _, _ = widget.prepare_queryset(selected)
+                list(qs)
+                return 0
+
+            def get_mixin_context():
+                ctx = widget._get_mixin_context('benchmark', qs, sel, disabled)
+                return sum(len(chunk.encode('utf-8')) for chunk in ctx['json_data'])
+
+            def render():
+                return len(widget.render('benchmark', selected).encode('utf-8'))
+
+            run(prepare_queryset, mode, 'prepare_queryset')
+            run(render, mode, 'render')
+            if '_get_mixin_context' in options['operations']:
+                qs, sel, disabled = widget.prepare_queryset(selected)
+                list(qs)
+                run(get_mixin_context, mode, '_get_mixin_context')
+
+        # per node proxy overhead: iterate an evaluated queryset
+        nodes = TreeQuerySet(model.objects.all())
+
+        def iterate_nodes():
+            proxies = list(nodes)
+            for node in proxies:
+                node.pk, node.ordering, str(node)
+            return 0
+
+        if 'iterate_nodes' in options['operations']:
+            list(nodes.qs)
+            run(iterate_nodes, 'plain', 'iterate_nodes')
+
+        factory = RequestFactory()
+
+        def get_node(ids):
+            request = factory.get('/', {'appmodel': appmodel, 'ids': ids, 'sort': 1})
+            request.user = self.user
+            return len(views.get_node(request).content)
+
+        def move_node(node_id, next_id):
+            # rolled back after each run to keep the tree shape
+            with transaction.atomic():
+                request = factory.get('/', {'appmodel': appmodel, 'id': node_id, 'next': next_id})
+                request.user = self.user
+                response = views.move_node(request)
+                assert json.loads(response.content)['moved'], 'move failed'
+                transaction.set_rollback(True)
+            return len(response.content)
+
+        # plain: the selected nodes, moves the second subtree of the first root
+        # in front of the first one (locks the roots of all trees for root level moves)
+        roots = [index for index, (parent, _, _) in enumerate(shape) if parent is None]
+        children = [index + 1 for index, (parent, _, _) in enumerate(shape) if parent == roots[0]]
+        run(lambda: get_node(selected), 'plain', 'get_node')
+        if len(children) > 1:
+            run(lambda: move_node(children[1], children[0]), 'plain', 'move_node')
+
+        # filtered: the nodes of the filtered queryset, moves the last filtered
+        # node in front of the first one (locks the affected trees only)
+        filtered = list(model.objects.filter(**FILTER).order_by('pk').values_list('pk', flat=True))
+        run(lambda: get_node(filtered), 'filtered', 'get_node')
+        if len(filtered) > 1:
+            run(lambda: move_node(filtered[-1], filtered[0]), 'filtered', 'move_node')
+        return results
@@ -0,0 +1,157 @@
+"""
+Concurrency benchmark of the sync and the async ajax views.
+
+Builds trees of the given shape in a fresh test database and sends `--requests`
+requests to `get_node` and `move_node` with `--concurrency` requests in flight
+on one event loop. The views get called like django's ASGI handler does:
+each request gets its own sync thread context, sync views run in it with
+`sync_to_async`, async views (`aget_node`, `amove_node`) get awaited.
+Prints throughput and latencies as JSON. Concurrent moves need a server
+database, SQLite rejects most of them (counted as failed).
+
+    $> ./manage.py benchmark_concurrency --size 10000 --concurrency 50 --requests 1000
+"""
+import asyncio
+import json
+import platform
+import sqlite3
+from random import Random
+from time import perf_counter
+
+import django
+from asgiref.sync import sync_to_async, iscoroutinefunction, ThreadSensitiveContext
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import AsyncRequestFactory
+from django.test.utils import override_settings
+
+from treewidget import views
+from exampleapp.management.commands.benchmark import MODELS, build_shape, create_tree
+
+
+VIEWS = {
+    'get_node': (views.get_node, views.aget_node),
+    'move_node': (views.move_node, views.amove_node),
+}
+
+
+async def run_requests(view, get_params, user, requests, concurrency):
+    """
+    Sends `requests` requests with the params of `get_params(i)` to `view`,
+    `concurrency` at a time. Returns throughput, latencies and failed requests.
+    """
+    if not iscoroutinefunction(view):
+        view = sync_to_async(view)
+    factory = AsyncRequestFactory()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failed = []
+
+    async def auser():
+        return user
+
+    async def send(i):
+        async with semaphore, ThreadSensitiveContext():
+            request = factory.get('/', get_params(i))
+            request.user = user
+            request.auser = auser
+            start = perf_counter()
+            response = await view(request)
+            latencies.append(perf_counter() - start)
+            data = json.loads(response.content)
+            if not data or isinstance(data, dict) and not data.get('moved'):
+                failed.append(i)
+
+    start = perf_counter()
+    await asyncio.gather(*(send(i) for i in range(requests)))
+    seconds = perf_counter() - start
+    latencies.sort()
+    return {
+        'seconds': seconds,
+        'throughput': requests / seconds,
+        'latency_median': latencies[len(latencies) // 2],
+        'latency_p95': latencies[int(len(latencies) * 0.95)],
+        'latency_max': latencies[-1],
+        'failed': len(failed),
+    }
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the sync and async treewidget ajax views under concurrent requests.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=1000, help='nodes per tree model')
+        parser.add_argument('--depth', type=int, default=5, help='maximum tree depth')
+        parser.add_argument('--fanout', type=int, default=8, help='children per node')
+        parser.add_argument('--roots', type=int, default=1, help='number of root nodes')
+        parser.add_argument('--requests', type=int, default=500, help='requests per view')
+        parser.add_argument('--concurrency', type=int, default=50, help='requests in flight')
+        parser.add_argument('--selected', type=int, default=10, help='requested nodes per get_node')
+        parser.add_argument('--models', nargs='+', choices=sorted(MODELS), default=sorted(MODELS))
+        parser.add_argument('--views', nargs='+', choices=sorted(VIEWS), default=sorted(VIEWS))
+        parser.add_argument('--output', help='write the JSON result to this file')
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(TREEWIDGET_CACHE=None, DEBUG=False):
+                result = self.run(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        data = json.dumps(result, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(data)
+        else:
+            self.stdout.write(data)
+
+    def run(self, options):
+        shape = build_shape(options['size'], options['depth'], options['fanout'], options['roots'])
+        user = User.objects.create_superuser('benchmark', 'benchmark@example.com', 'benchmark')
+        results = []
+        for name in options['models']:
+            model = MODELS[name]
+            create_tree(model, shape)
+            results.extend(self.run_model(model, shape, user, options))
+        return {
+            'meta': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'nodes': len(shape),
+                'options': dict((key, options[key]) for key in (
+                    'size', 'depth', 'fanout', 'roots', 'requests', 'concurrency',
+                    'selected', 'models', 'views')),
+            },
+            'results': results,
+        }
+
+    def run_model(self, model, shape, user, options):
+        appmodel = '%s.%s' % (model._meta.app_label, model._meta.model_name)
+        random = Random(42)
+        pks = range(1, len(shape) + 1)
+
+        def get_node_params(i):
+            return {'appmodel': appmodel, 'ids': random.sample(pks, min(options['selected'], len(pks))),
+                    'sort': 1}
+
+        # moves the second child of the first root in front of the first one and back
+        roots = [index for index, (parent, _, _) in enumerate(shape) if parent is None]
+        children = [index + 1 for index, (parent, _, _) in enumerate(shape) if parent == roots[0]]
+
+        def move_node_params(i):
+            if i % 2:
+                return {'appmodel': appmodel, 'id': children[0], 'next': children[1]}
+            return {'appmodel': appmodel, 'id': children[1], 'next': children[0]}
+
+        params = {'get_node': get_node_params, 'move_node': move_node_params}
+        results = []
+        for name in options['views']:
+            if name == 'move_node' and len(children) < 2:
+                continue
+            for mode, view in zip(('sync', 'async'), VIEWS[name]):
+                result = asyncio.run(run_requests(
+                    view, params[name], user, options['requests'], options['concurrency']))
+                results.append(dict(result, model=appmodel, view=name, mode=mode))
+        return results
@@ -60,8 +60,8 @@ class Example(models.Model):
         help_text="settings: drag'n drop")
     mptt_many = TreeManyToManyField(
         Mptt, related_name='example_many',
-        settings={'show_buttons': True, 'search': True, 'dnd': True},
-        help_text="settings: buttons, search, drag'n drop<br>")
+        settings={'show_buttons': True, 'search': True, 'search_field': 'name', 'dnd': True},
+        help_text="settings: buttons, server side search, drag'n drop<br>")
     treebeardmp_many = TreeManyToManyField(Treebeardmp, related_name='example_many')
     treebeardal_many = TreeManyToManyField(Treebeardal, related_name='example_many')
     treebeardns_many = TreeManyToManyField(Treebeardns, related_name='example_many')
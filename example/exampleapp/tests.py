@@ -1,3 +1,898 @@
-from django.test import TestCase
+import gzip
+import re
+from io import StringIO
+from json import dumps, loads
+from operator import itemgetter
+from random import Random
+from threading import Thread
+from time import sleep
+from unittest import mock
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core import signing
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, AsyncRequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from treewidget.tree import TreeNode, TreeQuerySet, PARENT_PYTHON, PARENT_INDEX, RECURSIVE_CTE_VENDORS
+from treewidget.fields import TreeModelChoiceField
+from treewidget.formatters import SelectFormatter, CompactFormatter, JSONChunks
+from treewidget.cache import memoize, get_version, get_tree_key, get_tree_data, get_changed_pks, bump_version
+from treewidget.index import (rebuild_index, is_current, is_indexed, get_index_rows, get_key_between,
+                              get_segments)
+from treewidget.timing import stage_finished
+from treewidget.views import get_move, run_moves, aget_node, amove_node, amove_nodes, brotli
+from treewidget.models import TreeIndex
+from .models import Mptt, Treebeardmp, Treebeardal, Treebeardns, Example
 
-# Create your tests here.
+
+TREE_MODELS = (Mptt, Treebeardmp, Treebeardal, Treebeardns)
+
+
+def get_widget_data(html):
+    """
+    Returns the JSON data of the widget script in `html`.
+    """
+    return loads(re.search(r'<script type="application/json"[^>]*>(.*?)</script>', html, re.S).group(1))
+
+
+def render_widget(queryset, settings, value=None):
+    field = TreeModelChoiceField(queryset, settings=settings)
+    return get_widget_data(field.widget.render('node', value, {'id': 'id_node'}))
+
+
+def node_ids(*pks):
+    return ['treewidget_id_node_%s' % pk for pk in pks]
+
+
+class GetNodeTest(TestCase):
+    fixtures = ['initial_data']
+
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def get_node(self, model, ids):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/treewidget/get_node/', {
+                'appmodel': 'exampleapp.%s' % model._meta.model_name,
+                'ids': ids,
+                'sort': 1
+            })
+        return response.json(), len(queries)
+
+    def test_result(self):
+        for model in TREE_MODELS:
+            pks = list(model.objects.values_list('pk', flat=True))
+            result, _ = self.get_node(model, pks)
+            self.assertEqual(len(result), len(pks))
+            for data in result:
+                node = TreeNode(model.objects.get(pk=data['id']))
+                pk = lambda n: n.node.pk if n else None
+                self.assertEqual(data['parent'], pk(node.parent))
+                self.assertEqual(data['prev'], pk(node.prev_sibling))
+                self.assertEqual(data['next'], pk(node.next_sibling))
+                self.assertEqual([p['id'] for p in data['parents']],
+                                 [p.node.pk for p in node.ancestors])
+                self.assertEqual([p['parent'] for p in data['parents']],
+                                 [pk(p.parent) for p in node.ancestors])
+
+    def test_bad_request(self):
+        for model in TREE_MODELS:
+            self.assertEqual(self.get_node(model, ['x'])[0], [], model)
+            self.assertEqual(self.get_node(model, [999])[0], [], model)
+        for appmodel in ('exampleapp', 'exampleapp.missing'):
+            response = self.client.get('/treewidget/get_node/', {'appmodel': appmodel, 'ids': [1]})
+            self.assertEqual(response.json(), [])
+
+    def test_query_count(self):
+        # nested set ancestors are ORed ranges or a subquery
+        for ranges in (1000, 0):
+            with mock.patch('treewidget.tree.NESTED_SET_RANGES', ranges):
+                self.assert_query_count()
+
+    def assert_query_count(self):
+        for model in TREE_MODELS:
+            deepest = max(model.objects.all(), key=lambda n: len(list(TreeNode(n).ancestors)))
+            same_level = [n.pk for n in model.objects.all()
+                          if len(list(TreeNode(n).ancestors)) == len(list(TreeNode(deepest).ancestors))]
+            _, single = self.get_node(model, [deepest.pk])
+            _, many = self.get_node(model, same_level)
+            self.assertEqual(single, many, model)
+            root = model.objects.filter(pk__in=[p.node.pk for p in TreeNode(deepest).ancestors])[0]
+            _, shallow = self.get_node(model, [root.pk])
+            _, everything = self.get_node(model, list(model.objects.values_list('pk', flat=True)))
+            self.assertEqual(single, shallow, model)
+            self.assertEqual(single, everything, model)
+
+
+@override_settings(TREEWIDGET_INDEX_MODELS=['exampleapp.%s' % model.__name__ for model in TREE_MODELS])
+class IndexedGetNodeTest(GetNodeTest):
+
+    def setUp(self):
+        super(IndexedGetNodeTest, self).setUp()
+        for model in TREE_MODELS:
+            rebuild_index(model)
+
+    def test_outdated_index(self):
+        for model in TREE_MODELS:
+            # changes without signals get announced with `bump_version`
+            with self.captureOnCommitCallbacks(execute=True):
+                bump_version(model)
+            self.assertFalse(is_current(model), model)
+            # falls back to the subquery strategy without rebuilding the index
+            TreeIndex.objects.filter(model=TreeQuerySet(model.objects.all()).appmodel, node=10).update(parent=3)
+            result, _ = self.get_node(model, [10])
+            self.assertEqual(result[0]['parent'], 4, model)
+
+    def test_index_read(self):
+        def get_parent(model):
+            return dict(TreeQuerySet(model.objects.filter(pk=10)).annotate_parent(PARENT_INDEX)
+                        .values_parent_annotated())[10]
+
+        for model in TREE_MODELS:
+            # a wrong parent in the index shows, that the parents are read from it
+            TreeIndex.objects.filter(model=TreeQuerySet(model.objects.all()).appmodel, node=10).update(parent=3)
+            self.assertEqual(get_parent(model), 3, model)
+            self.assertEqual(rebuild_index(model), 15, model)
+            self.assertEqual(get_parent(model), 4, model)
+
+
+@override_settings(TREEWIDGET_INDEX_MODELS=['exampleapp.%s' % model.__name__ for model in TREE_MODELS])
+class IndexUpdateTest(TestCase):
+    fixtures = ['initial_data']
+
+    def setUp(self):
+        for model in TREE_MODELS:
+            rebuild_index(model)
+
+    def assert_index(self, model):
+        self.assertTrue(is_current(model), model)
+        rows = TreeIndex.objects.filter(model=TreeQuerySet(model.objects.all()).appmodel)\
+            .values_list('node', 'parent', 'depth', 'sort_key')
+        expected = get_index_rows(TreeQuerySet(model._default_manager.all())
+                                  .annotate_parent(PARENT_PYTHON).values_parent_annotated())
+        # same parents and depths, sort keys in tree order
+        self.assertEqual([row[:3] for row in sorted(rows, key=itemgetter(3))],
+                         [row[:3] for row in sorted(expected, key=itemgetter(3))], model)
+
+    def add_child(self, model, parent_pk, name):
+        if model is Mptt:
+            return Mptt.objects.create(name=name, parent_id=parent_pk)
+        return model.objects.get(pk=parent_pk).add_child(name=name)
+
+    def test_moves(self):
+        for model in TREE_MODELS:
+            for move in ((10, 3, None, None), (4, None, 2, None), (12, None, None, 11),
+                         (5, 10, None, None), (2, None, None, 1)):
+                self.assertTrue(run_moves(model, [get_move(model, *move)])['moved'], (model, move))
+                self.assert_index(model)
+
+    def test_add_delete(self):
+        for model in TREE_MODELS:
+            self.add_child(model, 3, 'Child CA')
+            self.add_child(model, 4, 'Grandchild AAD')
+            self.add_child(model, 4, 'Grandchild AA0')
+            self.assert_index(model)
+            node = model.objects.get(pk=11)
+            node.name = 'Grandchild AAZ'
+            node.save()
+            self.assert_index(model)
+            model.objects.get(pk=5).delete()
+            self.assert_index(model)
+            self.assertFalse(TreeIndex.objects.filter(
+                model=TreeQuerySet(model.objects.all()).appmodel, node=5).exists(), model)
+
+    def test_missing_rows(self):
+        for model in TREE_MODELS:
+            TreeIndex.objects.filter(model=TreeQuerySet(model.objects.all()).appmodel, node=4).delete()
+            self.add_child(model, 4, 'Grandchild AAD')
+            self.assertFalse(is_current(model), model)
+
+    def test_key_between(self):
+        keys = get_segments(40)
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(set(map(len, keys))), 1)
+        for low, high in [('', None), ('', '1'), ('1', '2'), ('1', '11'), ('z', None), ('01', '02'), ('1z', '2')]:
+            key = get_key_between(low, high)
+            self.assertTrue(low < key and (high is None or key < high), (low, high, key))
+            self.assertNotEqual(key[-1], '0')
+
+    @override_settings(TREEWIDGET_INDEX_MODELS=['sessions.Session'])
+    def test_integer_pks(self):
+        with self.assertRaises(ImproperlyConfigured):
+            rebuild_index(Session)
+        with self.assertRaises(ImproperlyConfigured):
+            is_indexed(Session)
+
+
+def call_async_view(view, user, params):
+    request = AsyncRequestFactory().get('/', params)
+
+    async def auser():
+        return user
+    request.auser = auser
+    return loads(async_to_sync(view)(request).content)
+
+
+class AsyncGetNodeTest(GetNodeTest):
+
+    def get_node(self, model, ids):
+        with CaptureQueriesContext(connection) as queries:
+            result = call_async_view(aget_node, User.objects.get(username='admin'), {
+                'appmodel': 'exampleapp.%s' % model._meta.model_name,
+                'ids': ids,
+                'sort': 1
+            })
+        return result, len(queries)
+
+
+@override_settings(TREEWIDGET_INDEX_MODELS=['exampleapp.%s' % model.__name__ for model in TREE_MODELS])
+class ParentStrategyTest(TestCase):
+    fixtures = ['initial_data']
+
+    def setUp(self):
+        for model in TREE_MODELS:
+            rebuild_index(model)
+
+    def get_parents(self, model, pks):
+        parents = {}
+        for pk in pks:
+            parent = TreeNode(model.objects.get(pk=pk)).parent
+            parents[pk] = parent.node.pk if parent else None
+        return parents
+
+    def test_annotate_parent(self):
+        for model in TREE_MODELS:
+            pks = list(model.objects.values_list('pk', flat=True))
+            expected = self.get_parents(model, pks)
+            for strategy in (PARENT_PYTHON, PARENT_INDEX):
+                tqs = TreeQuerySet(model.objects.all()).annotate_parent(strategy)
+                self.assertEqual(dict((node.pk, node.node._parent_pk) for node in tqs), expected, model)
+                self.assertEqual(dict(tqs.values_parent_annotated()), expected, model)
+
+                # chained queryset methods keep the parent resolution
+                chained = tqs.filter(pk__in=[1, 4, 10]).order_by('-pk')
+                self.assertEqual([(node.pk, node.node._parent_pk) for node in chained],
+                                 [(pk, expected[pk]) for pk in (10, 4, 1)], (model, strategy))
+                self.assertEqual(dict(chained.exclude(pk=1).values_parent_annotated()),
+                                 {10: expected[10], 4: expected[4]}, (model, strategy))
+
+    def test_ancestors(self):
+        for model in TREE_MODELS:
+            expected = self.get_parents(model, [1, 4, 10])
+            for strategy in (PARENT_PYTHON, PARENT_INDEX):
+                ancestors = TreeQuerySet(model.objects.filter(pk=10))\
+                    .get_ancestors_parent_annotated(include_self=True, strategy=strategy)
+                self.assertEqual(dict((node.pk, node.node._parent_pk) for node in ancestors.filter(pk__gt=0)),
+                                 expected, (model, strategy))
+
+
+class AncestorTest(TestCase):
+    fixtures = ['initial_data']
+
+    def get_ancestors(self, model, pks, include_self):
+        expected = set(pks) if include_self else set()
+        for pk in pks:
+            expected.update(p.node.pk for p in TreeNode(model.objects.get(pk=pk)).ancestors)
+        return expected
+
+    def assert_ancestors(self, model, queryset, include_self):
+        pks = list(queryset.values_list('pk', flat=True))
+        ancestors = TreeQuerySet(queryset).get_ancestors_parent_annotated(include_self=include_self)
+        self.assertEqual(set(node.pk for node in ancestors),
+                         self.get_ancestors(model, pks, include_self), (model, pks, include_self))
+
+    def test_ancestors(self):
+        # 0 forces the subquery for nested sets, without recursive queries
+        # for MPTT also the range condition instead of the parent walk
+        for ranges, vendors in ((10, RECURSIVE_CTE_VENDORS), (0, RECURSIVE_CTE_VENDORS), (0, ())):
+            with mock.patch('treewidget.tree.NESTED_SET_RANGES', ranges), \
+                    mock.patch('treewidget.tree.RECURSIVE_CTE_VENDORS', vendors):
+                for model in (Mptt, Treebeardns, Treebeardmp):
+                    for include_self in (False, True):
+                        self.assert_ancestors(model, model.objects.filter(pk=10), include_self)
+                        # nested selection, the ancestors of 4 are covered by 10
+                        self.assert_ancestors(model, model.objects.filter(pk__in=[1, 4, 7, 10, 12]),
+                                              include_self)
+                        self.assert_ancestors(model, model.objects.filter(pk__gte=10), include_self)
+                        self.assert_ancestors(model, model.objects.filter(pk__lte=3), include_self)
+                        self.assert_ancestors(model, model.objects.none(), include_self)
+
+    def test_query_size(self):
+        for model in (Mptt, Treebeardns):
+            sizes = set()
+            for pks in (range(1, 12), range(1, 16)):
+                queryset = TreeQuerySet(model.objects.filter(pk__in=pks)).get_ancestors_parent_annotated()
+                sizes.add(len(str(queryset.qs.query).replace(', '.join(map(str, pks)), '')))
+            self.assertEqual(len(sizes), 1, model)
+
+    def test_async(self):
+        async def get_ancestors(queryset, include_self):
+            ancestors = await TreeQuerySet(queryset).aget_ancestors_parent_annotated(include_self=include_self)
+            return [(node.pk, node.node._parent_pk) async for node in ancestors]
+
+        for ranges in (10, 0):
+            with mock.patch('treewidget.tree.NESTED_SET_RANGES', ranges):
+                for model in TREE_MODELS:
+                    for include_self in (False, True):
+                        queryset = model.objects.filter(pk__in=[1, 4, 7, 10, 12])
+                        expected = TreeQuerySet(queryset).get_ancestors_parent_annotated(include_self=include_self)
+                        self.assertEqual(sorted(async_to_sync(get_ancestors)(queryset, include_self)),
+                                         sorted((node.pk, node.node._parent_pk) for node in expected),
+                                         (model, include_self))
+
+
+@override_settings(TREEWIDGET_CACHE='default')
+class GetTreeTest(TestCase):
+    fixtures = ['initial_data']
+
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def get_tree(self, model, **headers):
+        url = render_widget(model.objects.all(), {'external': True})['additional']['dataurl']
+        return self.client.get(url, **headers)
+
+    def test_data(self):
+        for model in TREE_MODELS:
+            response = self.get_tree(model)
+            self.assertEqual(response.status_code, 200, model)
+            self.assertEqual(response['Content-Type'], 'application/json')
+            self.assertFalse(response.has_header('Content-Encoding'))
+            nodes = loads(response.getvalue())
+            self.assertEqual(sorted(node['id'] for node in nodes),
+                             sorted(node_ids(*model.objects.values_list('pk', flat=True))), model)
+            self.assertIn('Accept-Encoding', response['Vary'])
+
+    def test_streaming(self):
+        for encoding in ('', 'gzip'):
+            # streamed once, then served from the cache
+            response = self.get_tree(Mptt, HTTP_ACCEPT_ENCODING=encoding)
+            self.assertTrue(response.streaming, encoding)
+            body = response.getvalue()
+            response = self.get_tree(Mptt, HTTP_ACCEPT_ENCODING=encoding)
+            self.assertFalse(response.streaming, encoding)
+            self.assertEqual(response.getvalue(), body, encoding)
+
+    def test_not_modified(self):
+        for model in TREE_MODELS:
+            etag = self.get_tree(model)['ETag']
+            response = self.get_tree(model, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304, model)
+            self.assertEqual(response['ETag'], etag)
+            self.assertIn('Accept-Encoding', response['Vary'])
+
+            # a tree change gets a new ETag
+            bump_version(model)
+            response = self.get_tree(model, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200, model)
+            self.assertNotEqual(response['ETag'], etag, model)
+
+    def test_encoding(self):
+        plain = self.get_tree(Mptt)
+        response = self.get_tree(Mptt, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.getvalue()), plain.getvalue())
+        self.assertNotEqual(response['ETag'], plain['ETag'])
+
+        # brotli is preferred, if installed
+        response = self.get_tree(Mptt, HTTP_ACCEPT_ENCODING='gzip, br')
+        if brotli:
+            self.assertEqual(response['Content-Encoding'], 'br')
+            self.assertEqual(brotli.decompress(response.getvalue()), plain.getvalue())
+        else:
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+
+    def test_unknown_key(self):
+        response = self.client.get('/treewidget/get_tree/', {'key': 'x', 'attr_name': 'id_node'})
+        self.assertEqual(response.status_code, 404)
+
+
+class ValuesRenderTest(TestCase):
+    fixtures = ['initial_data']
+
+    def test_values(self):
+        for model in TREE_MODELS:
+            expected = render_widget(model.objects.all(), {}, 10)['treedata']
+            for node in expected:
+                node['text'] = model.objects.get(pk=node['id'].rsplit('_', 1)[1]).name
+            nodes = render_widget(model.objects.all(), {'label': 'name'}, 10)['treedata']
+            key = lambda node: node['id']
+            self.assertEqual(sorted(nodes, key=key), sorted(expected, key=key), model)
+
+    def test_formatter_attr_name(self):
+        class AttrNameFormatter(SelectFormatter):
+            def get_value_rows(self, values):
+                for pk, parent_pk, text, sort, lazy in super(AttrNameFormatter, self).get_value_rows(values):
+                    yield pk, parent_pk, '%s:%s' % (self.attr_name, text), sort, lazy
+
+        nodes = render_widget(Mptt.objects.all(), {'label': 'name', 'formatter': AttrNameFormatter})['treedata']
+        self.assertEqual(set(node['text'].split(':')[0] for node in nodes), set(['id_node']))
+
+
+class CompactFormatterTest(TestCase):
+    fixtures = ['initial_data']
+
+    def test_output(self):
+        for model in TREE_MODELS:
+            expected = render_widget(model.objects.all(), {}, 10)['treedata']
+            data = render_widget(model.objects.all(), {'formatter': CompactFormatter}, 10)['treedata']
+            self.assertEqual(data['prefix'], 'treewidget_id_node_')
+            ids = [data['prefix'] + str(pk) for pk in data['pks']]
+            self.assertEqual(ids, [node['id'] for node in expected], model)
+            self.assertEqual(data['texts'], [node['text'] for node in expected], model)
+            self.assertEqual([ids[i] if i >= 0 else '#' for i in data['parents']],
+                             [node['parent'] for node in expected], model)
+            self.assertEqual([ids[i] for i in data['selected']], node_ids(10), model)
+            self.assertEqual(data['disabled'], [])
+            self.assertEqual(data['lazy'], [])
+            self.assertNotIn('sort', data)
+
+    def test_sort(self):
+        data = render_widget(Mptt.objects.all(), {'formatter': CompactFormatter, 'sort': True})['treedata']
+        self.assertEqual(len(data['sort']), len(data['pks']))
+
+    def test_lazy(self):
+        data = render_widget(Mptt.objects.all(), {'formatter': CompactFormatter, 'lazy': True})['treedata']
+        self.assertEqual(data['parents'], [-1, -1, -1])
+        # 'Parent C' has no children
+        self.assertEqual(data['lazy'], [0, 1])
+
+
+class MemoTest(TestCase):
+    fixtures = ['initial_data']
+
+    def render(self, attr_name, value, settings=None):
+        field = TreeModelChoiceField(Mptt.objects.all(), settings=settings or {})
+        with CaptureQueriesContext(connection) as queries:
+            data = get_widget_data(field.widget.render('node', value, {'id': attr_name}))
+        return data, len(queries)
+
+    def test_shared(self):
+        with memoize():
+            first, first_queries = self.render('id_first', 10)
+            second, second_queries = self.render('id_second', 12)
+        self.assertNotIn('treedata_ref', first['additional'])
+        self.assertEqual(len(first['treedata']), 15)
+        self.assertEqual(second['additional']['treedata_ref'], 'id_first')
+        self.assertEqual(second['additional']['selected'], ['12'])
+        self.assertEqual(second['treedata'], [])
+        self.assertLess(second_queries, first_queries)
+
+    def test_same_id(self):
+        with memoize():
+            self.render('id_node', 10)
+            data, _ = self.render('id_node', 12)
+        self.assertNotIn('treedata_ref', data['additional'])
+        self.assertEqual(len(data['treedata']), 15)
+
+    def test_other_settings(self):
+        with memoize():
+            self.render('id_first', 10)
+            data, _ = self.render('id_second', 12, {'sort': True})
+        self.assertNotIn('treedata_ref', data['additional'])
+        self.assertEqual(len(data['treedata']), 15)
+
+    def test_outside_memo(self):
+        self.render('id_first', 10)
+        data, _ = self.render('id_second', 12)
+        self.assertNotIn('treedata_ref', data['additional'])
+
+
+class JSONChunksTest(TestCase):
+
+    def test_encode_once(self):
+        calls = []
+
+        def encode(*args):
+            calls.append(args)
+            yield '['
+            yield '1'
+            yield ']'
+        chunks = JSONChunks(encode, 'a')
+        self.assertEqual(list(chunks), ['[', '1', ']'])
+        self.assertEqual(str(chunks), '[1]')
+        self.assertEqual(''.join(chunks), '[1]')
+        self.assertEqual(calls, [('a',)])
+
+
+class LazyTest(TestCase):
+    fixtures = ['initial_data']
+
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def get_children(self, key, node):
+        return self.client.get('/treewidget/get_children/', {'key': key, 'node': node, 'attr_name': 'id_node'})
+
+    def test_render(self):
+        for model in TREE_MODELS:
+            nodes = render_widget(model.objects.all(), {'lazy': True})['treedata']
+            self.assertEqual(sorted(node['id'] for node in nodes), node_ids(1, 2, 3), model)
+            self.assertEqual([node['id'] for node in nodes if node.get('children')], node_ids(1, 2), model)
+
+            # paths to selected nodes are rendered
+            nodes = render_widget(model.objects.all(), {'lazy': True}, 10)['treedata']
+            children = [node.pk for node in TreeNode(model.objects.get(pk=4)).descendants]
+            self.assertEqual(sorted(node['id'] for node in nodes),
+                             sorted(node_ids(1, 2, 3, 4, 5, 6, *children)), model)
+            self.assertEqual(sorted(node['id'] for node in nodes if node.get('children')), node_ids(2, 5), model)
+
+    def test_children(self):
+        for model in TREE_MODELS:
+            key = render_widget(model.objects.all(), {'lazy': True})['additional']['childrenkey']
+            children = self.get_children(key, 1).json()
+            self.assertEqual([node['id'] for node in children], node_ids(4, 5, 6), model)
+            self.assertEqual([node['parent'] for node in children], node_ids(1, 1, 1), model)
+            self.assertEqual([node['id'] for node in children if node.get('children')], node_ids(4, 5), model)
+            self.assertEqual(self.get_children(key, 3).json(), [], model)
+            self.assertEqual(self.get_children(key, 999).json(), [], model)
+            self.assertEqual(self.get_children(key, 'x').json(), [], model)
+
+    def test_filtered_queryset(self):
+        for model in TREE_MODELS:
+            key = render_widget(model.objects.exclude(pk=5), {'lazy': True})['additional']['childrenkey']
+            self.assertEqual([node['id'] for node in self.get_children(key, 1).json()], node_ids(4, 6), model)
+            self.assertEqual(self.get_children(key, 5).json(), [], model)
+
+    def test_bad_key(self):
+        key = render_widget(Mptt.objects.all(), {'lazy': True})['additional']['childrenkey']
+        self.assertEqual(self.get_children(key + 'x', 1).status_code, 404)
+        self.assertEqual(self.get_children('x', 1).status_code, 404)
+
+    def test_stored_query(self):
+        key = render_widget(Mptt.objects.all(), {'lazy': True})['additional']['childrenkey']
+        # the key only carries the digest of the query stored on the server
+        digest = signing.loads(key, salt='treewidget.children')
+        self.assertIsInstance(digest, str)
+        caches['default'].delete('treewidget:query:%s' % digest)
+        self.assertEqual(self.get_children(key, 1).status_code, 404)
+
+
+class SearchTest(TestCase):
+    fixtures = ['initial_data']
+    settings = {'search': True, 'search_field': 'name'}
+
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def search(self, queryset, term):
+        key = render_widget(queryset, self.settings)['additional']['searchkey']
+        return self.client.get('/treewidget/search/', {'key': key, 'str': term})
+
+    def test_matches(self):
+        for model in TREE_MODELS:
+            result = self.search(model.objects.all(), 'aab').json()
+            self.assertEqual(result['matches'], [11], model)
+            self.assertEqual(result['parents'], [1, 4], model)
+
+            result = self.search(model.objects.all(), 'child b').json()
+            self.assertEqual(sorted(result['matches']), [7, 8, 9], model)
+            self.assertEqual(result['parents'], [2], model)
+
+    def test_filtered_queryset(self):
+        for model in TREE_MODELS:
+            result = self.search(model.objects.exclude(pk=11), 'aab').json()
+            self.assertEqual(result, {'matches': [], 'parents': []}, model)
+
+    def test_bad_key(self):
+        key = render_widget(Mptt.objects.all(), self.settings)['additional']['searchkey']
+        response = self.client.get('/treewidget/search/', {'key': key + 'x', 'str': 'a'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_bad_field(self):
+        with self.assertRaises(ImproperlyConfigured):
+            render_widget(Mptt.objects.all(), {'search': True, 'search_field': 'missing'})
+        with self.assertRaises(ImproperlyConfigured):
+            render_widget(Mptt.objects.all(), {'search': True, 'search_field': 'name', 'search_lookup': 'missing'})
+
+
+class MoveNodeTest(TestCase):
+    fixtures = ['initial_data']
+
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def move_node(self, model, **params):
+        params['appmodel'] = 'exampleapp.%s' % model._meta.model_name
+        return self.client.get('/treewidget/move_node/', params).json()
+
+    def move_nodes(self, model, moves):
+        return self.client.get('/treewidget/move_nodes/', {
+            'appmodel': 'exampleapp.%s' % model._meta.model_name, 'moves': dumps(moves)}).json()
+
+    def test_errors(self):
+        for model in TREE_MODELS:
+            # move below own descendant
+            self.assertEqual(self.move_node(model, id=1, parent=10)['error'], 'invalid', model)
+            self.assertEqual(self.move_node(model, id=1, parent=999)['error'], 'invalid', model)
+            self.assertEqual(self.move_node(model, id=1)['error'], 'invalid', model)
+            self.assertTrue(self.move_node(model, id=10, parent=3)['moved'], model)
+
+    @override_settings(TREEWIDGET_CACHE='default')
+    def test_stale_version(self):
+        for model in TREE_MODELS:
+            version = get_version(model)
+            result = self.move_node(model, id=10, parent=3, version=version)
+            self.assertTrue(result['moved'], model)
+            self.assertNotEqual(result['version'], version, model)
+            result = self.move_node(model, id=11, parent=3, version=version)
+            self.assertEqual(result['error'], 'stale', model)
+            self.assertEqual(TreeNode(model.objects.get(pk=11)).parent.node.pk, 4, model)
+            self.assertTrue(self.move_node(model, id=11, parent=3, version=result['version'])['moved'])
+
+    def test_batch(self):
+        for model in TREE_MODELS:
+            moves = [{'id': 10, 'parent': 3}, {'id': 11, 'next': 10}]
+            self.assertTrue(self.move_nodes(model, moves)['moved'], model)
+            self.assertEqual(TreeNode(model.objects.get(pk=10)).parent.node.pk, 3, model)
+            self.assertEqual(TreeNode(model.objects.get(pk=11)).next_sibling.node.pk, 10, model)
+
+    def test_batch_rollback(self):
+        for model in TREE_MODELS:
+            # the second move (below own descendant) fails, the first one gets rolled back
+            moves = [{'id': 10, 'parent': 3}, {'id': 1, 'parent': 5}]
+            self.assertEqual(self.move_nodes(model, moves)['error'], 'invalid', model)
+            self.assertEqual(TreeNode(model.objects.get(pk=10)).parent.node.pk, 4, model)
+            self.assertIsNone(TreeNode(model.objects.get(pk=1)).parent, model)
+
+    @override_settings(TREEWIDGET_CACHE='default')
+    def test_version_bump(self):
+        for model in TREE_MODELS:
+            version = get_version(model)
+            with self.captureOnCommitCallbacks(execute=True):
+                result = self.move_node(model, id=10, parent=3, version=version)
+            # bumped once within the move transaction, not again on commit
+            self.assertEqual(result['version'], version + 1, model)
+            self.assertEqual(get_version(model), version + 1, model)
+            self.assertEqual(get_changed_pks(model, version), (version + 1, {10}), model)
+
+
+class AsyncMoveNodeTest(MoveNodeTest):
+
+    def move_node(self, model, **params):
+        params['appmodel'] = 'exampleapp.%s' % model._meta.model_name
+        return call_async_view(amove_node, User.objects.get(username='admin'), params)
+
+    def move_nodes(self, model, moves):
+        return call_async_view(amove_nodes, User.objects.get(username='admin'), {
+            'appmodel': 'exampleapp.%s' % model._meta.model_name, 'moves': dumps(moves)})
+
+
+class MoveNodeStressTest(TransactionTestCase):
+    """
+    Random moves from concurrent threads must keep the trees intact.
+    """
+    fixtures = ['initial_data']
+    threads = 4
+    moves = 15
+
+    def move_randomly(self, model, pks, seed, results):
+        rand = Random(seed)
+        try:
+            for _ in range(self.moves):
+                node, target = rand.sample(pks, 2)
+                kind = rand.choice(('parent', 'prev', 'next'))
+                move = get_move(model, node, *(target if kind == name else None
+                                               for name in ('parent', 'prev', 'next')))
+                # retry moves failing for concurrent transactions
+                # (SQLite locks the whole database)
+                for _ in range(100):
+                    error = run_moves(model, [move]).get('error')
+                    if error != 'conflict':
+                        break
+                    sleep(rand.random() * 0.01)
+                results.append(error)
+        except Exception as e:
+            results.append(e)
+        finally:
+            connection.close()
+
+    def assert_valid_tree(self, model):
+        nodes = list(model.objects.all())
+        if model in (Mptt, Treebeardns):
+            rgt, level, root_level = ('rght', 'level', 0) if model is Mptt else ('rgt', 'depth', 1)
+            trees = {}
+            for node in nodes:
+                trees.setdefault(node.tree_id, []).append(node)
+            for tree in trees.values():
+                bounds = sorted(v for node in tree for v in (node.lft, getattr(node, rgt)))
+                self.assertEqual(bounds, list(range(1, 2 * len(tree) + 1)), model)
+                for node in tree:
+                    ancestors = [n for n in tree if n.lft < node.lft and getattr(n, rgt) > getattr(node, rgt)]
+                    self.assertEqual(getattr(node, level), len(ancestors) + root_level, model)
+                    if model is Mptt:
+                        parent = max(ancestors, key=lambda n: n.lft) if ancestors else None
+                        self.assertEqual(node.parent_id, parent and parent.pk, model)
+        elif model is Treebeardmp:
+            paths = dict((node.path, node) for node in nodes)
+            self.assertEqual(len(paths), len(nodes), model)
+            for node in nodes:
+                self.assertEqual(node.depth, len(node.path) // model.steplen, model)
+                if node.depth > 1:
+                    self.assertIn(node.path[:-model.steplen], paths, model)
+                self.assertEqual(node.numchild, len([
+                    n for n in nodes if n.depth == node.depth + 1 and n.path.startswith(node.path)]), model)
+        else:
+            parents = dict((node.pk, node.parent_id) for node in nodes)
+            for node in nodes:
+                seen = set()
+                pk = node.pk
+                while pk is not None:
+                    self.assertNotIn(pk, seen, model)
+                    seen.add(pk)
+                    pk = parents[pk]
+
+    def test_concurrent_moves(self):
+        for model in TREE_MODELS:
+            results = []
+            pks = list(model.objects.values_list('pk', flat=True))
+            threads = [Thread(target=self.move_randomly, args=(model, pks, seed, results))
+                       for seed in range(self.threads)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(results), self.threads * self.moves, results)
+            self.assertIn(None, results, model)
+            self.assertTrue(set(results) <= set([None, 'invalid', 'conflict']), results)
+            self.assert_valid_tree(model)
+
+
+@override_settings(TREEWIDGET_CACHE='default')
+class CacheInvalidationTest(TestCase):
+    fixtures = ['initial_data']
+
+    def get_changes(self, model, change):
+        version = get_version(model)
+        with self.captureOnCommitCallbacks(execute=True):
+            change()
+        new_version, pks = get_changed_pks(model, version)
+        return new_version - version, pks
+
+    def test_save(self):
+        for model in TREE_MODELS:
+            node = model.objects.get(pk=10)
+            node.name = 'changed'
+            self.assertEqual(self.get_changes(model, node.save), (1, set([10])), model)
+
+    def test_delete(self):
+        for model in TREE_MODELS:
+            node = model.objects.get(pk=10)
+            bumps, pks = self.get_changes(model, node.delete)
+            # treebeard MP also saves the parent (child count)
+            self.assertGreaterEqual(bumps, 1, model)
+            self.assertIn(10, pks, model)
+
+    def test_move(self):
+        for model in TREE_MODELS:
+            node = TreeNode(model.objects.get(pk=10))
+            changes = self.get_changes(model, lambda: node.move(model.objects.get(pk=3), 'first-child'))
+            self.assertEqual(changes, (1, set([10])), model)
+
+    @override_settings(TREEWIDGET_CACHE=None)
+    def test_disabled(self):
+        for model in TREE_MODELS:
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                model.objects.get(pk=10).save()
+            self.assertEqual(callbacks, [], model)
+
+
+@override_settings(TREEWIDGET_CACHE='default')
+class ChangesTest(TestCase):
+    fixtures = ['initial_data']
+
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def get_changes(self, model, since):
+        return self.client.get('/treewidget/changes/', {
+            'appmodel': 'exampleapp.%s' % model._meta.model_name, 'since': since}).json()
+
+    def test_changes(self):
+        for model in TREE_MODELS:
+            version = get_version(model)
+            self.assertEqual(self.get_changes(model, version), {'version': version, 'nodes': [], 'deleted': []})
+            self.assertTrue(run_moves(model, [get_move(model, 10, 3, None, None)])['moved'], model)
+            with self.captureOnCommitCallbacks(execute=True):
+                model.objects.get(pk=12).delete()
+
+            result = self.get_changes(model, version)
+            self.assertEqual(result['version'], get_version(model), model)
+            nodes = dict((node['id'], node) for node in result['nodes'])
+            self.assertEqual(nodes[10]['parent'], 3, model)
+            self.assertEqual(result['deleted'], [12], model)
+
+            # only the changes after the given version
+            result = self.get_changes(model, version + 1)
+            self.assertNotIn(10, [node['id'] for node in result['nodes']], model)
+            self.assertEqual(result['deleted'], [12], model)
+
+    def test_reset(self):
+        for model in TREE_MODELS:
+            version = get_version(model)
+            bump_version(model, [10])
+            bump_version(model, [11])
+            self.assertNotIn('reset', self.get_changes(model, version), model)
+
+            # more versions than the change log size
+            with override_settings(TREEWIDGET_CHANGE_LOG_SIZE=1):
+                self.assertEqual(self.get_changes(model, version), {'version': version + 2, 'reset': True})
+
+            # evicted change log entries
+            caches['default'].delete('treewidget:changes:exampleapp.%s:%s' % (model._meta.model_name, version + 1))
+            self.assertEqual(self.get_changes(model, version), {'version': version + 2, 'reset': True})
+            self.assertNotIn('reset', self.get_changes(model, version + 1), model)
+
+            # changes without recorded nodes
+            bump_version(model)
+            self.assertEqual(self.get_changes(model, version + 2), {'version': version + 3, 'reset': True})
+
+
+@override_settings(TREEWIDGET_CACHE='default')
+class WarmCommandTest(TestCase):
+    fixtures = ['initial_data']
+
+    def test_warm(self):
+        out = StringIO()
+        call_command('treewidget_warm', 'exampleapp.Example.treebeardns', 'exampleapp.Example.mptt_many',
+                     stdout=out)
+        self.assertIn('exampleapp.Example.treebeardns: ', out.getvalue())
+        for name in ('treebeardns', 'mptt_many'):
+            formfield = Example._meta.get_field(name).formfield()
+            widget = formfield.widget
+            widget.load_settings()
+            key = get_tree_key(formfield.queryset.model, widget.get_cache_digest())
+            self.assertIsNotNone(get_tree_data(key), name)
+            with CaptureQueriesContext(connection) as queries:
+                html = widget.render(name, None, {'id': 'id_%s' % name})
+            self.assertIn('treewidget_id_%s_1' % name, html)
+            self.assertEqual(len(queries), 1, name)
+
+
+@override_settings(TREEWIDGET_INSTRUMENTATION=True, TREEWIDGET_SERVER_TIMING=True)
+class InstrumentationTest(TestCase):
+    fixtures = ['initial_data']
+
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        self.records = []
+        stage_finished.connect(self.receive)
+
+    def tearDown(self):
+        stage_finished.disconnect(self.receive)
+
+    def receive(self, sender, record, **kwargs):
+        self.records.append(record)
+
+    def test_view(self):
+        response = self.client.get('/treewidget/get_node/', {'appmodel': 'exampleapp.treebeardns', 'ids': [10, 11]})
+        stages = dict((record.stage, record) for record in self.records)
+        self.assertEqual(stages['treewidget.node_data'].nodes, 2)
+        self.assertGreater(stages['treewidget.node_data'].queries, 0)
+        self.assertEqual(stages['treewidget.get_node'].size, len(response.content))
+        self.assertIn('treewidget.get_node;dur=', response['Server-Timing'])
+
+    def test_widget(self):
+        response = self.client.get('/admin/exampleapp/example/add/')
+        stages = set(record.stage for record in self.records)
+        self.assertTrue(set(['treewidget.queryset', 'treewidget.encode']) <= stages, stages)
+        self.assertIn('treewidget.encode;dur=', response['Server-Timing'])
+        encoded = [record for record in self.records if record.stage == 'treewidget.encode']
+        self.assertTrue(all(record.size > 0 for record in encoded))
+
+    @override_settings(TREEWIDGET_INSTRUMENTATION=False)
+    def test_disabled(self):
+        response = self.client.get('/treewidget/get_node/', {'appmodel': 'exampleapp.mptt', 'ids': [10]})
+        self.assertEqual(self.records, [])
+        self.assertFalse(response.has_header('Server-Timing'))
@@ -0,0 +1,67 @@
+"""
+Browser benchmark of the widget script (`treewidget/default.js`).
+
+Renders a widget for a synthetic tree of `size` nodes (query parameter,
+defaults to 10000) and measures the latency of the select, deselect and
+popup add/delete handlers and of expanding the tree in the browser.
+Point the browser to `/benchmark/?size=100000&multiple=1` (add `&virtual=1`
+for virtual scrolling).
+"""
+from json import dumps
+from django.contrib.admin.views.decorators import staff_member_required
+from django.shortcuts import render
+from treewidget.fields import TREEOPTIONS, iter_tree_json
+from treewidget.formatters import SelectFormatter, CompactFormatter, JSONChunks
+
+
+MAX_SIZE = 1000000
+
+
+def get_rows(size, fanout=10):
+    """
+    Rows of a tree with `size` nodes and `fanout` children per node
+    in breadth first order (see `formatters.SelectFormatter.get_rows`).
+    """
+    return [(pk, pk // fanout or None, 'Node %d' % pk, [], False) for pk in range(1, size + 1)]
+
+
+@staff_member_required
+def benchmark(request):
+    size = min(int(request.GET.get('size', 10000)), MAX_SIZE)
+    multiple = bool(request.GET.get('multiple'))
+    virtual = bool(request.GET.get('virtual'))
+    formatter_cls = CompactFormatter if request.GET.get('compact') else SelectFormatter
+    attr_name = 'id_benchmark'
+    rows = get_rows(size)
+    formatter = formatter_cls(attr_name, ['1'], [], {})
+    additional = {
+        'id': attr_name,
+        'appmodel': 'benchmark.node',
+        'disabled': False,
+        'multiple': multiple,
+        'search': False,
+        'show_buttons': True,
+        'sort': [],
+        # answered by the stubbed ajax call of the benchmark script
+        'updateurl': request.path + 'get_node/',
+        'dnd': False,
+        'moveurl': '',
+        'movesurl': '',
+        'version': None,
+        'changesurl': '',
+        'sync': 0,
+        'virtual': virtual,
+        'searchurl': '',
+        'childrenurl': '',
+        'dataurl': '',
+    }
+    return render(request, 'exampleapp/benchmark.html', {
+        'size': size,
+        'multiple': multiple,
+        'virtual': virtual,
+        'attr_name': attr_name,
+        'widget': {'treewidget': {'id': attr_name, 'show_buttons': True}},
+        'options': [(pk, text) for pk, _, text, _, _ in rows],
+        'json_data': JSONChunks(iter_tree_json, dumps(TREEOPTIONS), additional,
+                                lambda: formatter.encode(formatter.render_rows(rows))),
+    })
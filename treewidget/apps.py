@@ -1,8 +1,29 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.apps import AppConfig
+from django.apps import AppConfig, apps
 
 
 class TreewidgetConfig(AppConfig):
     name = 'treewidget'
+
+    def ready(self):
+        from treewidget.cache import connect_signals, patch_move
+        from treewidget.tree import get_treetype, UnknownTreeImplementation, TREEBEARD
+        from treewidget import index
+
+        models = []
+        for model in apps.get_models():
+            try:
+                treetype = get_treetype(model)
+            except UnknownTreeImplementation:
+                continue
+            if treetype == TREEBEARD:
+                patch_move(model)
+            models.append(model)
+
+        # invalidate cached tree data on tree changes (checks `TREEWIDGET_CACHE` per change)
+        connect_signals(models)
+
+        # mark the tree index as outdated on tree changes (checks `TREEWIDGET_INDEX_MODELS` per change)
+        index.connect_signals(models)
@@ -0,0 +1,326 @@
+from contextlib import contextmanager
+from functools import wraps
+from hashlib import md5
+from time import time
+from asgiref.local import Local
+from django.conf import settings
+from django.core.cache import caches, DEFAULT_CACHE_ALIAS
+from django.core.exceptions import EmptyResultSet
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import Signal
+
+
+# request scoped memo, see `memoize`
+_request = Local()
+
+# changed nodes per tree model, see `collect_changes`
+_changes = Local()
+
+# sent after `move` of treebeard NS and MP nodes, which move nodes
+# with queryset updates without any model signal (see `patch_move`)
+node_moved = Signal()
+
+
+def get_cache():
+    """
+    Returns the django cache configured with `TREEWIDGET_CACHE`
+    in settings.py, or `None` if caching is disabled.
+    """
+    alias = getattr(settings, 'TREEWIDGET_CACHE', None)
+    if not alias:
+        return None
+    return caches[alias]
+
+
+def get_timeout():
+    return getattr(settings, 'TREEWIDGET_CACHE_TIMEOUT', None)
+
+
+def get_appmodel(model):
+    opts = model._meta.concrete_model._meta
+    return '%s.%s' % (opts.app_label, opts.model_name)
+
+
+def get_version(model):
+    """
+    Returns the current version of a tree model. The version is a counter
+    bumped on every tree change. If the counter is missing (evicted or
+    new) it starts from a timestamp, so old versions never come back.
+    """
+    cache = get_cache()
+    key = 'treewidget:version:%s' % get_appmodel(model)
+    version = cache.get(key)
+    if version is None:
+        version = int(time() * 1000)
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+class StaleVersion(Exception):
+    pass
+
+
+def check_version(model, version):
+    """
+    Raises `StaleVersion` if `version` (e.g. sent by a widget)
+    is not the current version of the tree model.
+    Versions are only known with caching enabled.
+    """
+    if version and get_cache() is not None and str(get_version(model)) != str(version):
+        raise StaleVersion('tree version %s is outdated' % version)
+
+
+def bump_version(model, pks=None):
+    """
+    Bumps the version of a tree model, which invalidates all cached data.
+    Call this after tree changes not covered by the model signals,
+    e.g. `QuerySet.update` or raw SQL. `pks` are the changed nodes,
+    which get recorded in the change log for the new version
+    (see `get_changed_pks`), without the widgets have to reload the tree.
+    Also marks the tree index as outdated (see `index`).
+    """
+    from treewidget.index import is_indexed, invalidate_index
+    if is_indexed(model):
+        invalidate_index(model)
+    return increment_version(model, pks)
+
+
+def increment_version(model, pks=None):
+    """
+    Bumps the version of a tree model like `bump_version` for changes
+    sent by the model signals, which also update the tree index.
+    """
+    cache = get_cache()
+    if cache is None:
+        return None
+    appmodel = get_appmodel(model)
+    try:
+        version = cache.incr('treewidget:version:%s' % appmodel)
+    except ValueError:
+        return get_version(model)
+    if pks is not None:
+        cache.set('treewidget:changes:%s:%s' % (appmodel, version), list(pks), get_timeout())
+    return version
+
+
+def get_changed_pks(model, since):
+    """
+    Returns the current version of a tree model and the pks of the nodes
+    changed after version `since` from the change log. The pks are `None`,
+    if the changes are unknown (e.g. evicted, not recorded or more than
+    `TREEWIDGET_CHANGE_LOG_SIZE` versions).
+    """
+    version = get_version(model)
+    since = int(since)
+    if since > version or version - since > getattr(settings, 'TREEWIDGET_CHANGE_LOG_SIZE', 1000):
+        return version, None
+    appmodel = get_appmodel(model)
+    keys = ['treewidget:changes:%s:%s' % (appmodel, v) for v in range(since + 1, version + 1)]
+    entries = get_cache().get_many(keys)
+    if len(entries) != len(keys):
+        return version, None
+    pks = set()
+    for key in keys:
+        pks.update(entries[key])
+    return version, pks
+
+
+def get_digest(queryset, *parts):
+    """
+    Returns a digest of `queryset` and additional `parts`, which are values
+    the tree data depends on besides the queryset (e.g. settings).
+    Returns `None` if caching and the request memo are disabled
+    or caching is not possible.
+    """
+    if get_cache() is None and get_memo() is None:
+        return None
+    try:
+        sql, params = queryset.query.sql_with_params()
+    except EmptyResultSet:
+        return None
+    return md5(repr((sql, params, parts)).encode('utf-8')).hexdigest()
+
+
+def get_tree_key(model, digest, version=None):
+    """
+    Returns the cache key for tree data of `digest`
+    and the current (or given) tree version.
+    """
+    return 'treewidget:tree:%s:%s:%s' % (
+        get_appmodel(model), get_version(model) if version is None else version, digest)
+
+
+def get_tree_data(key):
+    return get_cache().get(key)
+
+
+def set_tree_data(key, data):
+    get_cache().set(key, data, get_timeout())
+
+
+def register_queryset(digest, queryset, settings):
+    """
+    Stores the query and the widget settings of `digest`,
+    so the tree data can be rebuilt outside of the widget
+    (see `views.get_tree`).
+    """
+    get_cache().add('treewidget:queryset:%s' % digest,
+                    (queryset.model, queryset.query, settings), get_timeout())
+
+
+def get_registered_queryset(digest):
+    """
+    Returns the queryset and widget settings
+    registered for `digest` or `None`.
+    """
+    entry = get_cache().get('treewidget:queryset:%s' % digest)
+    if entry is None:
+        return None
+    model, query, settings = entry
+    queryset = model._default_manager.all()
+    queryset.query = query
+    return queryset, settings
+
+
+def get_query_cache():
+    """
+    Returns the cache keeping the queries of the widgets for the ajax views,
+    the cache of `TREEWIDGET_CACHE` or the default django cache.
+    """
+    return get_cache() or caches[DEFAULT_CACHE_ALIAS]
+
+
+def store_query(queryset, *data):
+    """
+    Stores the query of `queryset` and additional `data` server side
+    and returns a digest of both to load them with `load_query`.
+    """
+    try:
+        sql = queryset.query.sql_with_params()
+    except EmptyResultSet:
+        sql = None
+    digest = md5(repr((get_appmodel(queryset.model), sql, data)).encode('utf-8')).hexdigest()
+    get_query_cache().set('treewidget:query:%s' % digest,
+                          (queryset.model, queryset.query, data), get_timeout())
+    return digest
+
+
+def load_query(digest):
+    """
+    Returns the queryset and the additional data stored
+    for `digest` by `store_query` or `None`.
+    """
+    entry = get_query_cache().get('treewidget:query:%s' % digest)
+    if entry is None:
+        return None
+    model, query, data = entry
+    queryset = model._default_manager.all()
+    queryset.query = query
+    return queryset, list(data)
+
+
+def get_body(key):
+    return get_cache().get('treewidget:body:%s' % key)
+
+
+def set_body(key, body):
+    get_cache().set('treewidget:body:%s' % key, body, get_timeout())
+
+
+def get_memo():
+    """
+    Returns the memo dictionary of the current request
+    or `None` outside of `memoize`.
+    """
+    return getattr(_request, 'memo', None)
+
+
+@contextmanager
+def memoize():
+    """
+    Context manager providing a memo for the tree data, which gets shared
+    by widgets with the same queryset and settings (see `get_memo`).
+    Nested calls keep the outer memo.
+    """
+    if get_memo() is not None:
+        yield
+        return
+    _request.memo = {}
+    try:
+        yield
+    finally:
+        del _request.memo
+
+
+def invalidate(sender, **kwargs):
+    """
+    Signal receiver for tree changes. Bumps the version after
+    the transaction got committed, since treebeard moves nodes
+    after `save` was called. The changed node gets recorded
+    in the change log. The receiver is connected for all tree models,
+    without `TREEWIDGET_CACHE` it does nothing. Within `collect_changes`
+    the node only gets collected.
+    """
+    if get_cache() is None:
+        return
+    pk = kwargs['instance'].pk
+    collected = getattr(_changes, 'pks', {}).get(sender._meta.concrete_model)
+    if collected is not None:
+        collected.add(pk)
+        return
+    transaction.on_commit(lambda: increment_version(sender, [pk]), using=kwargs.get('using'))
+
+
+@contextmanager
+def collect_changes(model):
+    """
+    Context manager collecting the nodes of `model` changed by the signals
+    instead of bumping the version per change. Yields the set of changed pks,
+    the caller bumps the version once with them (see `views.run_moves`).
+    Nested calls for the same model share the set.
+    """
+    model = model._meta.concrete_model
+    collected = getattr(_changes, 'pks', None)
+    if collected is None:
+        collected = _changes.pks = {}
+    if model in collected:
+        yield collected[model]
+        return
+    collected[model] = set()
+    try:
+        yield collected[model]
+    finally:
+        del collected[model]
+
+
+def patch_move(model):
+    """
+    Wraps `move` of a treebeard NS or MP model to send `node_moved`
+    after the move. Other tree models are left unchanged, treebeard AL
+    and django-mptt save moved nodes (`post_save`).
+    """
+    from treebeard.ns_tree import NS_Node
+    from treebeard.mp_tree import MP_Node
+    if not issubclass(model, (NS_Node, MP_Node)) or getattr(model.move, 'sends_node_moved', False):
+        return
+    move = model.move
+
+    @wraps(move)
+    def wrapper(self, target, pos=None):
+        result = move(self, target, pos)
+        node_moved.send(sender=self.__class__, instance=self, using=self._state.db)
+        return result
+    wrapper.sends_node_moved = True
+    model.move = wrapper
+
+
+def connect_signals(models):
+    """
+    Connects the invalidation receiver for the given tree models.
+    """
+    for model in models:
+        post_save.connect(invalidate, sender=model, dispatch_uid='treewidget_save')
+        post_delete.connect(invalidate, sender=model, dispatch_uid='treewidget_delete')
+        node_moved.connect(invalidate, sender=model, dispatch_uid='treewidget_move')
@@ -1,12 +1,19 @@
 from django.forms.widgets import SelectMultiple, Select
 from django.forms import ModelChoiceField, ModelMultipleChoiceField
-from django.utils.safestring import mark_safe
 from django.db import models
+from django.db.models import Q
 from django.conf import settings
+from django.core import signing
+from django.core.exceptions import FieldError, ImproperlyConfigured
+from django.utils.encoding import force_str
 from json import dumps
+from urllib.parse import urlencode
 from django.urls import reverse, NoReverseMatch
-from treewidget.tree import TreeQuerySet, get_treetype, MPTT
-from treewidget.formatters import SelectFormatter
+from treewidget.tree import TreeQuerySet, get_treetype, MPTT, PARENT_SUBQUERY
+from treewidget.formatters import SelectFormatter, JSONChunks, mark_lazy, escape_script
+from treewidget.timing import measure, measure_chunks
+from treewidget.cache import (get_cache, get_digest, get_memo, get_tree_key, get_tree_data,
+                              set_tree_data, register_queryset, get_version, store_query, load_query)
 
 
 TREEOPTIONS = {
@@ -21,6 +28,124 @@ TREEOPTIONS = {
 }
 
 
+def get_url(name):
+    """
+    Returns the url of a treewidget ajax view or an empty string,
+    if the treewidget urls are not installed.
+    """
+    try:
+        return reverse(name)
+    except NoReverseMatch:
+        return ''
+
+
+def get_drawable_queryset(queryset, filtered=False, strategy=PARENT_SUBQUERY):
+    """
+    Returns the queryset annotated with `_parent_pk` and the disabled pks.
+    With `filtered` the queryset gets replaced by a queryset containing
+    all ancestors to ensure the data form a correct subtree structure,
+    added nodes are disabled. `strategy` selects the parent resolution
+    for treebeard NS and MP (see `TreeQuerySet.annotate_parent`).
+    """
+    qs = TreeQuerySet(queryset).annotate_parent(strategy)
+    if not filtered:
+        return qs, []
+    with measure('treewidget.ancestors') as record:
+        orig_pks = set(queryset.values_list('pk', flat=True))
+        qs_new = TreeQuerySet(queryset).get_ancestors_parent_annotated(include_self=True, strategy=strategy)
+        disabled = set(node.pk for node in qs_new) - orig_pks
+        if record:
+            record.nodes = len(qs_new.qs)
+    return qs_new, disabled
+
+
+def get_drawable_values(queryset, label, filtered=False, strategy=PARENT_SUBQUERY, sort=False):
+    """
+    Values-only variant of `get_drawable_queryset` for `label` in settings.
+    Returns tuples of `(pk, parent pk, label, *ordering values)` and the
+    disabled pks without instantiating model objects.
+    `label` is a field name or an expression.
+    """
+    tqs = TreeQuerySet(queryset)
+    with measure('treewidget.ancestors' if filtered else 'treewidget.values') as record:
+        if filtered:
+            qs = tqs.get_ancestors_parent_annotated(include_self=True, strategy=strategy)
+        else:
+            qs = tqs.annotate_parent(strategy)
+        fields = [label]
+        if sort:
+            fields.extend(attr.lstrip('-') for attr in qs.ordering)
+        values = qs.values_parent_annotated(*fields)
+        disabled = []
+        if filtered:
+            disabled = set(row[0] for row in values) - set(queryset.values_list('pk', flat=True))
+        if record:
+            record.nodes = len(values)
+    return values, disabled
+
+
+def get_queryset_key(queryset, salt, *data):
+    """
+    Returns a signed key of the query of `queryset` and additional `data`,
+    created while rendering the widget. The query stays on the server
+    (see `cache.store_query`), the key only carries its digest. The ajax
+    views resolve the queryset of the widget from it with `load_queryset_key`,
+    so they only return nodes the form field accepts (e.g. with `limit_choices_to`).
+    """
+    return signing.dumps(store_query(queryset, *data), salt=salt)
+
+
+def load_queryset_key(key, salt):
+    """
+    Returns the queryset and the additional data of a key from `get_queryset_key`,
+    `None` for invalid keys or queries no longer stored.
+    """
+    try:
+        digest = signing.loads(key, salt=salt)
+    except signing.BadSignature:
+        return None
+    return load_query(digest)
+
+
+def get_search_key(queryset, settings):
+    """
+    Returns a signed key of `queryset` and the lookup of `search_field`
+    in settings for `views.search_nodes` (see `get_queryset_key`).
+    Raises `ImproperlyConfigured` for unknown search fields or lookups.
+    """
+    lookup = '%s__%s' % (settings['search_field'], settings.get('search_lookup', 'icontains'))
+    try:
+        queryset.filter(**{lookup: ''})
+    except FieldError as e:
+        raise ImproperlyConfigured("invalid 'search_field' or 'search_lookup': %s" % e)
+    return get_queryset_key(queryset, 'treewidget.search', lookup)
+
+
+def renders_values(settings):
+    """
+    Whether the tree data can be built values-only with `label` in settings.
+    Not possible for formatters overriding `get_rows` or `render`.
+    """
+    formatter = settings.get('formatter') or SelectFormatter
+    return bool(settings.get('label')
+                and issubclass(formatter, SelectFormatter)
+                and formatter.get_rows is SelectFormatter.get_rows
+                and formatter.render is SelectFormatter.render)
+
+
+def iter_tree_json(treeoptions, additional, treedata):
+    """
+    Yields the JSON data for the widget script in chunks,
+    `treedata` returns the encoded tree data chunks
+    (see `formatters.SelectFormatter.encode`).
+    """
+    yield '{"settings": %s, "additional": %s, "treedata": ' % (
+        escape_script(treeoptions), escape_script(dumps(additional)))
+    for chunk in treedata():
+        yield chunk
+    yield '}'
+
+
 class TreeSelectWidgetMixin(object):
     """
     Mixin class for SelectWidgets to provide the tree functionality.
@@ -40,6 +165,18 @@ class TreeSelectWidgetMixin(object):
             'treewidget/default.css'
         )}
 
+    def prepare_selected(self, selected):
+        """
+        Converts selected to a list of pks (as strings).
+        """
+        if not selected:
+            selected = []
+        elif isinstance(selected, str):
+            selected = [selected]
+        elif not hasattr(selected, '__iter__'):
+            selected = [selected]
+        return [str(pk) for pk in selected]
+
     def prepare_queryset(self, selected):
         """
         Prepares the underlying queryset so it can be used for the jstree
@@ -48,46 +185,247 @@ class TreeSelectWidgetMixin(object):
         Steps taken:
             - convert selected to a list of pks (as strings)
             - annotate _parent_pk to objects to avoid db query for parent lookup
-            - replace `choices` with drilled down list to avoid another db query
             - if `filtered` in settings is `True` replace queryset with
               queryset containing all ancestors to ensure the data form
               a correct subtree structure (disables added nodes in treewidget)
+            - if `lazy` in settings is set replace queryset with the upper
+              levels and the paths to selected nodes (see `prepare_lazy_queryset`)
         """
         # set selected to a list of str(pk)
-        if not selected:
-            selected = []
-        elif isinstance(selected, str):
-            selected = [selected]
-        elif not hasattr(selected, '__iter__'):
-            selected = [selected]
-        selected = [str(pk) for pk in selected]
-
-        # add _parent_pk attribute to queryset objects
-        qs = TreeQuerySet(self.choices.queryset).annotate_parent()
-
-        # replace choices to avoid another db query
-        # FIXME: has illegal state in 2nd run, therefore disabled for now
-        # FIXME: also causes trouble with `empty_label` (
-        #choices = []
-        #if self.settings.get('empty_label'):
-        #    choices.append(('', self.settings['empty_label']))
-        #for node in qs:
-        #    choices.append((node.pk, force_text(node)))
-        #self.choices = choices
-
-        if not self.settings.get('filtered'):
-            return qs, selected, []
-
-        orig_pks = set(node.pk for node in qs)
-        qs_new = TreeQuerySet(qs).get_ancestors_parent_annotated(include_self=True)
-        disabled = set(node.pk for node in qs_new) - orig_pks
-        return qs_new, selected, disabled
+        selected = self.prepare_selected(selected)
+
+        # load settings if not supplied
+        self.load_settings()
+
+        # lazy mode: only draw upper levels and the paths to selected nodes
+        if self.is_lazy:
+            return self.prepare_lazy_queryset(selected), selected, []
+
+        # add _parent_pk attribute to queryset objects, add ancestors for filtered
+        qs, disabled = get_drawable_queryset(
+            self.choices.queryset, self.settings.get('filtered'),
+            self.settings.get('parent_strategy', PARENT_SUBQUERY))
+        return qs, selected, disabled
+
+    def get_tree_choices(self, qs, selected, disabled):
+        """
+        Builds the select choices from the drawable queryset, which gets
+        evaluated only once for options and tree data that way.
+        With `selected_only` in settings (always for `lazy`) only options
+        for the selected nodes are rendered, others are added by the widget
+        script on selection.
+        """
+        iterator = self.choices
+        selected_only = self.settings.get('selected_only') or self.is_lazy
+        choices = []
+        if iterator.field.empty_label is not None:
+            choices.append(('', iterator.field.empty_label))
+        for node in qs:
+            if node.pk in disabled:
+                continue
+            if selected_only and str(node.pk) not in selected:
+                continue
+            choices.append(iterator.choice(node.node))
+        return choices
+
+    def get_value_choices(self, values, selected, disabled):
+        """
+        Variant of `get_tree_choices` for the values from `get_drawable_values`,
+        the options get the label as text.
+        """
+        selected_only = self.settings.get('selected_only')
+        choices = []
+        if self.choices.field.empty_label is not None:
+            choices.append(('', self.choices.field.empty_label))
+        for row in values:
+            if row[0] in disabled:
+                continue
+            if selected_only and str(row[0]) not in selected:
+                continue
+            choices.append((row[0], force_str(row[2])))
+        return choices
+
+    @property
+    def uses_values(self):
+        """
+        Whether the tree data and options get built values-only
+        (see `renders_values`). Not used for `lazy` and fields
+        with `to_field_name`.
+        """
+        return bool(renders_values(self.settings)
+                    and not self.is_lazy
+                    and not self.choices.field.to_field_name)
 
-    def _get_mixin_context(self, name, qs, selected, disabled, attrs=None):
+    @property
+    def is_lazy(self):
+        """
+        Whether the `lazy` mode is usable. Needs the ajax urls and cannot be
+        combined with `filtered` (lazy loaded children are not filtered).
+        """
+        return bool(self.settings.get('lazy')
+                    and not self.settings.get('filtered')
+                    and get_url('treewidget.get_children'))
+
+    def prepare_lazy_queryset(self, selected):
+        """
+        Drawable queryset for the `lazy` mode. Contains the first
+        `settings['lazy']` levels (`True` for roots only) and the children
+        of all ancestors of selected nodes, so the selected nodes are reachable.
+        Nodes with children not contained get loaded on demand by jstree
+        from the `get_children` view.
+        """
+        levels = self.settings['lazy']
+        levels = 1 if levels is True else int(levels)
+        tqs = TreeQuerySet(self.choices.queryset)
+        filters = Q(pk__in=tqs.get_top_levels(levels).qs.values('pk'))
+        if selected:
+            ancestors = list(TreeQuerySet(tqs.filter(pk__in=selected))
+                             .get_ancestors_parent_annotated())
+            if ancestors:
+                filters |= Q(pk__in=tqs.get_children_parent_annotated(ancestors).qs.values('pk'))
+        qs = TreeQuerySet(tqs.filter(filters)).annotate_parent().annotate_leaf()
+        return mark_lazy(qs)
+
+    def load_settings(self):
+        """
+        Loads project wide settings, if not supplied.
+        """
+        if not self.settings and hasattr(settings, 'TREEWIDGET_SETTINGS'):
+            self.settings = settings.TREEWIDGET_SETTINGS
+        if not self.treeoptions:
+            self.treeoptions = dumps(settings.TREEWIDGET_TREEOPTIONS
+                if hasattr(settings, 'TREEWIDGET_TREEOPTIONS') else TREEOPTIONS)
+
+    def get_cache_digest(self):
+        """
+        Returns the cache digest for the selection independent tree data
+        or `None`, if the data cannot be cached. Caching is enabled with
+        `TREEWIDGET_CACHE` in settings.py or `middleware.TreeDataMiddleware`
+        and can be turned off per field with `cache` set to `False` in settings.
+        Not used for `lazy` and for formatters overriding `render`
+        (override `get_rows` and `render_rows` instead).
+        """
+        formatter = self.settings.get('formatter') or SelectFormatter
+        if not self.settings.get('cache', True) or self.is_lazy:
+            return None
+        if not issubclass(formatter, SelectFormatter) or formatter.render is not SelectFormatter.render:
+            return None
+        return get_digest(
+            self.choices.queryset,
+            formatter.__module__,
+            formatter.__name__,
+            bool(self.settings.get('filtered')),
+            bool(self.settings.get('sort')),
+            repr(self.settings.get('label')) if renders_values(self.settings) else None)
+
+    def get_tree_context(self, get_context, name, value, attrs):
+        """
+        Builds the widget context with `get_context` of the select widget
+        and adds the tree context as `treewidget`.
+        On a cache hit or for `external` the tree queryset is not evaluated
+        at all, only the options get rendered from the original choices
+        (or the selected nodes for `selected_only`).
+        Within `middleware.TreeDataMiddleware` the tree data is built only
+        once per request for widgets with the same queryset and settings,
+        later widgets reference the data of the first one by its id.
+        """
+        self.load_settings()
+        digest = self.get_cache_digest()
+        memo = get_memo() if digest else None
+        attr_name = attrs.get('id') if attrs and attrs.get('id') else name
+        cache_key = None
+        external = None
+        cached = None
+        ref = None
+        if digest and self.settings.get('external') and get_cache() and get_url('treewidget.get_tree'):
+            # tree data gets loaded by jstree from `views.get_tree`
+            register_queryset(digest, self.choices.queryset, self.settings)
+            external = digest
+            cached = ([], [])
+        elif memo is not None and digest in memo:
+            # tree data of another widget in this request
+            rows, disabled, ref = memo[digest]
+            cached = (rows, disabled)
+            if ref == attr_name:
+                ref = None
+        elif digest and get_cache():
+            cache_key = get_tree_key(self.choices.queryset.model, digest)
+            cached = get_tree_data(cache_key)
+        choices_key = self.get_choices_key(digest) if memo is not None else None
+        if cached is not None:
+            rows, disabled = cached
+            selected = self.prepare_selected(value)
+            qs = TreeQuerySet(self.choices.queryset)
+            choices = self.choices
+            if self.settings.get('selected_only'):
+                choices = self.get_tree_choices(qs.filter(pk__in=selected), selected, disabled)
+            elif choices_key in (memo or ()):
+                choices = memo[choices_key]
+        elif self.uses_values:
+            # build rows and options without model instances
+            selected = self.prepare_selected(value)
+            values, disabled = get_drawable_values(
+                self.choices.queryset, self.settings['label'], self.settings.get('filtered'),
+                self.settings.get('parent_strategy', PARENT_SUBQUERY), self.settings.get('sort'))
+            formatter = (self.settings.get('formatter') or SelectFormatter)(
+                attr_name, selected, disabled, self.settings)
+            rows = list(formatter.get_value_rows(values))
+            if cache_key:
+                set_tree_data(cache_key, (rows, disabled))
+            qs = TreeQuerySet(self.choices.queryset)
+            choices = self.get_value_choices(values, selected, disabled)
+        else:
+            rows = None
+            with measure('treewidget.queryset') as record:
+                qs, selected, disabled = self.prepare_queryset(value)
+                choices = self.get_tree_choices(qs, selected, disabled)
+                if record:
+                    record.nodes = len(qs.qs)
+            if memo is not None:
+                formatter = (self.settings.get('formatter') or SelectFormatter)(
+                    attr_name, selected, disabled, self.settings)
+                with measure('treewidget.rows') as record:
+                    rows = list(formatter.get_rows(qs))
+                    if record:
+                        record.nodes = len(rows)
+                if cache_key:
+                    set_tree_data(cache_key, (rows, disabled))
+        if memo is not None and not external and digest not in memo:
+            memo[digest] = (rows, disabled, attr_name)
+        if choices_key and not self.settings.get('selected_only') and choices_key not in memo:
+            choices = memo[choices_key] = list(choices)
+
+        # render options from drawable queryset, restore choices for next run
+        original = self.choices
+        self.choices = choices
+        try:
+            ctx = get_context(name, value, attrs)
+        finally:
+            self.choices = original
+        ctx['widget']['treewidget'] = self._get_mixin_context(
+            name, qs, selected, disabled, attrs, rows, cache_key, external, ref)
+        return ctx
+
+    def get_choices_key(self, digest):
+        """
+        Memo key of the options for tree data of `digest`. The options
+        depend on the field class, `to_field_name` and `empty_label`.
+        """
+        field = self.choices.field
+        return ('choices', digest, type(field), field.to_field_name, field.empty_label)
+
+    def _get_mixin_context(self, name, qs, selected, disabled, attrs=None,
+                           rows=None, cache_key=None, external=None, ref=None):
         """
         Method to build the final tree widget context data.
         The tree data is provided to `jstree` as json object in the DOM.
         The data for `jstree` rendered by `formatters.SelectFormatter`.
+        `rows` are cached tree data, if `cache_key` is given without `rows`
+        the tree data gets stored in the cache.
+        With the registered digest as `external` the tree data is not
+        contained, instead `jstree` loads it from `views.get_tree`.
+        With the id of another widget as `ref` the tree data is taken
+        from that widget by the widget script.
         """
         # need something like a unique id, use name if none in attrs
         if not attrs or not attrs.get('id'):
@@ -95,23 +433,21 @@ class TreeSelectWidgetMixin(object):
         attr_name = attrs.get('id')
 
         # try to get ajax urls
-        try:
-            update_url = reverse('treewidget.get_node')
-            move_url = reverse('treewidget.move_node')
-        except NoReverseMatch:
-            update_url = ''
-            move_url = ''
+        update_url = get_url('treewidget.get_node')
+        move_url = get_url('treewidget.move_node')
 
         # load settings if not supplied
-        if not self.settings and hasattr(settings, 'TREEWIDGET_SETTINGS'):
-            self.settings = settings.TREEWIDGET_SETTINGS
-        if not self.treeoptions:
-            self.treeoptions = dumps(settings.TREEWIDGET_TREEOPTIONS
-                if hasattr(settings, 'TREEWIDGET_TREEOPTIONS') else TREEOPTIONS)
+        self.load_settings()
 
         # jstree data formatter
         formatter = (self.settings.get('formatter') or SelectFormatter)(
             attr_name, selected, disabled, self.settings)
+        if rows is None and cache_key:
+            with measure('treewidget.rows') as record:
+                rows = list(formatter.get_rows(qs))
+                if record:
+                    record.nodes = len(rows)
+            set_tree_data(cache_key, (rows, disabled))
 
         # additional settings for JS
         additional = {
@@ -125,21 +461,54 @@ class TreeSelectWidgetMixin(object):
             'updateurl': update_url,
             'dnd': self.settings.get('dnd', False),
             'moveurl': move_url if self.settings.get('dnd') else '',
+            'movesurl': get_url('treewidget.move_nodes') if self.settings.get('dnd') else '',
+            'version': get_version(qs.qs.model) if get_cache() else None,
+            'changesurl': get_url('treewidget.get_changes') if get_cache() else '',
+            'sync': self.settings.get('sync', 0),
+            'virtual': self.settings.get('virtual', False),
+            'searchurl': '',
+            'childrenurl': '',
+            'dataurl': '',
         }
 
-        # data for JS
-        json_data = '{"settings": %s, "additional": %s, "treedata": %s}' % (
-            self.treeoptions,
-            dumps(additional),
-            dumps(list(formatter.render(qs)))
-        )
+        # children loaded on demand from the field's queryset
+        if self.is_lazy:
+            additional['childrenurl'] = get_url('treewidget.get_children')
+            additional['childrenkey'] = get_queryset_key(self.choices.queryset, 'treewidget.children')
+
+        # server side search
+        search_url = get_url('treewidget.search')
+        if self.settings.get('search') and self.settings.get('search_field') and search_url:
+            additional['searchurl'] = search_url
+            additional['searchkey'] = get_search_key(self.choices.queryset, self.settings)
+
+        # external tree data, selected state gets applied by the widget script
+        if external:
+            additional['dataurl'] = '%s?%s' % (get_url('treewidget.get_tree'), urlencode({
+                'key': external, 'attr_name': attr_name}))
+            additional['selected'] = selected
+            rows = []
+
+        # tree data of another widget, selected state gets applied by the widget script
+        if ref:
+            additional['treedata_ref'] = ref
+            additional['selected'] = selected
+            rows = []
+
+        # data for JS, encoded in chunks while the template gets rendered
+        def treedata():
+            return measure_chunks('treewidget.encode', formatter.encode(
+                formatter.render(qs) if rows is None else formatter.render_rows(rows)))
+        json_data = JSONChunks(iter_tree_json, self.treeoptions, additional, treedata)
 
         # treewidget context
         return {
             'id': attr_name,
             'search': self.settings.get('search', False),
             'show_buttons': self.settings.get('show_buttons', False),
-            'json_data': mark_safe(json_data.replace('</script', '<\\/script')),
+            'json_data': json_data,
+            # inline tree data only
+            'worker': bool(self.settings.get('worker')) and not external and not ref,
             'disabled': attrs.get('disabled')
         }
 
@@ -149,10 +518,8 @@ class TreeSelectMultiple(SelectMultiple, TreeSelectWidgetMixin):
     multiple = True
 
     def get_context(self, name, value, attrs):
-        drawable_qs, selected, disabled = self.prepare_queryset(value)
-        ctx = super(TreeSelectMultiple, self).get_context(name, value, attrs)
-        ctx['widget']['treewidget'] = self._get_mixin_context(
-            name, drawable_qs, selected, disabled, attrs)
+        ctx = self.get_tree_context(
+            super(TreeSelectMultiple, self).get_context, name, value, attrs)
         ctx['widget']['treewidget']['super_template'] = super(TreeSelectMultiple, self).template_name
         return ctx
 
@@ -162,10 +529,8 @@ class TreeSelect(Select, TreeSelectWidgetMixin):
     multiple = False
 
     def get_context(self, name, value, attrs):
-        drawable_qs, selected, disabled = self.prepare_queryset(value)
-        ctx = super(TreeSelect, self).get_context(name, value, attrs)
-        ctx['widget']['treewidget'] = self._get_mixin_context(
-            name, drawable_qs, selected, disabled, attrs)
+        ctx = self.get_tree_context(
+            super(TreeSelect, self).get_context, name, value, attrs)
         ctx['widget']['treewidget']['super_template'] = super(TreeSelect, self).template_name
         return ctx
 
@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+from json import dumps
 from django.utils.html import escape
 from django.utils.encoding import force_str
+from django.utils.safestring import mark_safe
+
+
+# approximate size of encoded JSON chunks in characters
+CHUNK_SIZE = 65536
 
 
 class SelectFormatter(object):
@@ -28,28 +34,187 @@ class SelectFormatter(object):
         """
         Render method of tree data for `jstree`.
         NOTE: `queryset` is a `tree.TreeQueryset` object.
+        """
+        return self.render_rows(self.get_rows(queryset))
+
+    def get_rows(self, queryset):
+        """
+        Returns the selection independent node data as tuples of
+        `(pk, parent pk, text, sort, lazy)`. The rows can be cached
+        and get turned into `jstree` data by `render_rows`.
         To avoid expensive database lookups, the parent pk
         is accessible as `node.node._parent_pk`.
+        Nodes marked with `node.node._lazy` get their children
+        loaded on demand by `jstree`.
+        """
+        sort = self.settings.get('sort')
+        for node in queryset.iterator():
+            yield (
+                node.pk,
+                node.node._parent_pk,
+                escape(force_str(node)),
+                node.ordering if sort else [],
+                getattr(node.node, '_lazy', False)
+            )
+
+    def get_value_rows(self, values):
+        """
+        Variant of `get_rows` for tuples of `(pk, parent pk, label, *ordering values)`
+        (see `fields.get_drawable_values`), the label gets used as text.
+        """
+        sort = self.settings.get('sort')
+        for row in values:
+            yield (
+                row[0],
+                row[1],
+                escape(force_str(row[2])),
+                list(row[3:]) if sort else [],
+                False
+            )
+
+    def render_rows(self, rows):
+        """
+        Applies ids, selected and disabled state to rows from `get_rows`.
         """
-        for node in queryset:
-            id = self.ID_TEMPLATE % (self.attr_name, node.pk)
+        for pk, parent_pk, text, sort, lazy in rows:
+            id = self.ID_TEMPLATE % (self.attr_name, pk)
             parent = '#'
-            #try:
-            if node.node._parent_pk:
-                parent = self.ID_TEMPLATE % (self.attr_name, node.node._parent_pk)
-            #except AttributeError:
-            #    parent_obj = node.parent
-            #    if parent_obj:
-            #        parent = self.ID_TEMPLATE % (self.attr_name, parent_obj.node.pk)
-            yield {
+            if parent_pk:
+                parent = self.ID_TEMPLATE % (self.attr_name, parent_pk)
+            item = {
                 'id': id,
                 'parent': parent,
-                'text': escape(force_str(node)),
+                'text': text,
                 'data': {
-                    'sort': node.ordering if self.settings.get('sort') else []
+                    'sort': sort
                 },
                 'state': {
-                    'selected': True if str(node.pk) in self.selected else False,
-                    'disabled': True if node.pk in self.disabled else False
+                    'selected': True if str(pk) in self.selected else False,
+                    'disabled': True if pk in self.disabled else False
                 }
             }
+            # children to be loaded on demand (`lazy` setting)
+            if lazy:
+                item['children'] = True
+            yield item
+
+    def encode(self, data):
+        """
+        Encodes the output of `render` or `render_rows` as JSON chunks.
+        """
+        return iter_json(data)
+
+
+class CompactFormatter(SelectFormatter):
+    """
+    Formatter emitting the tree data as parallel arrays instead of
+    one object per node. The widget script expands them to `jstree` nodes.
+
+    Keys of the tree data:
+        - `prefix`: id prefix of the nodes
+        - `pks`, `texts`: pk and text of the nodes
+        - `parents`: index of the parent node in `pks`, -1 for top level nodes
+        - `sort`: sort values of the nodes (only with `sort` in settings)
+        - `selected`, `disabled`, `lazy`: indices of the nodes with that state
+    """
+    def render_rows(self, rows):
+        rows = list(rows)
+        index = dict((row[0], i) for i, row in enumerate(rows))
+        selected = set(str(pk) for pk in self.selected)
+        disabled = set(self.disabled)
+        data = {
+            'prefix': self.ID_TEMPLATE % (self.attr_name, ''),
+            'pks': [row[0] for row in rows],
+            'parents': [index.get(row[1], -1) for row in rows],
+            'texts': [row[2] for row in rows],
+            'selected': [i for i, row in enumerate(rows) if str(row[0]) in selected],
+            'disabled': [i for i, row in enumerate(rows) if row[0] in disabled],
+            'lazy': [i for i, row in enumerate(rows) if row[4]],
+        }
+        if self.settings.get('sort'):
+            data['sort'] = [row[3] for row in rows]
+        return data
+
+    def encode(self, data):
+        """
+        Encodes the arrays one by one.
+        """
+        yield '{'
+        separator = ''
+        for key in sorted(data):
+            yield '%s"%s": %s' % (separator, key, escape_script(dumps(data[key])))
+            separator = ', '
+        yield '}'
+
+
+def mark_lazy(queryset):
+    """
+    Marks nodes, that have children but none of them contained
+    in `queryset`, to be loaded on demand by `jstree`.
+    Evaluates `queryset`, the marks are kept in its result cache.
+    NOTE: `queryset` must be annotated with `_parent_pk`.
+    """
+    nodes = list(queryset)
+    loaded = set(node.node._parent_pk for node in nodes)
+    for node in nodes:
+        node.node._lazy = node.pk not in loaded and not node.is_leaf
+    return queryset
+
+
+def escape_script(data):
+    """
+    Escapes `</` in JSON data, so it cannot close a surrounding script element.
+    """
+    return data.replace('</', '<\\/')
+
+
+def iter_json(items, chunk_size=CHUNK_SIZE):
+    """
+    Encodes `items` as JSON array in chunks of about `chunk_size` characters,
+    the items get encoded and script escaped one by one.
+    """
+    chunk = ['[']
+    length = 1
+    separator = ''
+    for item in items:
+        data = separator + escape_script(dumps(item))
+        separator = ', '
+        chunk.append(data)
+        length += len(data)
+        if length >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+            length = 0
+    chunk.append(']')
+    yield ''.join(chunk)
+
+
+class JSONChunks(object):
+    """
+    Lazy JSON output for templates. Iterating yields the safe chunks
+    of `func(*args)`, which get kept after the first complete iteration,
+    so further iterations and the string value do not encode again.
+    """
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+        self.chunks = None
+
+    def __iter__(self):
+        if self.chunks is not None:
+            return iter(self.chunks)
+        return self._encode()
+
+    def _encode(self):
+        chunks = []
+        for chunk in self.func(*self.args):
+            chunk = mark_safe(chunk)
+            chunks.append(chunk)
+            yield chunk
+        self.chunks = chunks
+
+    def __str__(self):
+        return ''.join(self)
+
+    def __html__(self):
+        return str(self)
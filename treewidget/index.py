@@ -0,0 +1,279 @@
+"""
+Optional materialized tree index.
+
+Holds `(pk, parent pk, depth, sort key)` of every node of the tree models
+listed in `TREEWIDGET_INDEX_MODELS` (as `'app_label.ModelName'`) in
+`models.TreeIndex`. With `parent_strategy` set to `'index'` the parents get
+read from the index within the query of the nodes by an indexed lookup per row
+for any tree implementation (see `get_index_parent`). The index rows get
+updated by signals within the transaction of the tree change (see `update_index`).
+Changes not sending signals (e.g. `QuerySet.update`, raw SQL) mark the index
+as outdated with `cache.bump_version` (or `invalidate_index`), then the parents
+get resolved with the subquery strategy until the index is rebuilt with
+`rebuild_index` (e.g. by the `treewidget_index` management command).
+Only usable for models with integer pks.
+
+The sort key orders the nodes in tree order. It is made of one segment per
+level, each segment followed by `SEPARATOR`. A node gets a segment between
+the segments of its siblings (see `get_key_between`), so changes only
+rewrite the rows of the changed subtree. Like treebeard MP paths the keys
+are limited to 255 characters, which allows trees with about 50 levels.
+"""
+from itertools import count
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import F, Value, BigIntegerField, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Concat, Substr
+from django.db.models.signals import post_save, post_delete
+from treewidget.cache import get_appmodel, node_moved
+from treewidget.models import TreeIndex, TreeIndexState
+from treewidget.tree import TreeQuerySet, PARENT_PYTHON
+
+# digits of the sort key segments. Segments never end with the first digit,
+# so there is always room for a segment before another one.
+DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+# ends every segment, sorts before all digits, so a node sorts
+# before its descendants and these before its next sibling
+SEPARATOR = '.'
+
+
+def check_indexable(model):
+    """
+    Raises `ImproperlyConfigured` for models without integer pks.
+    """
+    field = model._meta.pk
+    while field.is_relation:
+        field = field.target_field
+    if not isinstance(field, IntegerField):
+        raise ImproperlyConfigured('%s cannot be indexed by treewidget, the tree index '
+                                   'needs integer pks' % model._meta.label)
+
+
+def get_indexed_models():
+    """
+    Returns the tree models of `TREEWIDGET_INDEX_MODELS`.
+    Raises `ImproperlyConfigured` for models without integer pks.
+    """
+    models = [apps.get_model(name) for name in getattr(settings, 'TREEWIDGET_INDEX_MODELS', [])]
+    for model in models:
+        check_indexable(model)
+    return models
+
+
+def is_indexed(model):
+    return model._meta.concrete_model in get_indexed_models()
+
+
+def get_current_states(model):
+    return TreeIndexState.objects.filter(model=get_appmodel(model), built=F('generation'))
+
+
+def is_current(model):
+    """
+    Whether the index of `model` is built and not outdated.
+    """
+    return get_current_states(model).exists()
+
+
+async def ais_current(model):
+    """
+    Async version of `is_current`.
+    """
+    return await get_current_states(model).aexists()
+
+
+def get_key_between(low, high):
+    """
+    Returns a sort key segment sorting between the segments `low` and `high`
+    (`''` and `None` for no bound).
+    """
+    key = ''
+    for i in count():
+        lo = DIGITS.index(low[i]) if i < len(low) else 0
+        hi = DIGITS.index(high[i]) if high is not None and i < len(high) else len(DIGITS)
+        if hi - lo > 1:
+            return key + DIGITS[(lo + hi) // 2]
+        key += DIGITS[lo]
+        if hi > lo:
+            # below `high` from here, only `low` bounds the rest
+            high = None
+
+
+def get_segments(n):
+    """
+    Returns `n` ascending sort key segments of equal length
+    without the first digit for the siblings of a rebuilt index.
+    """
+    base = len(DIGITS) - 1
+    width = 1
+    while base ** width < n:
+        width += 1
+    segments = []
+    for i in range(n):
+        digits = []
+        for _ in range(width):
+            i, digit = divmod(i, base)
+            digits.append(DIGITS[digit + 1])
+        segments.append(''.join(reversed(digits)))
+    return segments
+
+
+def get_segment(key):
+    """
+    Returns the last segment of the sort key `key`.
+    """
+    return key[:-1].rsplit(SEPARATOR, 1)[-1]
+
+
+def get_index_rows(rows):
+    """
+    Returns `(pk, parent pk, depth, sort key)` for the `(pk, parent pk)` rows
+    of a tree with siblings in tree order, the depth of root nodes is 0.
+    """
+    children = {}
+    for pk, parent_pk in rows:
+        children.setdefault(parent_pk, []).append(pk)
+    result = []
+    stack = [(None, -1, '')]
+    while stack:
+        parent_pk, depth, prefix = stack.pop()
+        pks = children.get(parent_pk, [])
+        for pk, segment in zip(pks, get_segments(len(pks))):
+            key = prefix + segment + SEPARATOR
+            result.append((pk, parent_pk, depth + 1, key))
+            stack.append((pk, depth + 1, key))
+    return result
+
+
+def rebuild_index(model, attempts=3):
+    """
+    Rebuilds the index rows of `model`. Returns the number of indexed nodes,
+    or `None` if the tree changed during all `attempts`. The tree gets read
+    without locks, the index rows only get replaced (with the index state
+    locked), if the index was not changed meanwhile.
+    Raises `ImproperlyConfigured` for models without integer pks.
+    """
+    check_indexable(model)
+    appmodel = get_appmodel(model)
+    TreeIndexState.objects.get_or_create(model=appmodel)
+    for _ in range(attempts):
+        generation = TreeIndexState.objects.filter(model=appmodel)\
+            .values_list('generation', flat=True).get()
+        # the default managers return siblings in tree order
+        rows = TreeQuerySet(model._default_manager.all())\
+            .annotate_parent(PARENT_PYTHON).values_parent_annotated()
+        entries = [TreeIndex(model=appmodel, node=pk, parent=parent_pk, depth=depth, sort_key=key)
+                   for pk, parent_pk, depth, key in get_index_rows(rows)]
+        with transaction.atomic():
+            state = TreeIndexState.objects.select_for_update().get(model=appmodel)
+            if state.generation != generation:
+                continue
+            TreeIndex.objects.filter(model=appmodel).delete()
+            TreeIndex.objects.bulk_create(entries, batch_size=1000)
+            state.built = generation
+            state.save(update_fields=['built'])
+        return len(entries)
+    return None
+
+
+def update_index(model, pk, using=None):
+    """
+    Updates the index rows after a change of the node `pk` of `model`
+    within the transaction of the change: a new or moved node gets a sort
+    key between its siblings, the rows of its descendants get the new
+    key prefix and depth. A deleted node gets removed with its descendants.
+    The index state stays locked until the end of the transaction, so
+    concurrent changes wait and `rebuild_index` retries. Does nothing
+    for an outdated index. Marks the index as outdated, if the parent or
+    the siblings of the node are not indexed.
+    """
+    appmodel = get_appmodel(model)
+    states = TreeIndexState.objects.using(using).filter(model=appmodel)
+    rows = TreeIndex.objects.using(using).filter(model=appmodel)
+    with transaction.atomic(using=using):
+        if not states.filter(built=F('generation')).update(
+                generation=F('generation') + 1, built=F('built') + 1):
+            return
+        row = rows.filter(node=pk).first()
+        node = TreeQuerySet(model._default_manager.db_manager(using).filter(pk=pk)).annotate_parent().first()
+        if node is None:
+            if row is not None:
+                rows.filter(sort_key__startswith=row.sort_key).delete()
+            return
+
+        parent_pk = node.node._parent_pk
+        prev_node, next_node = node.prev_sibling, node.next_sibling
+        pks = [n.pk for n in (prev_node, next_node) if n is not None]
+        if parent_pk is not None:
+            pks.append(parent_pk)
+        indexed = dict((entry.node, entry) for entry in rows.filter(node__in=pks))
+        if len(indexed) != len(pks):
+            states.update(generation=F('generation') + 1)
+            return
+        parent = indexed.get(parent_pk)
+        prefix = parent.sort_key if parent else ''
+        depth = parent.depth + 1 if parent else 0
+        low = indexed[prev_node.pk].sort_key if prev_node else ''
+        high = indexed[next_node.pk].sort_key if next_node else None
+
+        # unchanged position (e.g. renamed node)
+        if (row is not None and row.parent == parent_pk and row.sort_key.startswith(prefix)
+                and row.sort_key[len(prefix):].count(SEPARATOR) == 1
+                and low < row.sort_key and (high is None or row.sort_key < high)):
+            return
+
+        key = prefix + get_key_between(get_segment(low) if low else '',
+                                       get_segment(high) if high else None) + SEPARATOR
+        if row is None:
+            rows.create(model=appmodel, node=pk, parent=parent_pk, depth=depth, sort_key=key)
+            return
+        # moved subtree, the descendants keep their segments
+        rows.filter(sort_key__startswith=row.sort_key).exclude(node=pk).update(
+            sort_key=Concat(Value(key), Substr('sort_key', len(row.sort_key) + 1)),
+            depth=F('depth') + (depth - row.depth))
+        rows.filter(node=pk).update(parent=parent_pk, depth=depth, sort_key=key)
+
+
+def invalidate_index(model):
+    """
+    Marks the index of `model` as outdated after the current transaction
+    got committed, so tree changes do not hold the index state locked.
+    """
+    states = TreeIndexState.objects.filter(model=get_appmodel(model))
+    transaction.on_commit(lambda: states.update(generation=F('generation') + 1))
+
+
+def get_index_parent(model):
+    """
+    Returns an expression of the parent pk read from the index of `model`,
+    check the index with `is_current` before.
+    """
+    parent = TreeIndex.objects.filter(model=get_appmodel(model), node=OuterRef('pk')).values('parent')
+    return Subquery(parent, output_field=BigIntegerField())
+
+
+def update(sender, **kwargs):
+    """
+    Signal receiver for tree changes, updates the index (see `update_index`).
+    The receiver is connected for all tree models, for models without
+    index it does nothing. Raw saves (e.g. `loaddata`) mark the index as outdated.
+    """
+    if not is_indexed(sender):
+        return
+    if kwargs.get('raw'):
+        invalidate_index(sender)
+        return
+    update_index(sender, kwargs['instance'].pk, kwargs.get('using'))
+
+
+def connect_signals(models):
+    """
+    Connects the index receiver for the given tree models.
+    """
+    for model in models:
+        post_save.connect(update, sender=model, dispatch_uid='treewidget_index_save')
+        post_delete.connect(update, sender=model, dispatch_uid='treewidget_index_delete')
+        node_moved.connect(update, sender=model, dispatch_uid='treewidget_index_move')
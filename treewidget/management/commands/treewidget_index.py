@@ -0,0 +1,29 @@
+"""
+Rebuilds the tree index (see `treewidget.index`) of the models
+in `TREEWIDGET_INDEX_MODELS` or of the given models.
+
+    $> ./manage.py treewidget_index [app_label.ModelName ...]
+"""
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from treewidget.index import get_indexed_models, rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the treewidget tree index.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', help='app_label.ModelName of the tree models')
+
+    def handle(self, *args, **options):
+        try:
+            models = [apps.get_model(name) for name in options['models']] or get_indexed_models()
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+        for model in models:
+            count = rebuild_index(model)
+            if count is None:
+                self.stderr.write('%s: tree changed during the rebuild, index outdated' % model._meta.label)
+            else:
+                self.stdout.write('%s: %d nodes' % (model._meta.label, count))
@@ -0,0 +1,151 @@
+"""
+Prebuilds the tree data of the tree fields in installed apps (or of the given fields).
+
+Fills the tree data cache of the widgets (`TREEWIDGET_CACHE`) and for 'external'
+in settings also the response bodies of the `get_tree` route. With `--output` the
+tree data gets written as static JSON files instead, along with precompressed
+`.gz` (and `.br` with brotli) files. The models are handled in parallel
+by `--jobs` processes.
+
+    $> ./manage.py treewidget_warm [app_label.ModelName.field ...] [--jobs 4] [--output DIR]
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from time import perf_counter
+
+import django
+from django.apps import apps
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import FieldDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+from django.forms.models import apply_limit_choices_to_to_formfield
+
+from treewidget.cache import (get_cache, get_version, get_tree_key, set_tree_data,
+                              register_queryset, set_body)
+from treewidget.fields import TreeForeignKey, TreeOneToOneField, TreeManyToManyField, get_url
+from treewidget.views import build_tree_data, encode_tree_data, compress, get_tree_tag, brotli
+
+
+TREE_FIELDS = (TreeForeignKey, TreeOneToOneField, TreeManyToManyField)
+ENCODINGS = ('', 'gzip', 'br') if brotli else ('', 'gzip')
+EXTENSIONS = {'gzip': '.gz', 'br': '.br'}
+
+
+def get_tree_fields():
+    """
+    Returns the labels `app_label.ModelName.field` of all tree fields.
+    """
+    return ['%s.%s' % (model._meta.label, field.name)
+            for model in apps.get_models()
+            for field in model._meta.local_fields + model._meta.local_many_to_many
+            if isinstance(field, TREE_FIELDS)]
+
+
+def get_field(label):
+    app_label, model_name, name = label.split('.')
+    return apps.get_model(app_label, model_name)._meta.get_field(name)
+
+
+def write_tree_data(path, chunks):
+    """
+    Writes the JSON chunks to `path` and the precompressed variants.
+    Returns the size of the uncompressed data.
+    """
+    body = b''.join(chunks)
+    for encoding in ENCODINGS:
+        with open(path + EXTENSIONS.get(encoding, ''), 'wb') as f:
+            f.write(b''.join(compress([body], encoding)))
+    return len(body)
+
+
+def warm_field(label, output=None):
+    """
+    Builds the tree data of the field `label` like its default form widget,
+    the ids are built with the default form id `id_<field name>`.
+    Returns `(label, seconds, bytes)`, seconds is `None` if the
+    widget does not cache its tree data (e.g. for 'lazy').
+    """
+    field = get_field(label)
+    formfield = field.formfield()
+    apply_limit_choices_to_to_formfield(formfield)
+    widget = formfield.widget
+    widget.load_settings()
+    settings = widget.settings
+    queryset = formfield.queryset
+    attr_name = 'id_%s' % field.name
+    start = perf_counter()
+
+    if output:
+        data = build_tree_data(queryset, settings, attr_name)
+        size = write_tree_data(os.path.join(output, '%s.json' % label),
+                               encode_tree_data(data, settings, attr_name))
+        return label, perf_counter() - start, size
+
+    digest = widget.get_cache_digest()
+    if digest is None:
+        return label, None, 0
+    version = get_version(queryset.model)
+    data = build_tree_data(queryset, settings, attr_name)
+    set_tree_data(get_tree_key(queryset.model, digest, version), data)
+    size = 0
+    if settings.get('external') and get_url('treewidget.get_tree'):
+        register_queryset(digest, queryset, settings)
+        for encoding in ENCODINGS:
+            body = b''.join(compress(encode_tree_data(data, settings, attr_name), encoding))
+            set_body(get_tree_tag(digest, version, attr_name, encoding), body)
+            size = size or len(body)
+    else:
+        size = sum(len(chunk) for chunk in encode_tree_data(data, settings, attr_name))
+    return label, perf_counter() - start, size
+
+
+def warm_fields(labels, output=None):
+    return [warm_field(label, output) for label in labels]
+
+
+class Command(BaseCommand):
+    help = 'Prebuilds the tree data of the treewidget fields.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('fields', nargs='*', help='app_label.ModelName.field of the tree fields')
+        parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                            help='number of worker processes')
+        parser.add_argument('--output', help='directory for static JSON files')
+
+    def handle(self, *args, **options):
+        output = options['output']
+        cache = get_cache()
+        if not output and cache is None:
+            raise CommandError('set TREEWIDGET_CACHE or --output')
+        if output:
+            os.makedirs(output, exist_ok=True)
+        labels = options['fields'] or get_tree_fields()
+        try:
+            for label in labels:
+                get_field(label)
+        except (LookupError, ValueError, FieldDoesNotExist) as e:
+            raise CommandError('unknown tree field: %s' % e)
+
+        # one task per model
+        tasks = {}
+        for label in labels:
+            tasks.setdefault(label.rsplit('.', 1)[0], []).append(label)
+        tasks = list(tasks.values())
+
+        # a process local cache would be lost with the workers
+        jobs = min(options['jobs'], len(tasks))
+        if not output and isinstance(cache, LocMemCache):
+            jobs = 1
+        if jobs > 1:
+            with ProcessPoolExecutor(jobs, get_context('spawn'), initializer=django.setup) as pool:
+                results = pool.map(warm_fields, tasks, [output] * len(tasks))
+        else:
+            results = [warm_fields(task, output) for task in tasks]
+
+        for result in results:
+            for label, seconds, size in result:
+                if seconds is None:
+                    self.stdout.write('%s: skipped, tree data not cached' % label)
+                else:
+                    self.stdout.write('%s: %.3fs, %d bytes' % (label, seconds, size))
@@ -0,0 +1,42 @@
+from treewidget.cache import memoize
+from treewidget.timing import collect, add_server_timing
+
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:
+    # asgiref < 3.6 (Django 3.2), mark like Django's own middlewares did
+    from asyncio import iscoroutinefunction
+    from asyncio.coroutines import _is_coroutine
+
+    def markcoroutinefunction(func):
+        func._is_coroutine = _is_coroutine
+        return func
+
+
+class TreeDataMiddleware(object):
+    """
+    Middleware sharing the tree data of widgets with the same queryset
+    and settings within a request, e.g. for inline formsets.
+    The tree gets queried and sent to the browser only once,
+    other widgets reference the data of the first one.
+    Also adds the instrumentation records of the request
+    as `Server-Timing` header (see `timing`).
+    Supports sync and async requests.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with memoize(), collect() as records:
+            return add_server_timing(self.get_response(request), records)
+
+    async def __acall__(self, request):
+        with memoize(), collect() as records:
+            return add_server_timing(await self.get_response(request), records)
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TreeIndexState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100, unique=True)),
+                ('generation', models.PositiveBigIntegerField(default=0)),
+                ('built', models.PositiveBigIntegerField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TreeIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100)),
+                ('node', models.BigIntegerField()),
+                ('parent', models.BigIntegerField(null=True)),
+                ('depth', models.PositiveIntegerField()),
+                ('sort_key', models.CharField(max_length=255)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['model', 'sort_key'], name='treewidget__model_528777_idx')],
+                'unique_together': {('model', 'node')},
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+from django.db import models
+
+
+class TreeIndexState(models.Model):
+    """
+    State of the tree index of a tree model (see `index`).
+    `generation` gets bumped on tree changes, the index is
+    up to date while `built` equals `generation`.
+    """
+    model = models.CharField(max_length=100, unique=True)
+    generation = models.PositiveBigIntegerField(default=0)
+    built = models.PositiveBigIntegerField(null=True)
+
+    def __str__(self):
+        return self.model
+
+
+class TreeIndex(models.Model):
+    """
+    Parent, depth and tree order of a node of an indexed tree model (see `index`).
+    """
+    model = models.CharField(max_length=100)
+    node = models.BigIntegerField()
+    parent = models.BigIntegerField(null=True)
+    depth = models.PositiveIntegerField()
+    sort_key = models.CharField(max_length=255)
+
+    class Meta:
+        unique_together = (('model', 'node'),)
+        indexes = [models.Index(fields=['model', 'sort_key'])]
+
+    def __str__(self):
+        return '%s:%s' % (self.model, self.node)
@@ -8,53 +8,637 @@
         }
     }
 
+    // expand the parallel arrays of `formatters.CompactFormatter` to jstree nodes
+    // (also runs in the tree worker, no jQuery)
+    function expand_treedata(data) {
+        if (!data || Array.isArray(data))
+            return data;
+        var flags = function(indices) {
+            var result = {};
+            indices.forEach(function(i) { result[i] = true; });
+            return result;
+        };
+        var selected = flags(data.selected);
+        var disabled = flags(data.disabled);
+        var lazy = flags(data.lazy);
+        var nodes = new Array(data.pks.length);
+        for (var i = 0; i < data.pks.length; ++i) {
+            var parent = data.parents[i];
+            nodes[i] = {
+                id: data.prefix + data.pks[i],
+                parent: (parent < 0) ? '#' : data.prefix + data.pks[parent],
+                text: data.texts[i],
+                data: {sort: (data.sort) ? data.sort[i] : []},
+                state: {selected: !!selected[i], disabled: !!disabled[i]}
+            };
+            if (lazy[i])
+                nodes[i].children = true;
+        }
+        return nodes;
+    }
+
+    // tree data of widgets referenced by other widgets (`middleware.TreeDataMiddleware`)
+    var shared_treedata = {};
+
+    function get_shared_treedata(ref) {
+        if (!shared_treedata.hasOwnProperty(ref)) {
+            var data_element = $('#treewidget_' + ref).children('script')[0];
+            var data = (data_element) ? JSON.parse(data_element.textContent || data_element.innerText) : {};
+            shared_treedata[ref] = expand_treedata(data.treedata) || [];
+        }
+        return shared_treedata[ref];
+    }
+
+    // copy the tree data of widget `ref` with the ids and selected state of this widget
+    function share_treedata(ref, attr_name, selected_values) {
+        var source = ['treewidget', ref, ''].join('_').length;
+        var pk = pk_proto('treewidget', attr_name);
+        var selected = {};
+        selected_values.forEach(function(value) { selected[value] = true; });
+        return get_shared_treedata(ref).map(function(node) {
+            var value = node.id.slice(source);
+            var item = {
+                id: pk(value),
+                parent: (node.parent === '#') ? '#' : pk(node.parent.slice(source)),
+                text: node.text,
+                data: {sort: node.data.sort},
+                state: {selected: !!selected[value], disabled: node.state.disabled}
+            };
+            if (node.children)
+                item.children = true;
+            return item;
+        });
+    }
+
+    // search index over the node texts: case insensitive substring search like jstree,
+    // candidates come from the shortest trigram list of the query (all nodes for
+    // shorter queries). Returns a function answering a query with the ids of the
+    // matching nodes and of their ancestors. Runs in the tree worker
+    // (or on the main thread if workers are not available, no jQuery).
+    function tree_index(nodes) {
+        var entities = {'&amp;': '&', '&lt;': '<', '&gt;': '>', '&quot;': '"', '&#x27;': "'", '&#39;': "'"};
+        var ids = new Array(nodes.length);
+        var parents = new Int32Array(nodes.length);
+        var texts = new Array(nodes.length);
+        var grams = Object.create(null);
+        var positions = Object.create(null);
+        var i;
+        var trigrams = function(text) {
+            var result = [];
+            for (var j = 0; j + 3 <= text.length; ++j)
+                result.push(text.substr(j, 3));
+            return result;
+        };
+        for (i = 0; i < nodes.length; ++i) {
+            ids[i] = nodes[i].id;
+            positions[nodes[i].id] = i;
+        }
+        for (i = 0; i < nodes.length; ++i) {
+            var parent = positions[nodes[i].parent];
+            parents[i] = (parent === undefined) ? -1 : parent;
+            texts[i] = String(nodes[i].text)
+                .replace(/&(amp|lt|gt|quot|#x27|#39);/g, function(entity) { return entities[entity]; })
+                .toLowerCase();
+            for (var j = 0; j + 3 <= texts[i].length; ++j) {
+                var list = grams[texts[i].substr(j, 3)];
+                if (!list)
+                    grams[texts[i].substr(j, 3)] = [i];
+                else if (list[list.length - 1] !== i)
+                    list.push(i);
+            }
+        }
+
+        return function(str) {
+            var query = String(str).toLowerCase();
+            var candidates = null;
+            trigrams(query).forEach(function(gram) {
+                var list = grams[gram] || [];
+                if (!candidates || list.length < candidates.length)
+                    candidates = list;
+            });
+            var matches = [];
+            var check = function(j) {
+                if (texts[j].indexOf(query) !== -1)
+                    matches.push(j);
+            };
+            if (candidates)
+                candidates.forEach(check);
+            else
+                for (var j = 0; j < texts.length; ++j)
+                    check(j);
+            var seen = new Uint8Array(ids.length);
+            var ancestors = [];
+            matches.forEach(function(j) {
+                for (var p = parents[j]; p !== -1 && !seen[p]; p = parents[p]) {
+                    seen[p] = 1;
+                    ancestors.push(ids[p]);
+                }
+            });
+            return {
+                matches: matches.map(function(j) { return ids[j]; }),
+                parents: ancestors
+            };
+        };
+    }
+
+    // entry of the tree worker: parses and expands the tree data,
+    // sends the nodes back and answers the searches
+    function tree_worker() {
+        var search = null;
+        self.onmessage = function(e) {
+            if (e.data.text !== undefined) {
+                var nodes = expand_treedata(JSON.parse(e.data.text)) || [];
+                self.postMessage({nodes: nodes});
+                search = tree_index(nodes);
+            } else {
+                self.postMessage({id: e.data.id, result: search(e.data.str)});
+            }
+        };
+    }
+
+    // the worker gets created from the sources above (like jstree creates its worker)
+    var tree_worker_url = null;
+
+    // parse the tree data JSON `text` and build the search index in a web worker,
+    // falls back to the main thread if workers are not available
+    function start_tree_worker(text) {
+        var worker = null;
+        var nodes = null;
+        var waiting = [];
+        var search = null;
+        var pending = {};
+        var last = 0;
+        var loaded = function(result) {
+            nodes = result;
+            waiting.forEach(function(callback) { callback(nodes); });
+            waiting = [];
+        };
+        var fallback = function() {
+            if (worker)
+                worker.terminate();
+            worker = null;
+            if (!nodes)
+                loaded(expand_treedata(JSON.parse(text)) || []);
+            search = tree_index(nodes);
+            Object.keys(pending).forEach(function(id) {
+                pending[id].callback(search(pending[id].str));
+            });
+            pending = {};
+        };
+        try {
+            if (!tree_worker_url)
+                tree_worker_url = window.URL.createObjectURL(new window.Blob([
+                    expand_treedata.toString(), '\n', tree_index.toString(), '\n(', tree_worker.toString(), ')();'
+                ], {type: 'text/javascript'}));
+            worker = new window.Worker(tree_worker_url);
+            worker.onmessage = function(e) {
+                if (e.data.nodes)
+                    return loaded(e.data.nodes);
+                var request = pending[e.data.id];
+                delete pending[e.data.id];
+                request.callback(e.data.result);
+            };
+            worker.onerror = fallback;
+            worker.postMessage({text: text});
+        } catch (e) {
+            fallback();
+        }
+        return {
+            // callback gets the expanded nodes when parsed
+            nodes: function(callback) {
+                if (nodes)
+                    return callback(nodes);
+                waiting.push(callback);
+            },
+            // callback gets `{matches: [ids], parents: [ids]}`
+            search: function(str, callback) {
+                if (!worker)
+                    return callback(search(str));
+                pending[++last] = {str: str, callback: callback};
+                worker.postMessage({id: last, str: str});
+            }
+        };
+    }
+
+    // split the widget JSON, the tree data is the last entry (see `fields.iter_tree_json`)
+    // and gets parsed by the tree worker
+    function parse_without_treedata(text) {
+        var key = '"treedata": ';
+        var start = text.lastIndexOf(key);
+        var data = JSON.parse(text.slice(0, start) + key + 'null}');
+        data.treedata_text = text.slice(start + key.length, text.lastIndexOf('}'));
+        return data;
+    }
+
+    // virtual scrolling plugin: renders only the rows in the viewport as a flat list
+    // (indented by depth) from the model, the row window is moved while scrolling.
+    // Opening, closing and searching only change the model state and redraw the window.
+    $.jstree.defaults.virtual = {
+        height: 400,        // max height of the viewport in px
+        row_height: 24,     // height of a row in px (default theme)
+        overscan: 10        // rows rendered above and below the viewport
+    };
+    $.jstree.plugins.virtual = function(options, parent) {
+        this.bind = function() {
+            parent.bind.call(this);
+            this._data.virtual = {rows: null, first: 0, last: 0, timeout: false, frame: false};
+            this.element
+                .addClass('treewidget-virtual')
+                .css('max-height', this.settings.virtual.height + 'px')
+                .on('scroll.jstree', $.proxy(function() {
+                    var v = this._data.virtual;
+                    if (v.frame)
+                        return;
+                    v.frame = true;
+                    window.requestAnimationFrame($.proxy(function() {
+                        v.frame = false;
+                        this._virtual_draw(false);
+                    }, this));
+                }, this))
+                .on('search.jstree', $.proxy(function(e, data) {
+                    if (data.res.length)
+                        this._virtual_scroll_to(data.res[0]);
+                }, this));
+        };
+        this.unbind = function() {
+            var v = this._data.virtual;
+            if (v.timeout)
+                clearTimeout(v.timeout);
+            this.element.removeClass('treewidget-virtual').css('max-height', '');
+            parent.unbind.call(this);
+        };
+
+        // ids of the visible rows in tree order
+        this._virtual_rows = function() {
+            var v = this._data.virtual;
+            if (v.rows)
+                return v.rows;
+            var m = this._model.data;
+            var rows = [];
+            var stack = m[$.jstree.root].children.slice().reverse();
+            while (stack.length) {
+                var node = m[stack.pop()];
+                if (!node || node.state.hidden)
+                    continue;
+                rows.push(node.id);
+                if (node.state.opened && node.state.loaded)
+                    for (var i = node.children.length - 1; i >= 0; --i)
+                        stack.push(node.children[i]);
+            }
+            v.rows = rows;
+            return rows;
+        };
+        // rows changed, redraw the window once for all changes of this task
+        this._virtual_update = function() {
+            var v = this._data.virtual;
+            v.rows = null;
+            if (!v.timeout)
+                v.timeout = setTimeout($.proxy(function() {
+                    v.timeout = false;
+                    this._virtual_draw(true);
+                }, this), 0);
+        };
+        // render a single row without children
+        this._virtual_row = function(id) {
+            var node = this._model.data[id];
+            var li = this.redraw_node(id, false, true);
+            li.style.marginLeft = (node.parents.length - 1) * this.settings.virtual.row_height + 'px';
+            return li;
+        };
+        // (re)render the rows of the viewport, only if the window moved unless `force`
+        this._virtual_draw = function(force) {
+            var v = this._data.virtual;
+            var s = this.settings.virtual;
+            var el = this.element[0];
+            var scroll = el.scrollTop;
+            var stale = !v.rows;
+            var rows = this._virtual_rows();
+            var top = Math.floor(scroll / s.row_height);
+            var bottom = Math.ceil((scroll + s.height) / s.row_height);
+            if (!force && !stale && top >= v.first && Math.min(bottom, rows.length) <= v.last)
+                return;
+            if (v.timeout) {
+                clearTimeout(v.timeout);
+                v.timeout = false;
+            }
+            v.first = Math.max(0, top - s.overscan);
+            v.last = Math.min(rows.length, bottom + s.overscan);
+
+            // swap in the new list before rendering the rows, redraw_node
+            // must not find the old rows (would render their children)
+            var old = this.get_container_ul()[0];
+            var focused = old && old.contains(document.activeElement);
+            var ul = document.createElement('UL');
+            ul.className = (old) ? old.className : 'jstree-container-ul jstree-children';
+            ul.setAttribute('role', 'group');
+            ul.style.boxSizing = 'border-box';
+            ul.style.height = rows.length * s.row_height + 'px';
+            ul.style.paddingTop = v.first * s.row_height + 'px';
+            if (old)
+                el.replaceChild(ul, old);
+            else
+                el.appendChild(ul);
+            var fragment = document.createDocumentFragment();
+            for (var i = v.first; i < v.last; ++i)
+                fragment.appendChild(this._virtual_row(rows[i]));
+            ul.appendChild(fragment);
+            el.scrollTop = scroll;
+
+            if (focused && this._data.core.focused) {
+                var anchor = this.get_node(this._data.core.focused, true).children('.jstree-anchor')[0];
+                if (anchor) {
+                    anchor.focus();
+                    el.scrollTop = scroll;
+                }
+            }
+        };
+        // scroll the row of `id` into the viewport
+        this._virtual_scroll_to = function(id) {
+            var s = this.settings.virtual;
+            var el = this.element[0];
+            var index = this._virtual_rows().indexOf(id);
+            if (index === -1)
+                return;
+            // update the list height first, the scroll position gets clamped to it
+            this._virtual_draw(false);
+            var top = index * s.row_height;
+            if (top < el.scrollTop || top + s.row_height > el.scrollTop + el.clientHeight)
+                el.scrollTop = Math.max(0, top - Math.floor((el.clientHeight - s.row_height) / 2));
+            this._virtual_draw(false);
+        };
+
+        this._redraw = function() {
+            var nodes = (this._model.force_full_redraw)
+                ? this._model.data[$.jstree.root].children.concat([])
+                : this._model.changed.concat([]);
+            this._data.virtual.rows = null;
+            this._virtual_draw(true);
+            this._model.force_full_redraw = false;
+            this._model.changed = [];
+            this.trigger('redraw', {nodes: nodes});
+        };
+        this.redraw_node = function(obj, deep, is_callback, force_render) {
+            if (is_callback)
+                return parent.redraw_node.call(this, obj, deep, is_callback, force_render);
+            // direct updates (set_text, create_node, sort) redraw the window
+            this._virtual_update();
+            return false;
+        };
+        this.open_node = function(obj, callback, animation) {
+            var i;
+            if ($.isArray(obj)) {
+                obj = obj.slice();
+                for (i = 0; i < obj.length; ++i)
+                    this.open_node(obj[i], callback, animation);
+                return true;
+            }
+            obj = this.get_node(obj);
+            if (!obj || obj.id === $.jstree.root)
+                return false;
+            // loading gets handled by jstree, calls this again when loaded
+            if (!this.is_loaded(obj) || this.is_loading(obj))
+                return parent.open_node.call(this, obj, callback, animation);
+            if (!this.is_closed(obj)) {
+                if (callback)
+                    callback.call(this, obj, false);
+                return false;
+            }
+            this.trigger('before_open', {node: obj});
+            obj.state.opened = true;
+            this._virtual_update();
+            if (callback)
+                callback.call(this, obj, true);
+            this.trigger('open_node', {node: obj});
+            this.trigger('after_open', {node: obj});
+            return true;
+        };
+        this.close_node = function(obj, animation) {
+            var i;
+            if ($.isArray(obj)) {
+                obj = obj.slice();
+                for (i = 0; i < obj.length; ++i)
+                    this.close_node(obj[i], animation);
+                return true;
+            }
+            obj = this.get_node(obj);
+            if (!obj || obj.id === $.jstree.root || this.is_closed(obj))
+                return false;
+            obj.state.opened = false;
+            this.trigger('close_node', {node: obj});
+            this._virtual_update();
+            this.trigger('after_close', {node: obj});
+        };
+        this.open_all = function(obj, animation) {
+            obj = this.get_node(obj || $.jstree.root);
+            if (!obj)
+                return false;
+            var m = this._model.data;
+            var ids = (obj.id === $.jstree.root) ? obj.children_d : [obj.id].concat(obj.children_d);
+            var unloaded = [];
+            for (var i = 0; i < ids.length; ++i) {
+                var node = m[ids[i]];
+                if (!node.state.loaded)
+                    unloaded.push(node.id);
+                else if (node.children.length)
+                    node.state.opened = true;
+            }
+            this.redraw();
+            // lazy children: open them when loaded
+            if (unloaded.length)
+                this.open_node(unloaded, function(node, opened) {
+                    if (opened)
+                        this.open_all(node, animation);
+                }, animation);
+            this.trigger('open_all', {node: obj});
+        };
+        this.close_all = function(obj, animation) {
+            obj = this.get_node(obj || $.jstree.root);
+            if (!obj)
+                return false;
+            var m = this._model.data;
+            if (obj.id !== $.jstree.root)
+                obj.state.opened = false;
+            for (var i = 0; i < obj.children_d.length; ++i)
+                m[obj.children_d[i]].state.opened = false;
+            this.redraw();
+            this.trigger('close_all', {node: obj});
+        };
+        this._open_to = function(obj) {
+            obj = this.get_node(obj);
+            if (!obj || obj.id === $.jstree.root)
+                return false;
+            parent._open_to.call(this, obj);
+            this._virtual_scroll_to(obj.id);
+            return this.get_node(obj, true);
+        };
+    };
+
     $(document).on('move_error.treewidget', function() {
         alert('Error while moving node!');
     });
 
+    $(document).on('resync.treewidget', function() {
+        alert('The tree was changed meanwhile, please reload the page!');
+    });
+
     $(document).ready(function() {
         $('.treewidget').each(function(idx, el) {
             var $el = $(el);
             var data_element = $el.children('script')[0];
-            var data = JSON.parse(data_element.textContent || data_element.innerText);
-            var treedata = data.treedata;
+            var text = data_element.textContent || data_element.innerText;
+            // tree data parsed and searched by a web worker
+            var worker = (data_element.hasAttribute('data-worker')) ? true : null;
+            var data = (worker) ? parse_without_treedata(text) : JSON.parse(text);
             var settings = data.settings;
             var additional = data.additional;
             var attr_name = additional.id;
+            if (worker)
+                worker = start_tree_worker(data.treedata_text);
+            var treedata = (additional.treedata_ref)
+                ? share_treedata(additional.treedata_ref, attr_name, additional.selected)
+                : expand_treedata(data.treedata);
             var pk = pk_proto('treewidget', attr_name);
+            var $select = $('#' + attr_name);
+            var select = $select[0];
+            var all_texts = null;
+            var move_node_handler = null;
+
+            // options by value, built on first use and kept up to date
+            // by the handlers below (options might be added by others)
+            var option_map = null;
+            var get_option_map = function() {
+                if (!option_map) {
+                    option_map = {};
+                    for (var i = 0; i < select.options.length; ++i)
+                        option_map[select.options[i].value] = select.options[i];
+                }
+                return option_map;
+            };
+
+            // tree changed meanwhile: reload external tree data or let the page handle it
+            var resync = function(resp) {
+                if (!additional.dataurl)
+                    return $el.trigger('resync.treewidget', [resp]);
+                additional.version = resp.version;
+                $el.jstree(true).refresh();
+            };
 
-            // set treedata
-            if (treedata) {
+            // set treedata (passed by the tree worker when parsed)
+            var root_nodes = (worker) ? worker.nodes : function (callback) { callback(treedata); };
+            if (treedata || worker) {
                 var core = settings.core || {};
-                core.data = treedata;
+                core.data = (worker) ? function (obj, callback) { worker.nodes(callback); } : treedata;
                 settings.core = core;
             }
 
+            // lazy mode: load children on demand
+            if ((treedata || worker) && additional.childrenurl) {
+                settings.core.data = function (obj, callback) {
+                    if (obj.id === '#')
+                        return root_nodes(function (nodes) { callback($.extend(true, [], nodes)); });
+                    $.getJSON(
+                        additional.childrenurl,
+                        $.param({
+                            key: additional.childrenkey,
+                            node: obj.id.split('_').pop(),
+                            attr_name: attr_name,
+                            sort: (additional.sort.length) ? 1 : 0
+                        }, true),
+                        function (resp) {
+                            if (additional.disabled)
+                                resp.forEach(function (node) { node.state.disabled = true; });
+                            callback(resp);
+                        }
+                    ).fail(function () { callback(false); });
+                };
+            }
+
+            // external tree data: HTTP cacheable, apply selected state here
+            if (additional.dataurl) {
+                settings.core.data = function (obj, callback) {
+                    var selected = {};
+                    additional.selected.forEach(function (value) { selected[value] = true; });
+                    $.ajax({url: additional.dataurl, dataType: 'json', cache: true})
+                        .done(function (resp) {
+                            resp = expand_treedata(resp);
+                            resp.forEach(function (node) {
+                                if (selected[node.id.split('_').pop()])
+                                    node.state.selected = true;
+                            });
+                            callback(resp);
+                        })
+                        .fail(function () { callback(false); });
+                };
+            }
+
             // widget is disabled
             if (additional.disabled) {
                 //$el.addClass('treewidget-disabled');  // TODO: move to template
                 $el.on('ready.jstree', function() {
-                    $($el.jstree(true).get_json('#', { flat: true })).each(function() {
-                        $el.jstree("disable_node", this.id);
-                    });
+                    var tree = $el.jstree(true);
+                    tree.disable_node(Object.keys(tree._model.data).filter(function(id) { return id !== '#'; }));
                 });
             } else {
+                // get option of a node, options of not selected nodes might be missing
+                // (`selected_only` or `lazy` setting), add them as needed
+                var get_option = function(node) {
+                    var value = node.id.split('_').pop();
+                    var options = get_option_map();
+                    var option = options[value];
+                    if (!option || !option.parentNode)
+                        option = select.querySelector('option[value="' + value + '"]');
+                    if (!option) {
+                        var text = $('<div>').html(node.text).text();
+                        option = new Option(text, value);
+                        // keep track of added options for the popup handlers below
+                        if (all_texts) {
+                            option.text = '#' + text;
+                            all_texts[value] = option.text;
+                        }
+                        select.appendChild(option);
+                    }
+                    options[value] = option;
+                    return option;
+                };
+
+                // selected options by value, updated with the changed nodes only
+                var selected_options = null;
+                var get_selected_options = function() {
+                    if (!selected_options) {
+                        selected_options = {};
+                        for (var i = 0; i < select.options.length; ++i)
+                            if (select.options[i].selected)
+                                selected_options[select.options[i].value] = select.options[i];
+                    }
+                    return selected_options;
+                };
+
                 // select/deselect standard handler to update django options
                 $el.on('select_node.jstree', function(e, data){
-                    var selected = $('#treewidget_' + attr_name).jstree('get_selected');
-                    // clear 'em all
-                    $('#' + attr_name + ' option').each(function(idx, el) {
-                        el.selected = false;
+                    var options = get_selected_options();
+                    var selected = {};
+                    data.selected.forEach(function(id) { selected[id.split('_').pop()] = true; });
+                    // deselect options of nodes deselected without event (e.g. single selection)
+                    Object.keys(options).forEach(function(value) {
+                        if (!selected[value]) {
+                            options[value].selected = false;
+                            delete options[value];
+                        }
                     });
-                    // set selected
-                    selected.forEach(function(el) {
-                        $('#' + attr_name + ' option[value="' + el.split('_').pop() + '"]')[0].selected = true;
+                    data.selected.forEach(function(id) {
+                        var value = id.split('_').pop();
+                        if (!options[value] || !options[value].selected) {
+                            options[value] = get_option(data.instance.get_node(id));
+                            options[value].selected = true;
+                        }
                     });
-                    $('#' + attr_name).change();
+                    $select.change();
                 });
                 $el.on('deselect_node.jstree', function(e, data){
-                    $('#' + attr_name + ' option[value="' + data.node.id.split('_').pop() + '"]')[0].selected = false;
-                    $('#' + attr_name).change();
+                    var option = get_option(data.node);
+                    option.selected = false;
+                    delete get_selected_options()[option.value];
+                    $select.change();
                 });
             }
 
@@ -82,6 +666,36 @@
             if (additional.search) {
                 if (plugins.indexOf('search') === -1)
                     plugins.push('search');
+                // server side search or search in the tree worker: load the parents
+                // of the matching nodes and match by id instead of searching the node texts
+                var find = null;
+                if (additional.searchurl)
+                    find = function (str, done) {
+                        $.getJSON(
+                            additional.searchurl,
+                            {key: additional.searchkey, str: str},
+                            function (resp) { done(resp.matches.map(pk), resp.parents.map(pk)); }
+                        ).fail(function () { done([], []); });
+                    };
+                else if (worker)
+                    find = function (str, done) {
+                        worker.search(str, function (result) { done(result.matches, result.parents); });
+                    };
+                if (find) {
+                    var matches = {};
+                    settings.search = $.extend({}, settings.search, {
+                        ajax: function (str, callback) {
+                            find(str, function (found, parents) {
+                                matches = {};
+                                found.forEach(function (id) { matches[id] = true; });
+                                callback(parents);
+                            });
+                        },
+                        search_callback: function (str, node) {
+                            return !!matches[node.id];
+                        }
+                    });
+                }
                 var to = null;
                 $('#treewidget-search_' + attr_name).keyup(function () {
                     if (to) clearTimeout(to);
@@ -112,8 +726,48 @@
             if (additional.dnd) {
                 if (plugins.indexOf('dnd') === -1)
                     plugins.push('dnd');
-                if (additional.moveurl) {
-                    var move_node_handler = function (ev, data) {
+                if (additional.moveurl || additional.movesurl) {
+                    // moves get sent in batches to `movesurl` (one move per request
+                    // with `moveurl` only), moves made while a batch is pending wait
+                    // for the next one, a failed batch gets reverted
+                    var pending_moves = [];
+                    var sending = false;
+                    var send_moves = function () {
+                        if (sending || !pending_moves.length)
+                            return;
+                        var moves = (additional.movesurl) ? pending_moves : pending_moves.slice(0, 1);
+                        pending_moves = pending_moves.slice(moves.length);
+                        var params = moves.map(function (move) { return move.params; });
+                        sending = true;
+                        $.getJSON(
+                            additional.movesurl || additional.moveurl,
+                            $.param((additional.movesurl)
+                                ? {appmodel: additional.appmodel, moves: JSON.stringify(params), version: additional.version}
+                                : $.extend({appmodel: additional.appmodel, version: additional.version}, params[0]), true),
+                            function (resp) {
+                                if (resp.moved) {
+                                    additional.version = resp.version;
+                                    return;
+                                }
+                                // revert to last state
+                                $el.off('move_node.jstree', move_node_handler);
+                                for (var i = moves.length - 1; i >= 0; --i) {
+                                    var data = moves[i].data;
+                                    $el.jstree('move_node', data.node, data.old_parent, data.old_position);
+                                }
+                                $el.on('move_node.jstree', move_node_handler);
+                                if (resp.error !== 'stale')
+                                    return $('#'+moves[0].data.node.id).trigger('move_error.treewidget', [moves[0].data]);
+                                if (additional.dataurl)
+                                    pending_moves = [];
+                                resync(resp);
+                            }
+                        ).always(function () {
+                            sending = false;
+                            send_moves();
+                        });
+                    };
+                    move_node_handler = function (ev, data) {
                         var parent_node = $el.jstree('get_node', data.parent);
                         var position = parent_node.children.indexOf(data.node.id);
                         var prev = null;
@@ -122,30 +776,31 @@
                         var next = null;
                         if (position + 1 < parent_node.children.length)
                             next = parent_node.children[position + 1].split('_').slice(-1)[0];
-                        $.getJSON(
-                            additional.moveurl,
-                            $.param({
-                                appmodel: additional.appmodel,
+                        pending_moves.push({
+                            data: data,
+                            params: {
                                 id: data.node.id.split('_').slice(-1)[0],
                                 parent: (data.parent === '#') ? null : data.parent.split('_').slice(-1)[0],
                                 prev: prev,
                                 next: next
-                            }, true),
-                            function (resp) {
-                                if (resp)
-                                    return;
-                                // revert to last state
-                                $el.off('move_node.jstree', move_node_handler);
-                                $el.jstree('move_node', data.node, data.old_parent, data.old_position);
-                                $('#'+data.node.id).trigger('move_error.treewidget', [data]);
-                                $el.on('move_node.jstree', move_node_handler);
                             }
-                        );
+                        });
+                        // collect the moves of one drop (multiple dragged nodes)
+                        setTimeout(send_moves, 0);
                     };
                     $el.on('move_node.jstree', move_node_handler);
                 }
             }
 
+            // virtual scrolling for big trees, must be the last plugin
+            // (dnd needs the nested node elements)
+            if (additional.virtual && !additional.dnd) {
+                if (plugins.indexOf('virtual') === -1)
+                    plugins.push('virtual');
+                settings.virtual = $.extend({}, settings.virtual,
+                    (additional.virtual === true) ? {} : {height: additional.virtual});
+            }
+
             // init jstree
             $el.jstree(settings);
             $el.jstree().settings.core.multiple = additional.multiple;
@@ -154,18 +809,141 @@
             if (!additional.updateurl || additional.disabled)
                 return;
 
-            // get all known options
-            var all_options = [];
-            $('#'+attr_name+' option').each(function() {all_options.push(this.value);});
-            var all_texts = {};
-            $('#'+attr_name+' option').each(function() {
-                $(this).text('#' + $(this).text());
-                all_texts[this.value] = $(this).text();
-            });
+            // texts of all known options
+            all_texts = {};
+            for (var i = 0; i < select.options.length; ++i) {
+                var option = select.options[i];
+                option.text = '#' + option.text;
+                all_texts[option.value] = option.text;
+            }
+
+            // add, move or rename nodes with the data of `get_node` (or `get_changes`),
+            // parents get added as needed, added nodes get selected with `select`
+            // (nodes are looked up by id, not by walking the tree)
+            var update_nodes = function(nodes, select) {
+                var tree = $el.jstree(true);
+                nodes.forEach(function(data) {
+                    data.parents.forEach(function(parent) {
+                        if (!tree.get_node(pk(parent.id)))
+                            tree.create_node(pk(parent.parent), {
+                                id: pk(parent.id),
+                                text: parent.name,
+                                state: {selected: false},
+                                data: {sort: parent.sort}
+                            }, 'last');
+                    });
+                    var node = tree.get_node(pk(data.id));
+                    if (!node) {
+                        tree.create_node(pk(data.parent), {
+                            id: pk(data.id),
+                            text: data.name,
+                            state: {selected: !!select},
+                            data: {sort: data.sort}
+                        }, 'last');
+                        if (select) {
+                            tree._open_to(pk(data.id));
+                            // deselect all and select only last added if not multiple
+                            if (!additional.multiple) {
+                                tree.deselect_all();
+                                tree.select_node(pk(data.id));
+                            }
+                        }
+                        return;
+                    }
+                    if (node.text !== data.name)
+                        tree.rename_node(node, data.name);
+                    node.data = node.data || {};
+                    node.data.sort = data.sort;
+                    // unchanged position (prev sibling might not be contained)
+                    var parent = tree.get_node(pk(data.parent));
+                    var position = parent.children.indexOf(node.id);
+                    var prev = (data.prev) ? tree.get_node(pk(data.prev)) : null;
+                    if (position !== -1 && ((data.prev) ? !prev || parent.children[position - 1] === prev.id : !position))
+                        return;
+
+                    // moved, place after prev or before next sibling if present
+                    if (move_node_handler)
+                        $el.off('move_node.jstree', move_node_handler);
+                    if (prev)
+                        tree.move_node(node, prev, 'after');
+                    else if (data.next && tree.get_node(pk(data.next)))
+                        tree.move_node(node, pk(data.next), 'before');
+                    else
+                        tree.move_node(node, parent, (data.prev) ? 'last' : 'first');
+                    if (move_node_handler)
+                        $el.on('move_node.jstree', move_node_handler);
+                });
+            };
+
+            // delta sync: apply the changes since the current tree version,
+            // nodes in `select` get selected
+            var syncing = false;
+            var sync_select = null;
+            var sync = function(select) {
+                if (syncing) {
+                    sync_select = (sync_select || []).concat(select);
+                    return;
+                }
+                syncing = true;
+                $.getJSON(
+                    additional.changesurl,
+                    $.param({
+                        appmodel: additional.appmodel,
+                        since: additional.version,
+                        sort: (additional.sort.length) ? 1 : 0
+                    }, true),
+                    function (resp) {
+                        if (resp.reset)
+                            return resync(resp);
+                        var tree = $el.jstree(true);
+                        update_nodes(resp.nodes, false);
+                        resp.deleted.forEach(function (value) {
+                            tree.delete_node(pk(value));
+                        });
+                        select.forEach(function (value) {
+                            if (!tree.get_node(pk(value)))
+                                return;
+                            if (!additional.multiple)
+                                tree.deselect_all();
+                            tree.select_node(pk(value));
+                            tree._open_to(pk(value));
+                        });
+                        additional.version = resp.version;
+                    }
+                ).always(function () {
+                    syncing = false;
+                    if (sync_select) {
+                        var next = sync_select;
+                        sync_select = null;
+                        sync(next);
+                    }
+                });
+            };
+
+            // request nodes changed by the popup, with delta sync if possible
+            var request_nodes = function(values, select) {
+                if (additional.changesurl && additional.version)
+                    return sync((select) ? values : []);
+                $.getJSON(
+                    additional.updateurl,
+                    $.param({
+                        appmodel: additional.appmodel,
+                        ids: values,
+                        sort: (additional.sort.length) ? 1 : 0
+                    }, true),
+                    function (resp) {
+                        update_nodes(resp, select);
+                    }
+                );
+            };
+
+            // poll for changes of other users
+            if (additional.sync && additional.changesurl && additional.version)
+                setInterval(function () { sync([]); }, additional.sync * 1000);
 
             // updates for name or position changes
             var name_handler = function(ev) {
-                if (ev.target !== $('#'+attr_name)[0]) {
+                if (ev.target !== select) {
                     // only operate on option elements
                     if (ev.target.nodeName.toLowerCase() !== 'option')
                         return;
@@ -179,213 +957,49 @@
                     all_texts[ev.target.value] = '#' + txt;
                     ev.target.text = '#' + txt;
 
-                    var tree_items = $el.jstree(true).get_json('#', { flat: true }).map(
-                        function(el) { return el.id; }
-                    );
-
                     // update from popup rename/move
-                    $.getJSON(
-                        additional.updateurl,
-                        $.param({
-                            appmodel: additional.appmodel,
-                            ids: [ev.target.value],
-                            sort: (additional.sort.length) ? 1 : 0
-                        }, true),
-                        function (resp) {
-
-                            // since tree could have changed in between get nodes again
-                            var tree_items = $el.jstree(true).get_json('#', { flat: true }).map(
-                                function(el) { return el.id; }
-                            );
-
-                            for (var i=0; i < resp.length; ++i) {
-                                var data = resp[i];
-
-                                // first check if node has still same parent to skip parent inserts
-                                var new_parent = pk(data.parent);
-                                var old_node = $el.jstree(true).get_node(pk(data.id));
-                                if (old_node) {
-                                    if (new_parent === old_node.parent) {
-                                        $el.jstree('rename_node', old_node, data.name);
-                                        old_node.data.sort = data.sort;
-                                        continue;
-                                    }
-                                }
-
-                                // check if parent node exists, add node if not
-                                for (var j=0; j<data.parents.length; ++j) {
-                                    if (tree_items.indexOf(pk(data.parents[j].id)) === -1) {
-                                        $el.jstree().create_node(
-                                            pk(data.parents[j].parent),
-                                            {
-                                                id: pk(data.parents[j].id),
-                                                text: data.parents[j].name,
-                                                state: {selected: false},
-                                                data: {sort: data.sort}
-                                            },
-                                            'last'
-                                        );
-                                    }
-                                }
-
-                                // try to move node
-                                if (old_node) {
-                                    $el.off('move_node.jstree', move_node_handler);
-                                    var done = false;
-                                    if (data.prev) {
-                                        var prev = $el.jstree(true).get_node(pk(data.prev));
-                                        if (prev) {
-                                            $el.jstree('move_node', old_node, prev, 'after');
-                                            done = true;
-                                        }
-                                    } else if (!done && data.next) {
-                                        var next = $el.jstree(true).get_node(pk(data.next));
-                                        if (next) {
-                                            $el.jstree('move_node', old_node, next, 'before');
-                                            done = true;
-                                        }
-                                    } else if (!done) {
-                                        $el.jstree('move_node', old_node, new_parent, 'last');
-                                    }
-                                    $el.on('move_node.jstree', move_node_handler);
-                                    continue;
-                                }
-
-                                // should not end up here
-                                // must delete old node first
-                                $el.jstree('delete_node', pk(data.id));
-
-                                // insert node into tree
-                                $el.jstree().create_node(
-                                    pk(data.parent),
-                                    {
-                                        id: pk(data.id),
-                                        text: data.name,
-                                        state: {selected: true},
-                                        data: {sort: data.sort}
-                                    },
-                                    'last'
-                                );
-                                $el.jstree()._open_to(pk(data.id));
-
-                                // deselect all and select only last added if not multiple
-                                if (!additional.multiple) {
-                                    $el.jstree(true).deselect_all();
-                                    $el.jstree('select_node', pk(data.id));
-                                }
-                            }
-                        }
-                    );
+                    request_nodes([ev.target.value], true);
                 }
             };
+            // added and removed options (popup add/delete)
+            var options_handler = function(mutation) {
+                var options = get_option_map();
+                Array.prototype.forEach.call(mutation.addedNodes, function(option) {
+                    if (option.nodeName.toLowerCase() === 'option')
+                        options[option.value] = option;
+                });
+                Array.prototype.forEach.call(mutation.removedNodes, function(option) {
+                    if (option.nodeName.toLowerCase() !== 'option' || options[option.value] !== option)
+                        return;
+                    delete options[option.value];
+                    delete all_texts[option.value];
+                    if (selected_options)
+                        delete selected_options[option.value];
+                    $el.jstree('delete_node', pk(option.value));
+                });
+            };
             var observer = new MutationObserver(function(mutations) {
-                mutations.forEach(name_handler);
+                mutations.forEach(function(mutation) {
+                    if (mutation.target === select)
+                        options_handler(mutation);
+                    else
+                        name_handler(mutation);
+                });
             });
             var config = {childList: true, subtree: true};
-            observer.observe($('#'+attr_name).get(0), config);
-
-            // update from popup add/delete
-            $('#'+attr_name).on('change', function(ev) {
-                var current_options = [];
-                $('#'+attr_name+' option').each(function() {current_options.push(this.value);});
-
-                // handle deletes
-                var diff = all_options.filter(function(el) {return current_options.indexOf(el) < 0;});
-                for (var i=0; i<diff.length; ++i)
-                    $el.jstree('delete_node', pk(diff[i]));
-
-                // get active values
-                var active = $(ev.target).val();
-                if (typeof active === 'string') // for not multiple val() returns a string only
-                    active = [active];
-                if (!active)                    // for empty multiple val() returns null
-                    active = [];
-
-                // find missing values from active
-                var missing = [];
-                for (i = 0; i < active.length; ++i)
-                    if (all_options.indexOf(active[i]) === -1)
-                        missing.push(active[i]);
-
-                // important: update options so we catch consecutive inserts/deletes
-                all_options = current_options;
-
-                // nothing to insert
-                if (!missing.length)
-                    return;
-
-                // check if missing is already rendered in tree
-                var tree_items = $el.jstree(true).get_json('#', { flat: true }).map(
-                    function(el) { return el.id; }
-                );
-                var final_missing = [];
-                for (i=0; i<missing.length; ++i) {
-                    if (tree_items.indexOf(pk(missing[i])) === -1)
-                        final_missing.push(missing[i]);
-                }
-                if (!final_missing.length)
-                    return;
-
-                // request final missing from server
-                var data = {
-                    appmodel: additional.appmodel,
-                    ids: final_missing,
-                    sort: (additional.sort.length) ? 1 : 0
-                };
-                $.getJSON(
-                    additional.updateurl,
-                    $.param(data, true),
-                    function (resp) {
-
-                        // since tree could have changed in between get nodes again
-                        var tree_items = $el.jstree(true).get_json('#', { flat: true }).map(
-                            function(el) { return el.id; }
-                        );
-
-                        for (var i=0; i < resp.length; ++i) {
-                            var data = resp[i];
-
-                            // check if parent node exists, add node if not
-                            for (var j=0; j<data.parents.length; ++j) {
-                                if (tree_items.indexOf(pk(data.parents[j].id)) === -1) {
-                                    $el.jstree().create_node(
-                                        pk(data.parents[j].parent),
-                                        {
-                                            id: pk(data.parents[j].id),
-                                            text: data.parents[j].name,
-                                            state: {selected: false},
-                                            data: {sort: data.sort}
-                                        },
-                                        'last'
-                                    );
-                                }
-                            }
-
-                            // check if item is already in tree
-                            if (tree_items.indexOf(pk(data.id)) !== -1)
-                                continue;
-
-                            // insert node into tree
-                            $el.jstree().create_node(
-                                pk(data.parent),
-                                {
-                                    id: pk(data.id),
-                                    text: data.name,
-                                    state: {selected: true},
-                                    data: {sort: data.sort}
-                                },
-                                'last'
-                            );
-                            $el.jstree()._open_to(pk(data.id));
-
-                            // deselect all and select only last added if not multiple
-                            if (!additional.multiple) {
-                                $el.jstree(true).deselect_all();
-                                $el.jstree('select_node', pk(data.id));
-                            }
-                        }
-                    }
-                );
+            observer.observe(select, config);
+
+            // update from popup add: request selected values missing in the tree from server
+            $select.on('change', function() {
+                var tree = $el.jstree(true);
+                var active = (select.selectedOptions)
+                    ? Array.prototype.map.call(select.selectedOptions, function(option) { return option.value; })
+                    : [].concat($select.val() || []);
+                var missing = active.filter(function(value) {
+                    return value && !tree.get_node(pk(value));
+                });
+                if (missing.length)
+                    request_nodes(missing, true);
             });
         });
     });
@@ -0,0 +1,201 @@
+"""
+Timing and query count instrumentation of the widget rendering and the ajax views.
+
+Enabled with `TREEWIDGET_INSTRUMENTATION` in settings.py, either `True` or the
+dotted path of a callable getting each `Record`. Records are also sent with the
+`stage_finished` signal (sender is the stage name) and logged to the
+`treewidget.timing` logger at debug level. With `TREEWIDGET_SERVER_TIMING`
+the records of a request get added as `Server-Timing` header
+(see `middleware.TreeDataMiddleware` and `timed_view`).
+"""
+import logging
+from contextlib import contextmanager, ExitStack
+from functools import wraps
+from time import perf_counter
+from asgiref.local import Local
+from django.conf import settings
+from django.db import connections
+from django.dispatch import Signal
+from django.utils.module_loading import import_string
+
+try:
+    from asgiref.sync import iscoroutinefunction
+except ImportError:
+    # asgiref < 3.6 (Django 3.2)
+    from asyncio import iscoroutinefunction
+
+
+logger = logging.getLogger('treewidget.timing')
+
+# sent with `record` for each finished stage
+stage_finished = Signal()
+
+# records of the current request, see `collect`
+_local = Local()
+
+
+class Record(object):
+    """
+    Measurement of a stage. `nodes` and `size` (bytes or characters
+    of the output) are set by the measured code, if known.
+    """
+    __slots__ = ('stage', 'seconds', 'queries', 'nodes', 'size')
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.seconds = 0.0
+        self.queries = 0
+        self.nodes = None
+        self.size = None
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+def is_enabled():
+    return bool(getattr(settings, 'TREEWIDGET_INSTRUMENTATION', False))
+
+
+def finish(record):
+    """
+    Hands a finished record to the callback, receivers, logger
+    and the records of the current request.
+    """
+    callback = getattr(settings, 'TREEWIDGET_INSTRUMENTATION', None)
+    if isinstance(callback, str):
+        import_string(callback)(record)
+    stage_finished.send(sender=record.stage, record=record)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('%s: %.2f ms, %d queries, %s nodes, %s size',
+                     record.stage, record.seconds * 1000, record.queries, record.nodes, record.size,
+                     extra={'treewidget': record.as_dict()})
+    records = getattr(_local, 'records', None)
+    if records is not None:
+        records.append(record)
+
+
+@contextmanager
+def track(record):
+    """
+    Adds the wall time and the database queries of the block to `record`.
+    """
+    def count(execute, sql, params, many, context):
+        record.queries += 1
+        return execute(sql, params, many, context)
+
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(count))
+        start = perf_counter()
+        try:
+            yield record
+        finally:
+            record.seconds += perf_counter() - start
+
+
+@contextmanager
+def measure(stage):
+    """
+    Measures the block as `stage`.
+    Yields the `Record` or `None` if instrumentation is disabled.
+    """
+    if not is_enabled():
+        yield None
+        return
+    record = Record(stage)
+    with track(record):
+        yield record
+    finish(record)
+
+
+def measure_chunks(stage, chunks):
+    """
+    Measures the iteration of lazily generated `chunks` as `stage`,
+    the time consumers spend between the chunks is not counted.
+    """
+    if not is_enabled():
+        for chunk in chunks:
+            yield chunk
+        return
+    record = Record(stage)
+    record.size = 0
+    chunks = iter(chunks)
+    while True:
+        with track(record):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        record.size += len(chunk)
+        yield chunk
+    finish(record)
+
+
+@contextmanager
+def collect():
+    """
+    Collects the records of the current request. Nested calls
+    yield `None`, the records belong to the outermost call.
+    """
+    if getattr(_local, 'records', None) is not None:
+        yield None
+        return
+    _local.records = records = []
+    try:
+        yield records
+    finally:
+        _local.records = None
+
+
+def add_server_timing(response, records):
+    """
+    Adds the records as `Server-Timing` header,
+    if `TREEWIDGET_SERVER_TIMING` is set.
+    """
+    if not records or not getattr(settings, 'TREEWIDGET_SERVER_TIMING', False):
+        return response
+    metrics = ['%s;dur=%.1f;desc="%d queries"' % (record.stage, record.seconds * 1000, record.queries)
+               for record in records]
+    if response.has_header('Server-Timing'):
+        metrics.insert(0, response['Server-Timing'])
+    response['Server-Timing'] = ', '.join(metrics)
+    return response
+
+
+def timed_view(stage):
+    """
+    View decorator measuring the view as `stage`, the size is
+    the length of the response body. Without `middleware.TreeDataMiddleware`
+    the records of the view get added as `Server-Timing` header.
+    Works for sync and async views. For async views only the queries
+    of the calling thread get counted, the queries of the async ORM and of
+    `sync_to_async` calls run in other threads. Stages measured within
+    those calls (e.g. 'treewidget.moves') count their queries.
+    """
+    def finish_view(record, response):
+        if not response.streaming:
+            record.size = len(response.content)
+
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                if not is_enabled():
+                    return await view(request, *args, **kwargs)
+                with collect() as records:
+                    with measure(stage) as record:
+                        response = await view(request, *args, **kwargs)
+                        finish_view(record, response)
+                return add_server_timing(response, records)
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not is_enabled():
+                return view(request, *args, **kwargs)
+            with collect() as records:
+                with measure(stage) as record:
+                    response = view(request, *args, **kwargs)
+                    finish_view(record, response)
+            return add_server_timing(response, records)
+        return wrapper
+    return decorator
@@ -1,24 +1,42 @@
+from itertools import zip_longest
+from operator import attrgetter, itemgetter
+from asgiref.sync import sync_to_async
 from django.db.models import QuerySet
+from django.db.models.query import ModelIterable
 from django.db.models import Q, F
 from django.db.models.functions import Substr, Length
-from django.db.models import CharField, OuterRef, Subquery
+from django.db.models import CharField, OuterRef, Subquery, Exists
+from django.db.models import Case, When, Value, Max
+from django.db.models.expressions import RawSQL
+from django.db import connections, transaction
+from django.core.exceptions import EmptyResultSet, ObjectDoesNotExist, ValidationError
 
 try:
     from treebeard.models import Node as TreebeardNode
     from treebeard.al_tree import AL_Node
     from treebeard.ns_tree import NS_Node
     from treebeard.mp_tree import MP_Node
+    from treebeard.exceptions import InvalidPosition, InvalidMoveToDescendant, PathOverflow, MissingNodeOrderBy
     HAS_TREEBEARD = True
 except ImportError:
     HAS_TREEBEARD = False
 
 try:
     from mptt.models import MPTTModel
+    from mptt.exceptions import InvalidMove
     HAS_MPTT = True
 except ImportError:
     HAS_MPTT = False
 
 
+# errors raised for illegal moves (see `TreeQuerySet.move_nodes`)
+INVALID_MOVE_ERRORS = (ObjectDoesNotExist, ValidationError, ValueError)
+if HAS_TREEBEARD:
+    INVALID_MOVE_ERRORS += (InvalidPosition, InvalidMoveToDescendant, PathOverflow, MissingNodeOrderBy)
+if HAS_MPTT:
+    INVALID_MOVE_ERRORS += (InvalidMove,)
+
+
 TREEBEARD = {
     'root_level': 1,
     'model': {
@@ -33,6 +51,7 @@ TREEBEARD = {
         'level'     :   lambda node: node.get_depth(),
         'move'      :   lambda node: lambda target, pos: node.move(target, pos),
         'is_root'   :   lambda node: node.is_root(),
+        'is_leaf'   :   lambda node: node.is_leaf(),
     },
 }
 
@@ -51,14 +70,61 @@ MPTT = {
         'level'     :   lambda node: getattr(node, node.__class__._mptt_meta.level_attr, 0),
         'move'      :   lambda node: lambda target, pos: node.move_to(target, pos),
         'is_root'   :   lambda node: node.is_root_node(),
+        'is_leaf'   :   lambda node: node.is_leaf_node(),
     },
 }
 
 
+# database backends with `WITH RECURSIVE` support in subqueries
+RECURSIVE_CTE_VENDORS = ('sqlite', 'postgresql')
+
+
+# nested set ranges ORed for ancestor lookups, each scans its tree
+# (see `nested_set_ancestors`), for more nodes the nodes stay a subquery
+NESTED_SET_RANGES = 10
+
+
+# parent resolution strategies for treebeard NS and MP (see `TreeQuerySet.annotate_parent`)
+PARENT_SUBQUERY = 'subquery'
+PARENT_PYTHON = 'python'
+PARENT_INDEX = 'index'
+# `PARENT_INDEX` with the index already checked to be current (see `index.is_current`)
+PARENT_INDEX_CURRENT = 'index_current'
+
+
 class UnknownTreeImplementation(Exception):
     pass
 
 
+def supports_recursive_cte(connection):
+    return connection.vendor in RECURSIVE_CTE_VENDORS
+
+
+# ordering value getters per model (see `get_ordering_getter`)
+ORDERING_GETTERS = {}
+
+
+def get_ordering_getter(model, treetype):
+    """
+    Returns a function returning the ordering values of a node of `model`,
+    the ordering attributes get resolved once per model.
+    """
+    try:
+        return ORDERING_GETTERS[model]
+    except KeyError:
+        attrs = [attr.lstrip('-') for attr in treetype['model']['order'](model)]
+        if not attrs:
+            getter = lambda node: []
+        elif len(attrs) == 1:
+            get = attrgetter(attrs[0])
+            getter = lambda node: [get(node)]
+        else:
+            get = attrgetter(*attrs)
+            getter = lambda node: list(get(node))
+        ORDERING_GETTERS[model] = getter
+        return getter
+
+
 def get_treetype(model):
     """
     Return the function mapping of the real model tree implementation.
@@ -80,12 +146,16 @@ class TreeQuerySet(object):
 
     The real queryset can be accessed via the `qs` attribute.
     """
-    def __init__(self, qs, treetype=None):
+    __slots__ = ('qs', 'treetype', 'resolve_parents')
+
+    def __init__(self, qs, treetype=None, resolve_parents=None):
         if isinstance(qs, TreeQuerySet):
             self.qs = qs.qs
+            resolve_parents = resolve_parents or qs.resolve_parents
         else:
             self.qs = qs
         self.treetype = treetype or get_treetype(self.qs.model)
+        self.resolve_parents = resolve_parents
 
     def __getitem__(self, item):
         item = self.qs[item]
@@ -94,12 +164,51 @@ class TreeQuerySet(object):
         return item
 
     def _get_next(self):
-        for node in self.qs:
-            yield TreeNode(node, self.qs.model, self.treetype)
+        return iter(self)
 
     def __iter__(self):
-        for node in self.qs:
-            yield TreeNode(node, self.qs.model, self.treetype)
+        nodes = self.qs
+        model = self.qs.model
+        treetype = self.treetype
+        if self.resolve_parents:
+            # parent pks get set once on the objects in the result cache
+            nodes = list(self.qs)
+            if nodes and not hasattr(nodes[0], '_parent_pk'):
+                self.resolve_parents(model, nodes)
+        for node in nodes:
+            yield TreeNode(node, model, treetype)
+
+    def iterator(self, chunk_size=2000):
+        """
+        Iterates the nodes without filling the result cache of the queryset.
+        Evaluated querysets (e.g. marked by `formatters.mark_lazy`) and
+        querysets with parent resolution in Python are iterated as usual.
+        """
+        if self.resolve_parents or self.qs._result_cache is not None:
+            for node in self:
+                yield node
+            return
+        model = self.qs.model
+        treetype = self.treetype
+        for node in self.qs.iterator(chunk_size=chunk_size):
+            yield TreeNode(node, model, treetype)
+
+    async def __aiter__(self):
+        """
+        Iterates the nodes with the async ORM (`async for`),
+        parent resolution in Python runs in a sync thread.
+        """
+        model = self.qs.model
+        treetype = self.treetype
+        if self.resolve_parents:
+            nodes = [node async for node in self.qs]
+            if nodes and not hasattr(nodes[0], '_parent_pk'):
+                await sync_to_async(self.resolve_parents)(model, nodes)
+            for node in nodes:
+                yield TreeNode(node, model, treetype)
+            return
+        async for node in self.qs:
+            yield TreeNode(node, model, treetype)
 
     def __next__(self):
         return next(self)
@@ -120,6 +229,9 @@ class TreeQuerySet(object):
         def f(*args, **kwargs):
             res = attr(*args, **kwargs)
             if isinstance(res, self.qs.__class__):
+                # keep the parent resolution for querysets of model objects
+                if res._iterable_class is ModelIterable:
+                    return TreeQuerySet(res, self.treetype, self.resolve_parents)
                 return TreeQuerySet(res, self.treetype)
             if isinstance(res, self.qs.model):
                 return TreeNode(res, self.qs.model, self.treetype)
@@ -139,82 +251,191 @@ class TreeQuerySet(object):
         return '%s.%s' % (self.qs.model._meta.app_label,
                           self.qs.model._meta.model_name)
 
-    def annotate_parent(self):
+    def annotate_parent(self, strategy=PARENT_SUBQUERY):
+        """
+        Annotates the parent pk as `_parent_pk`.
+        For treebeard NS and MP `strategy` selects how the parent is resolved:
+            - `PARENT_SUBQUERY`: correlated subquery per row in the database
+            - `PARENT_PYTHON`: one linear pass over the fetched rows during
+              iteration, parents not contained in the queryset are fetched
+              with one additional query. The parent pk is not available
+              in the database query (e.g. for `values`).
+        For all implementations `PARENT_INDEX` reads the parents from the tree
+        index (see `index`) with an indexed lookup per row, if the model is indexed.
+        The index state gets checked once here, the subquery strategy is used
+        while the index is outdated. `PARENT_INDEX_CURRENT` skips the check.
+        """
+        model = self.qs.model
+        if strategy in (PARENT_INDEX, PARENT_INDEX_CURRENT):
+            from treewidget.index import is_indexed, is_current, get_index_parent
+            if is_indexed(model) and (strategy == PARENT_INDEX_CURRENT or is_current(model)):
+                return TreeQuerySet(self.qs.annotate(_parent_pk=get_index_parent(model)), self.treetype)
+            strategy = PARENT_SUBQUERY
+        if strategy == PARENT_PYTHON and self.treetype == TREEBEARD:
+            if issubclass(model, NS_Node):
+                return TreeQuerySet(self.qs.all(), self.treetype, resolve_parents_ns)
+            elif issubclass(model, MP_Node):
+                return TreeQuerySet(self.qs.all(), self.treetype, resolve_parents_mp)
+        qs, expr = self._get_parent_expression()
+        return TreeQuerySet(qs.annotate(_parent_pk=expr), self.treetype)
+
+    def _get_parent_expression(self):
+        """
+        Returns the queryset and the expression of the parent pk
+        for the subquery strategy (see `annotate_parent`).
+        """
+        model = self.qs.model
         if self.treetype == MPTT:
-            parent_field = self.qs.model._mptt_meta.parent_attr
-            return TreeQuerySet(self.qs.annotate(_parent_pk=F(parent_field+'__pk')))
+            return self.qs, F(model._mptt_meta.parent_attr + '__pk')
         elif self.treetype == TREEBEARD:
-            if issubclass(self.qs.model, NS_Node):
-                sub = self.qs.model.objects.filter(
+            if issubclass(model, NS_Node):
+                sub = model.objects.filter(
                     tree_id=OuterRef('tree_id'),
                     lft__lt=OuterRef('lft'),
                     rgt__gt=OuterRef('rgt')).reverse()[:1]
-                qs = self.qs.annotate(_parent_pk=Subquery(sub.values('pk')))
-                return TreeQuerySet(qs)
-            elif issubclass(self.qs.model, MP_Node):
-                sub = self.qs.model.objects.filter(path=OuterRef('parentpath'))
-                expr = Substr('path', 1, Length('path') - self.qs.model.steplen,
+                return self.qs, Subquery(sub.values('pk'))
+            elif issubclass(model, MP_Node):
+                sub = model.objects.filter(path=OuterRef('parentpath'))
+                expr = Substr('path', 1, Length('path') - model.steplen,
                               output_field=CharField())
-                qs = self.qs.annotate(parentpath=expr).annotate(_parent_pk=Subquery(sub.values('pk')))
-                return TreeQuerySet(qs)
-            elif issubclass(self.qs.model, AL_Node):
-                return TreeQuerySet(
-                        self.qs.annotate(_parent_pk=F('parent__pk')))
+                return self.qs.annotate(parentpath=expr), Subquery(sub.values('pk'))
+            elif issubclass(model, AL_Node):
+                return self.qs, F('parent__pk')
         raise UnknownTreeImplementation('dont know how to annotate _parent_pk')
 
-    def get_ancestors_parent_annotated(self, include_self=False):
+    def values_parent_annotated(self, *fields):
         """
-        Creates a queryset containing all parents of the queryset.
+        Returns tuples of `(pk, parent pk, *fields)` without instantiating
+        model objects, `fields` are field names or expressions.
+        The queryset must be annotated by `annotate_parent`, for parent
+        resolution in Python the resolver columns get fetched additionally.
+        """
+        if not self.resolve_parents:
+            return list(self.qs.values_list('pk', '_parent_pk', *fields))
+        columns = RESOLVER_FIELDS[self.resolve_parents]
+        nodes = [ValuesNode.from_row(row, columns)
+                 for row in self.qs.values_list('pk', *(columns + fields))]
+        self.resolve_parents(self.qs.model, nodes)
+        return [(node.pk, node._parent_pk) + node.values for node in nodes]
+
+    async def avalues_parent_annotated(self, *fields):
+        """
+        Async version of `values_parent_annotated`.
+        """
+        if not self.resolve_parents:
+            return [row async for row in self.qs.values_list('pk', '_parent_pk', *fields)]
+        columns = RESOLVER_FIELDS[self.resolve_parents]
+        nodes = [ValuesNode.from_row(row, columns)
+                 async for row in self.qs.values_list('pk', *(columns + fields))]
+        await sync_to_async(self.resolve_parents)(self.qs.model, nodes)
+        return [(node.pk, node._parent_pk) + node.values for node in nodes]
+
+    def annotate_leaf(self):
+        """
+        Annotates `_is_leaf` for tree implementations, that cannot tell
+        from the node's own fields whether it has children (treebeard AL).
+        All other implementations are returned unchanged.
+        """
+        if self.treetype == TREEBEARD and issubclass(self.qs.model, AL_Node):
+            children = self.qs.model.objects.filter(parent=OuterRef('pk'))
+            return TreeQuerySet(self.qs.annotate(_is_leaf=~Exists(children)))
+        return self
+
+    def get_top_levels(self, levels):
+        """
+        Creates a queryset containing the nodes of the first `levels` levels.
+        NOTE: The parent pk is not annotated, call `annotate_parent` if needed.
+        """
+        if self.treetype == MPTT:
+            level_attr = self.qs.model._mptt_meta.level_attr
+            return TreeQuerySet(self.qs.filter(**{level_attr + '__lt': levels}))
+        elif self.treetype == TREEBEARD:
+            if issubclass(self.qs.model, (NS_Node, MP_Node)):
+                return TreeQuerySet(self.qs.filter(depth__lte=levels))
+            elif issubclass(self.qs.model, AL_Node):
+                # no level field, nest one subquery per level instead
+                level = self.qs.filter(parent__isnull=True)
+                filters = Q(pk__in=level.values('pk'))
+                for _ in range(levels - 1):
+                    level = self.qs.filter(parent__in=level.values('pk'))
+                    filters |= Q(pk__in=level.values('pk'))
+                return TreeQuerySet(self.qs.filter(filters))
+        raise UnknownTreeImplementation('dont know how to filter levels')
+
+    def get_children_parent_annotated(self, parents):
+        """
+        Creates a queryset containing the direct children of `parents`.
         Also annotates the parent pk as `_parent_pk`.
+        For a single parent this is one indexed query (foreign key lookup
+        for MPTT and AL, range query for NS and path prefix range for MP).
         """
-        # django mptt got a ready to go method
+        parents = [getattr(parent, 'node', parent) for parent in parents]
+        if not parents:
+            return TreeQuerySet(self.qs.none(), self.treetype)
+
         if self.treetype == MPTT:
             parent_field = self.qs.model._mptt_meta.parent_attr
-            return TreeQuerySet(
-                self.qs.get_ancestors(include_self=include_self)
-                    .annotate(_parent_pk=F(parent_field+'__pk')))
+            return TreeQuerySet(self.qs.filter(
+                **{parent_field + '__in': [parent.pk for parent in parents]})).annotate_parent()
 
-        # for treebeard we have to get the parents ourself
         elif self.treetype == TREEBEARD:
+            if issubclass(self.qs.model, AL_Node):
+                return TreeQuerySet(self.qs.filter(
+                    parent__in=[parent.pk for parent in parents])).annotate_parent()
             if issubclass(self.qs.model, NS_Node):
-                filters = Q()
-                for node in self.qs:
-                    if include_self:
-                        filters |= Q(
-                            tree_id=node.tree_id,
-                            lft__lte=node.lft,
-                            rgt__gte=node.rgt)
-                    else:
-                        filters |= Q(
-                            tree_id=node.tree_id,
-                            lft__lt=node.lft,
-                            rgt__gt=node.rgt)
-                sub = self.qs.model.objects.filter(
-                    tree_id=OuterRef('tree_id'),
-                    lft__lt=OuterRef('lft'),
-                    rgt__gt=OuterRef('rgt')).reverse()[:1]
-                qs = self.qs.model.objects.filter(filters)\
-                    .annotate(_parent_pk=Subquery(sub.values('pk')))
-                return TreeQuerySet(qs)
-
+                conditions = [(parent, Q(
+                    tree_id=parent.tree_id,
+                    lft__range=(parent.lft + 1, parent.rgt - 1),
+                    depth=parent.depth + 1)) for parent in parents]
             elif issubclass(self.qs.model, MP_Node):
-                paths = set()
-                for node in self.qs:
-                    length = len(node.path)
-                    if include_self:
-                        length += node.steplen
-                    paths.update(node.path[0:pos]
-                                 for pos in range(node.steplen, length, node.steplen))
-                sub = self.qs.model.objects.filter(path=OuterRef('parentpath'))
-                expr = Substr('path', 1, Length('path') - self.qs.model.steplen,
-                              output_field=CharField())
-                qs = self.qs.model.objects.filter(path__in=paths)\
-                    .annotate(parentpath=expr)\
-                    .annotate(_parent_pk=Subquery(sub.values('pk')))
-                return TreeQuerySet(qs)
+                conditions = [(parent, Q(
+                    path__range=self.qs.model._get_children_path_interval(parent.path),
+                    depth=parent.depth + 1)) for parent in parents]
+            else:
+                raise UnknownTreeImplementation('dont know how to get children')
+
+            # parent pk is known from the condition, no need for a subquery
+            if len(conditions) == 1:
+                parent, filters = conditions[0]
+                return TreeQuerySet(
+                    self.qs.filter(filters).annotate(_parent_pk=Value(parent.pk)))
+            filters = Q()
+            for _, condition in conditions:
+                filters |= condition
+            expr = Case(*(When(condition, then=Value(parent.pk))
+                          for parent, condition in conditions))
+            return TreeQuerySet(self.qs.filter(filters).annotate(_parent_pk=expr))
+
+        raise UnknownTreeImplementation('dont know how to get children')
+
+    def get_ancestors_parent_annotated(self, include_self=False, strategy=PARENT_SUBQUERY):
+        """
+        Creates a queryset containing all parents of the queryset.
+        Also annotates the parent pk as `_parent_pk`
+        (see `annotate_parent` for `strategy`).
+        """
+        # django mptt's queryset method ORs one range per node,
+        # which gets slow and breaks the database expression limits for big querysets
+        if self.treetype == MPTT or issubclass(self.qs.model, NS_Node):
+            filters = nested_set_ancestors(self._get_unsliced(), include_self, *self._get_nested_set_fields(),
+                                           parent=self._get_parent_field())
+            return self._filter_ancestors(filters, strategy)
+
+        # for treebeard we have to get the parents ourself
+        elif self.treetype == TREEBEARD:
+            qs = self._get_unsliced()
+            if issubclass(self.qs.model, MP_Node):
+                depth = qs.aggregate(depth=Max('depth'))['depth'] or 0
+                return self._filter_ancestors(path_prefix_ancestors(qs, depth, include_self), strategy)
 
             elif issubclass(self.qs.model, AL_Node):
-                # worst for parent querying
+                # walk all levels up to root in one recursive query
+                if supports_recursive_cte(connections[self.qs.db]):
+                    return TreeQuerySet(
+                        self.qs.model.objects.filter(pk__in=self._get_recursive_pks(True, include_self))
+                            .annotate(_parent_pk=F('parent__pk')))
+
+                # worst for parent querying without recursive queries
                 # we have to walk all levels up to root
                 # adds roughly a one query per level
                 nodes = self.qs.select_related('parent')
@@ -242,6 +463,184 @@ class TreeQuerySet(object):
 
         raise UnknownTreeImplementation('dont know how to annotate _parent_pk')
 
+    async def aget_ancestors_parent_annotated(self, include_self=False, strategy=PARENT_SUBQUERY):
+        """
+        Async version of `get_ancestors_parent_annotated`, the queries
+        for building the ancestor query run with the async ORM
+        (in a sync thread for treebeard AL without recursive CTEs).
+        """
+        model = self.qs.model
+        qs = self._get_unsliced()
+        if self.treetype == MPTT or issubclass(model, NS_Node):
+            filters = await anested_set_ancestors(qs, include_self, *self._get_nested_set_fields(),
+                                                  parent=self._get_parent_field())
+            return self._filter_ancestors(filters, strategy)
+        elif issubclass(model, MP_Node):
+            depth = (await qs.aaggregate(depth=Max('depth')))['depth'] or 0
+            return self._filter_ancestors(path_prefix_ancestors(qs, depth, include_self), strategy)
+        elif issubclass(model, AL_Node) and not supports_recursive_cte(connections[self.qs.db]):
+            return await sync_to_async(self.get_ancestors_parent_annotated)(include_self, strategy)
+        return self.get_ancestors_parent_annotated(include_self, strategy)
+
+    def _get_nested_set_fields(self):
+        """
+        Returns the names of the tree id, left and right fields of nested set models.
+        """
+        if self.treetype == MPTT:
+            opts = self.qs.model._mptt_meta
+            return opts.tree_id_attr, opts.left_attr, opts.right_attr
+        return 'tree_id', 'lft', 'rgt'
+
+    def _get_parent_field(self):
+        """
+        Returns the name of the parent foreign key or `None` (treebeard NS and MP).
+        """
+        if self.treetype == MPTT:
+            return self.qs.model._mptt_meta.parent_attr
+        if issubclass(self.qs.model, AL_Node):
+            return 'parent'
+        return None
+
+    def _filter_ancestors(self, filters, strategy):
+        """
+        Returns the nodes matching the ancestor `filters`, parent annotated.
+        """
+        if self.treetype == MPTT:
+            parent_attr = self.qs.model._mptt_meta.parent_attr
+            return TreeQuerySet(self.qs.model._tree_manager.filter(filters)
+                                .annotate(_parent_pk=F(parent_attr+'__pk')))
+        return TreeQuerySet(self.qs.model.objects.filter(filters)).annotate_parent(strategy)
+
+    def _get_unsliced(self):
+        """
+        Returns the queryset usable for further filtering.
+        """
+        if self.qs.query.is_sliced:
+            return self.qs.model._default_manager.filter(pk__in=self.qs.values('pk'))
+        return self.qs
+
+    def get_descendants_parent_annotated(self, include_self=False):
+        """
+        Creates a queryset containing all descendants of the queryset.
+        Also annotates the parent pk as `_parent_pk`.
+        """
+        if self.treetype == MPTT:
+            return TreeQuerySet(
+                self.qs.get_descendants(include_self=include_self)).annotate_parent()
+
+        elif self.treetype == TREEBEARD:
+            if issubclass(self.qs.model, NS_Node):
+                filters = Q()
+                for node in self.qs:
+                    if include_self:
+                        filters |= Q(tree_id=node.tree_id, lft__gte=node.lft, rgt__lte=node.rgt)
+                    else:
+                        filters |= Q(tree_id=node.tree_id, lft__gt=node.lft, rgt__lt=node.rgt)
+                return TreeQuerySet(self.qs.model.objects.filter(filters)).annotate_parent()
+
+            elif issubclass(self.qs.model, MP_Node):
+                filters = Q()
+                for node in self.qs:
+                    if include_self:
+                        filters |= Q(path__startswith=node.path)
+                    else:
+                        filters |= Q(path__startswith=node.path, depth__gt=node.depth)
+                return TreeQuerySet(self.qs.model.objects.filter(filters)).annotate_parent()
+
+            elif issubclass(self.qs.model, AL_Node):
+                if supports_recursive_cte(connections[self.qs.db]):
+                    pks = self._get_recursive_pks(False, include_self)
+                else:
+                    # walk down level by level, one query per level
+                    level = set(self.qs.values_list('pk', flat=True))
+                    pks = set(level) if include_self else set()
+                    while level:
+                        level = set(self.qs.model.objects.filter(
+                            parent__in=level).values_list('pk', flat=True)) - pks
+                        pks.update(level)
+                return TreeQuerySet(
+                    self.qs.model.objects.filter(pk__in=pks)
+                        .annotate(_parent_pk=F('parent__pk')))
+
+        raise UnknownTreeImplementation('dont know how to annotate _parent_pk')
+
+    def _get_recursive_pks(self, ancestors, include_self):
+        """
+        Returns a subquery collecting the pks of all ancestors (or descendants)
+        of the queryset for adjacency list trees (see `get_recursive_pks`).
+        """
+        return get_recursive_pks(self.qs, 'parent', ancestors, include_self)
+
+    def move_nodes(self, moves, check=None):
+        """
+        Executes `moves` in one transaction. `moves` is a list of
+        `(node pk, target pk, position)` with positions of `TreeNode.move`,
+        applied in order. The trees of all nodes and targets get locked
+        with `select_for_update` first, then `check` gets called (if given),
+        which can raise to reject the moves. Nodes and targets are refetched
+        for every move, since moves change the tree fields of other nodes.
+        Raises `DoesNotExist` for nodes or targets not in the queryset and
+        one of `INVALID_MOVE_ERRORS` for illegal moves, a failing move
+        rolls back all moves.
+        """
+        model = self.qs.model
+        to_python = model._meta.pk.to_python
+        moves = [(to_python(node), to_python(target), position)
+                 for node, target, position in moves]
+        pks = set()
+        for node, target, _ in moves:
+            pks.update((node, target))
+        with transaction.atomic(using=self.qs.db):
+            self._lock_trees(pks)
+            if check is not None:
+                check()
+            for node, target, position in moves:
+                nodes = self.qs.in_bulk((node, target))
+                if node not in nodes or target not in nodes:
+                    raise model.DoesNotExist('node or target does not exist')
+                TreeNode(nodes[node], model, self.treetype).move(nodes[target], position)
+        return len(moves)
+
+    def _lock_trees(self, pks):
+        """
+        Locks the trees containing `pks` by locking their root rows
+        with `select_for_update`, moves in a tree wait for its root row.
+        Moves of or next to root nodes may renumber other trees,
+        then the root rows of all trees get locked (also always
+        for treebeard AL, which has no tree identifier).
+        """
+        model = self.qs.model
+        manager = model._default_manager
+        root_level = self.treetype['root_level']
+        if self.treetype == MPTT:
+            tree, level = model._mptt_meta.tree_id_attr, model._mptt_meta.level_attr
+        elif issubclass(model, NS_Node):
+            tree, level = 'tree_id', 'depth'
+        elif issubclass(model, MP_Node):
+            tree, level = 'path', 'depth'
+        else:
+            tree = level = None
+        roots = manager.filter(**{level: root_level}) if level else manager.filter(parent__isnull=True)
+
+        # the trees might change until locked, repeat until the locked trees are stable
+        locked = set()
+        while tree:
+            trees = set()
+            for value, depth in manager.filter(pk__in=pks).values_list(tree, level):
+                if depth == root_level:
+                    trees = None
+                    break
+                trees.add(value[:model.steplen] if tree == 'path' else value)
+            if trees is None:
+                break
+            trees -= locked
+            if not trees:
+                return
+            list(roots.filter(**{tree + '__in': trees}).select_for_update()
+                 .order_by('pk').values_list('pk', flat=True))
+            locked |= trees
+        list(roots.select_for_update().order_by('pk').values_list('pk', flat=True))
+
 
 class TreeNode(object):
     """
@@ -252,9 +651,11 @@ class TreeNode(object):
     if you need a specific value from a node, access it via `node`
     (e.g. `obj.node.some_field`).
     """
+    __slots__ = ('node', 'model', 'treetype')
+
     def __init__(self, node, model=None, treetype=None):
         self.node = node
-        self.model = model or self.node.__class__
+        self.model = model or node.__class__
         self.treetype = treetype or get_treetype(self.model)
 
     def _get_real(self, name):
@@ -270,8 +671,7 @@ class TreeNode(object):
 
     @property
     def ordering(self):
-        return [getattr(self.node, attr.lstrip('-'))
-                for attr in self.treetype['model']['order'](self.model)]
+        return get_ordering_getter(self.model, self.treetype)(self.node)
 
     @property
     def parent(self):
@@ -309,6 +709,217 @@ class TreeNode(object):
     def is_root(self):
         return self._get_real('is_root')
 
+    @property
+    def is_leaf(self):
+        # prefer the annotation from `TreeQuerySet.annotate_leaf`
+        if hasattr(self.node, '_is_leaf'):
+            return self.node._is_leaf
+        return self._get_real('is_leaf')
+
+
+def get_deepest_ranges(nodes):
+    """
+    Returns the nested set rows `(pk, tree_id, lft, rgt)` of `nodes` in tree order
+    without the nodes containing another node (their ancestors are covered by that node).
+    """
+    nodes = sorted(nodes, key=itemgetter(1, 2))
+    # in tree order a node contains another node,
+    # if the next node lies within its range
+    return [node for node, next_node in zip_longest(nodes, nodes[1:])
+            if not next_node or next_node[1] != node[1] or next_node[2] > node[3]]
+
+
+def get_ranges_filter(ranges, include_self, tree_id, lft, rgt):
+    """
+    Filter for the ancestors of the nested set `ranges`, one OR per range.
+    """
+    lower, upper = ('lte', 'gte') if include_self else ('lt', 'gt')
+    filters = Q(pk__in=[])
+    for _, tree, left, right in ranges:
+        filters |= Q(**{tree_id: tree, '%s__%s' % (lft, lower): left, '%s__%s' % (rgt, upper): right})
+    return filters
+
+
+def get_ancestors_exists(qs, include_self, tree_id, lft, rgt):
+    """
+    Filter for nested set nodes containing a node of `qs` in their range,
+    `qs` stays a subquery. Leaves get skipped before the subquery.
+    """
+    # `tree_id + 0` keeps SQLite from using the tree id index instead of
+    # the lft index, which scans the whole tree for every node
+    nodes = qs.order_by().alias(_tree_id=F(tree_id) + 0).filter(**{
+        '_tree_id': OuterRef(tree_id),
+        lft + '__gt': OuterRef(lft),
+        lft + '__lt': OuterRef(rgt)})
+    filters = Q(**{rgt + '__gt': F(lft) + 1}) & Q(Exists(nodes))
+    if include_self:
+        filters |= Q(pk__in=qs.order_by().values('pk'))
+    return filters
+
+
+def get_ancestors_filter(qs, rows, include_self, fields, parent):
+    """
+    Filter for the ancestors of the nodes of `qs` with the nested set rows
+    `(pk, tree_id, lft, rgt)` of at most `NESTED_SET_RANGES + 1` nodes.
+    """
+    if len(rows) <= NESTED_SET_RANGES:
+        return get_ranges_filter(get_deepest_ranges(rows), include_self, *fields)
+    if parent and supports_recursive_cte(connections[qs.db]):
+        return Q(pk__in=get_recursive_pks(qs, parent, True, include_self))
+    return get_ancestors_exists(qs, include_self, *fields)
+
+
+def nested_set_ancestors(qs, include_self=False, tree_id='tree_id', lft='lft', rgt='rgt', parent=None):
+    """
+    Filter for nested set nodes, that are ancestors of nodes in `qs`.
+    Up to `NESTED_SET_RANGES` nodes their lft/rgt ranges are ORed
+    (see `get_deepest_ranges`). Above that `qs` stays a subquery, so the
+    query does not grow with `qs`: along the parent foreign key `parent`
+    (e.g. MPTT) with a recursive query, if supported, otherwise
+    by the nodes containing a node of `qs` in their range.
+    """
+    fields = (tree_id, lft, rgt)
+    rows = list(qs.order_by().values_list('pk', *fields)[:NESTED_SET_RANGES + 1])
+    return get_ancestors_filter(qs, rows, include_self, fields, parent)
+
+
+async def anested_set_ancestors(qs, include_self=False, tree_id='tree_id', lft='lft', rgt='rgt', parent=None):
+    """
+    Async version of `nested_set_ancestors`.
+    """
+    fields = (tree_id, lft, rgt)
+    rows = [row async for row in qs.order_by().values_list('pk', *fields)[:NESTED_SET_RANGES + 1]]
+    return get_ancestors_filter(qs, rows, include_self, fields, parent)
+
+
+def get_recursive_pks(qs, parent_field, ancestors, include_self):
+    """
+    Returns a subquery collecting the pks of all ancestors (or descendants)
+    of the nodes of `qs` along the foreign key `parent_field` in one query
+    with a recursive common table expression
+    (an empty list for querysets known to be empty).
+    """
+    connection = connections[qs.db]
+    qn = connection.ops.quote_name
+    field = qs.model._meta.get_field(parent_field)
+    opts = field.model._meta
+    table = qn(opts.db_table)
+    pk = qn(opts.pk.column)
+    parent = qn(field.column)
+    try:
+        inner, params = qs.order_by().values('pk').query\
+            .get_compiler(connection=connection).as_sql()
+    except EmptyResultSet:
+        return []
+    if ancestors:
+        base = '%s IN (%s)' % (pk, inner) if include_self else \
+            '%s IN (SELECT %s FROM %s WHERE %s IN (%s))' % (pk, parent, table, pk, inner)
+        join = 't.%s = r.parent_id' % pk
+    else:
+        base = '%s IN (%s)' % (pk if include_self else parent, inner)
+        join = 't.%s = r.node_id' % parent
+    sql = (
+        'WITH RECURSIVE treewidget_related(node_id, parent_id) AS ('
+        'SELECT %(pk)s, %(parent)s FROM %(table)s WHERE %(base)s '
+        'UNION '
+        'SELECT t.%(pk)s, t.%(parent)s FROM %(table)s t '
+        'INNER JOIN treewidget_related r ON %(join)s'
+        ') SELECT node_id FROM treewidget_related'
+    ) % {'pk': pk, 'parent': parent, 'table': table, 'base': base, 'join': join}
+    return RawSQL(sql, params)
+
+
+def path_prefix_ancestors(qs, depth, include_self=False):
+    """
+    Filter for treebeard MP nodes, that are ancestors of nodes in `qs`
+    with `depth` as maximum depth in `qs`: the ancestor paths are the path
+    prefixes of the nodes, one prefix subquery per level.
+    """
+    steplen = qs.model.steplen
+    if not include_self:
+        depth -= 1
+    filters = Q(pk__in=[])
+    for level in range(1, depth + 1):
+        prefixes = qs.filter(depth__gte=level if include_self else level + 1)\
+            .annotate(_prefix=Substr('path', 1, level * steplen, output_field=CharField()))\
+            .values('_prefix')
+        filters |= Q(depth=level, path__in=prefixes)
+    return filters
+
+
+def resolve_parents_mp(model, nodes):
+    """
+    Sets `_parent_pk` for treebeard MP nodes from their paths in one pass.
+    Parents not contained in `nodes` are fetched with one query.
+    """
+    steplen = model.steplen
+    by_path = dict((node.path, node.pk) for node in nodes)
+    missing = {}
+    for node in nodes:
+        node._parent_pk = None
+        if node.depth > 1:
+            parentpath = node.path[:-steplen]
+            node._parent_pk = by_path.get(parentpath)
+            if node._parent_pk is None:
+                missing.setdefault(parentpath, []).append(node)
+    if missing:
+        for path, pk in model.objects.filter(path__in=missing).values_list('path', 'pk'):
+            for node in missing[path]:
+                node._parent_pk = pk
+
+
+def resolve_parents_ns(model, nodes):
+    """
+    Sets `_parent_pk` for treebeard NS nodes in one pass over the nodes in
+    tree order with a stack of open ancestors. Parents not contained
+    in `nodes` are fetched with one query.
+    """
+    stack = []
+    missing = []
+    for node in sorted(nodes, key=lambda node: (node.tree_id, node.lft)):
+        while stack and (stack[-1].tree_id != node.tree_id or stack[-1].rgt < node.lft):
+            stack.pop()
+        node._parent_pk = None
+        if node.depth > 1:
+            if stack and stack[-1].depth == node.depth - 1:
+                node._parent_pk = stack[-1].pk
+            else:
+                missing.append(node)
+        stack.append(node)
+    if missing:
+        parents = dict(TreeQuerySet(model.objects.filter(pk__in=[node.pk for node in missing]))
+                       .annotate_parent().qs.values_list('pk', '_parent_pk'))
+        for node in missing:
+            node._parent_pk = parents.get(node.pk)
+
+
+class ValuesNode(object):
+    """
+    Lightweight node for parent resolution in Python on values rows
+    (see `TreeQuerySet.values_parent_annotated`).
+    """
+    __slots__ = ('pk', 'path', 'depth', 'tree_id', 'lft', 'rgt', '_parent_pk', 'values')
+
+    @classmethod
+    def from_row(cls, row, columns):
+        """
+        Node of a values row `(pk, *columns, *values)`.
+        """
+        node = cls()
+        node.pk = row[0]
+        offset = len(columns) + 1
+        for name, value in zip(columns, row[1:offset]):
+            setattr(node, name, value)
+        node.values = row[offset:]
+        return node
+
+
+# columns needed by the parent resolvers in Python
+RESOLVER_FIELDS = {
+    resolve_parents_mp: ('path', 'depth'),
+    resolve_parents_ns: ('tree_id', 'lft', 'rgt', 'depth'),
+}
+
 
 def force_treenode(it):
     """
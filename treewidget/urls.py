@@ -3,9 +3,24 @@ try:
 except ImportError:
     # django 4 and up
     from django.urls import re_path as url
-from treewidget.views import get_node, move_node
+import django
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from treewidget.views import get_node, move_node, move_nodes, get_children, get_tree, get_changes, search_nodes
+
+# native async views for ASGI deployments
+if getattr(settings, 'TREEWIDGET_ASYNC_VIEWS', False):
+    # async `login_required` and `request.auser`
+    if django.VERSION < (5, 1):
+        raise ImproperlyConfigured('TREEWIDGET_ASYNC_VIEWS needs Django 5.1 or newer')
+    from treewidget.views import aget_node as get_node, amove_node as move_node, amove_nodes as move_nodes
 
 urlpatterns = [
     url(r'get_node/$', get_node, name='treewidget.get_node'),
     url(r'move_node/$', move_node, name='treewidget.move_node'),
+    url(r'move_nodes/$', move_nodes, name='treewidget.move_nodes'),
+    url(r'get_children/$', get_children, name='treewidget.get_children'),
+    url(r'get_tree/$', get_tree, name='treewidget.get_tree'),
+    url(r'changes/$', get_changes, name='treewidget.get_changes'),
+    url(r'search/$', search_nodes, name='treewidget.search'),
 ]
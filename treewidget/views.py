@@ -1,13 +1,171 @@
-from django.http import JsonResponse
+import re
+import zlib
+from json import loads
+from hashlib import md5
+from asgiref.sync import sync_to_async
+from django.http import (JsonResponse, HttpResponse, HttpResponseNotFound, HttpResponseNotModified,
+                         StreamingHttpResponse)
 from django.apps import apps
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.db import transaction, DatabaseError
+from django.db.models import Q
 from django.contrib.auth.decorators import login_required
 from django.utils.html import escape
 from django.utils.encoding import force_str
-from treewidget.tree import TreeQuerySet, TreeNode
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+from treewidget.tree import TreeQuerySet, PARENT_SUBQUERY, PARENT_INDEX_CURRENT, INVALID_MOVE_ERRORS
+from treewidget.index import is_indexed, is_current, ais_current
+from treewidget.timing import measure, timed_view
+from treewidget.formatters import SelectFormatter, mark_lazy
+from treewidget.fields import (get_drawable_queryset, get_drawable_values, renders_values,
+                               load_queryset_key)
+from treewidget.cache import (increment_version, get_cache, get_version, get_tree_key, get_tree_data,
+                              set_tree_data, get_registered_queryset, get_body, set_body,
+                              check_version, StaleVersion, get_changed_pks, collect_changes)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# maximum number of matching nodes of `search_nodes`
+SEARCH_LIMIT = 100
+
+RE_ACCEPTS_BR = re.compile(r'\bbr\b')
+RE_ACCEPTS_GZIP = re.compile(r'\bgzip\b')
 
 # TODO: check for individual permissions
 
 
+def get_parent_strategy(model):
+    """
+    Returns the parent resolution of the views, indexed tree models read
+    the parents from the tree index while it is current. The index state
+    gets checked once per request.
+    """
+    if is_indexed(model) and is_current(model):
+        return PARENT_INDEX_CURRENT
+    return PARENT_SUBQUERY
+
+
+async def aget_parent_strategy(model):
+    """
+    Async version of `get_parent_strategy`.
+    """
+    if is_indexed(model) and await ais_current(model):
+        return PARENT_INDEX_CURRENT
+    return PARENT_SUBQUERY
+
+
+def get_ancestors(model, ids, strategy):
+    """
+    Returns the nodes with pks `ids` with all ancestors, parent annotated.
+    """
+    return TreeQuerySet(model.objects.filter(pk__in=ids))\
+        .get_ancestors_parent_annotated(include_self=True, strategy=strategy)
+
+
+def get_requested(nodes, ids):
+    """
+    Returns the requested nodes of the ancestor `nodes`
+    and the pks of their parents (`None` for roots).
+    """
+    requested = set(str(pk) for pk in ids)
+    elems = [node for node in nodes if str(node.pk) in requested]
+    return elems, set(elem.node._parent_pk for elem in elems)
+
+
+def get_siblings(model, nodes, parents, strategy):
+    """
+    Returns the children of `parents` (and roots for `None`) in tree order,
+    parent annotated. The parents are looked up in the ancestor `nodes`.
+    """
+    tqs = TreeQuerySet(model.objects.all())
+    by_pk = dict((node.pk, node) for node in nodes)
+    filters = Q(pk__in=tqs.get_children_parent_annotated(
+        [by_pk[pk] for pk in parents if pk is not None]).qs.values('pk'))
+    if None in parents:
+        filters |= Q(pk__in=tqs.get_top_levels(1).qs.values('pk'))
+    return TreeQuerySet(tqs.qs.filter(filters)).annotate_parent(strategy)
+
+
+def format_node_data(nodes, elems, sibling_rows, sort):
+    """
+    Returns the data of `get_node` for the requested nodes `elems` with
+    their ancestor `nodes` and the `(pk, parent pk)` rows of their siblings.
+    """
+    by_pk = dict((node.pk, node) for node in nodes)
+    siblings = {}
+    for pk, parent_pk in sibling_rows:
+        siblings.setdefault(parent_pk, []).append(pk)
+
+    def get_parents(node):
+        parents = []
+        while node.node._parent_pk is not None:
+            node = by_pk[node.node._parent_pk]
+            parents.append(node)
+        return reversed(parents)
+
+    def get_sibling(node, offset):
+        children = siblings.get(node.node._parent_pk, [])
+        pos = children.index(node.pk) + offset
+        return children[pos] if 0 <= pos < len(children) else None
+
+    result = []
+    for elem in elems:
+
+        # get parent nodes
+        parents = [{
+            'name': escape(force_str(p)),
+            'parent': p.node._parent_pk,
+            'id': p.node.pk,
+            'sort': p.ordering if sort else None
+        } for p in get_parents(elem)]
+
+        result.append({
+            'name': escape(force_str(elem)),
+            'parent': elem.node._parent_pk,
+            'id': elem.node.pk,
+            'sort': elem.ordering if sort else None,
+            'parents': parents,
+            'prev': get_sibling(elem, -1),
+            'next': get_sibling(elem, 1)
+        })
+    return result
+
+
+def get_node_data(model, ids, sort=False):
+    """
+    Returns the data of `get_node` for the nodes with pks `ids`.
+    """
+    strategy = get_parent_strategy(model)
+
+    # requested nodes with all ancestors in one go
+    nodes = list(get_ancestors(model, ids, strategy))
+    elems, parents = get_requested(nodes, ids)
+
+    # bulk sibling lookup: children of all parents (and roots) in tree order
+    rows = get_siblings(model, nodes, parents, strategy).values_parent_annotated()
+    return format_node_data(nodes, elems, rows, sort)
+
+
+async def aget_node_data(model, ids, sort=False):
+    """
+    Async version of `get_node_data`, the nodes get fetched with the async ORM.
+    """
+    strategy = await aget_parent_strategy(model)
+
+    ancestors = await TreeQuerySet(model.objects.filter(pk__in=ids))\
+        .aget_ancestors_parent_annotated(include_self=True, strategy=strategy)
+    nodes = [node async for node in ancestors]
+    elems, parents = get_requested(nodes, ids)
+
+    rows = await get_siblings(model, nodes, parents, strategy).avalues_parent_annotated()
+    return format_node_data(nodes, elems, rows, sort)
+
+
+@timed_view('treewidget.get_node')
 @login_required
 def get_node(request):
     """
@@ -29,65 +187,435 @@ def get_node(request):
     try:
         app_label, model_name = appmodel.split('.')
         model = apps.get_model(app_label=app_label, model_name=model_name)
-        result = []
-        for elem in TreeQuerySet(model.objects.filter(id__in=ids)):
-
-            # get parent nodes
-            parents = [{
-                'name': escape(force_str(p)),
-                'parent': p.parent.node.pk if p.parent else None,
-                'id': p.node.pk,
-                'sort': p.ordering if sort else None
-            } for p in elem.ancestors]
-
-            result.append({
-                'name': escape(force_str(elem)),
-                'parent': elem.parent.node.pk if elem.parent else None,
-                'id': elem.node.pk,
-                'sort': elem.ordering if sort else None,
-                'parents': parents,
-                'prev': elem.prev_sibling.node.pk if elem.prev_sibling else None,
-                'next': elem.next_sibling.node.pk if elem.next_sibling else None
-            })
+        with measure('treewidget.node_data') as record:
+            result = get_node_data(model, ids, sort)
+            if record:
+                record.nodes = len(result)
         return JsonResponse(result, safe=False)
-    except:
+    except (LookupError, ObjectDoesNotExist, ValueError, ValidationError):
         return JsonResponse([], safe=False)
 
 
+@timed_view('treewidget.get_node')
 @login_required
-def move_node(request):
+async def aget_node(request):
     """
-    Ajax view to evaluate and execute direct drag'n drop moves in the tree.
-    Returns True if the moves is legal, otherwise False.
-    Not used, if drag'n drop is disabled.
+    Async version of `get_node` for ASGI deployments (see `TREEWIDGET_ASYNC_VIEWS`),
+    reads the nodes with the async ORM.
     :param request:
     :return:
     """
     appmodel = request.GET.get('appmodel', None)
-    node_id = request.GET.get('id', None)
-    parent_id = request.GET.get('parent', None)
-    prev_id = request.GET.get('prev', None)
-    next_id = request.GET.get('next', None)
-    if not appmodel or not node_id:
-        return JsonResponse(False, safe=False)
+    ids = request.GET.getlist('ids')
+    sort = request.GET.get('sort')
+    if not appmodel or not ids:
+        return JsonResponse([], safe=False)
     try:
         app_label, model_name = appmodel.split('.')
         model = apps.get_model(app_label=app_label, model_name=model_name)
+        with measure('treewidget.node_data') as record:
+            result = await aget_node_data(model, ids, sort)
+            if record:
+                record.nodes = len(result)
+        return JsonResponse(result, safe=False)
+    except (LookupError, ObjectDoesNotExist, ValueError, ValidationError):
+        return JsonResponse([], safe=False)
+
+
+@timed_view('treewidget.get_children')
+@login_required
+def get_children(request):
+    """
+    Ajax view to load children on demand for the `lazy` mode.
+    Returns the direct children of the requested node as `jstree` data
+    with ids for the requesting widget. Children with children
+    themselves are marked to be loaded on demand again.
+    `key` is the signed key of the widget's queryset (see `fields.get_queryset_key`),
+    only nodes contained in it are returned.
+    :param request:
+    :return:
+    """
+    key = request.GET.get('key', None)
+    node_id = request.GET.get('node', None)
+    attr_name = request.GET.get('attr_name', None)
+    sort = request.GET.get('sort')
+    if not key or not node_id or not attr_name:
+        return JsonResponse([], safe=False)
+    loaded = load_queryset_key(key, 'treewidget.children')
+    if loaded is None:
+        return HttpResponseNotFound()
+    queryset, _ = loaded
+    try:
+        parent = queryset.get(pk=node_id)
+    except (queryset.model.DoesNotExist, ValueError, ValidationError):
+        return JsonResponse([], safe=False)
+    children = TreeQuerySet(queryset).get_children_parent_annotated([parent]).annotate_leaf()
+    formatter = SelectFormatter(attr_name, [], [], {'sort': bool(sort)})
+    return JsonResponse(list(formatter.render(mark_lazy(children))), safe=False)
+
+
+@timed_view('treewidget.get_changes')
+@login_required
+def get_changes(request):
+    """
+    Ajax view for the delta sync of the widgets. Returns the nodes changed
+    after the tree version `since` from the change log (see `cache.get_changed_pks`)
+    as `{'version': <current version>, 'nodes': [...], 'deleted': [...]}`.
+    `nodes` contains the added, moved and renamed nodes like `get_node`,
+    `deleted` the pks of deleted nodes. `{'version': <current version>, 'reset': True}`
+    is returned for unknown changes, the widget has to reload the tree then.
+    Needs `TREEWIDGET_CACHE`.
+    :param request:
+    :return:
+    """
+    appmodel = request.GET.get('appmodel', None)
+    since = request.GET.get('since', None)
+    sort = request.GET.get('sort')
+    if not appmodel or not since or get_cache() is None:
+        return HttpResponseNotFound()
+    try:
+        app_label, model_name = appmodel.split('.')
+        model = apps.get_model(app_label=app_label, model_name=model_name)
+        version, pks = get_changed_pks(model, since)
+    except (ValueError, LookupError):
+        return HttpResponseNotFound()
+    if pks is None:
+        return JsonResponse({'version': version, 'reset': True})
+    nodes = get_node_data(model, pks, sort) if pks else []
+    existing = set(str(node['id']) for node in nodes)
+    return JsonResponse({
+        'version': version,
+        'nodes': nodes,
+        'deleted': [pk for pk in pks if str(pk) not in existing]
+    })
+
+
+@timed_view('treewidget.search_nodes')
+@login_required
+def search_nodes(request):
+    """
+    Ajax view for the server side search of `search_field` in settings.
+    Matches the search field of the nodes in the database and returns
+    the pks of the matching nodes (at most `SEARCH_LIMIT`) as `matches`
+    and the pks of all nodes to be opened to reveal them as `parents`
+    (in tree order). `key` is the signed key of the queryset and search lookup
+    of the widget (see `fields.get_search_key`).
+    :param request:
+    :return:
+    """
+    key = request.GET.get('key', None)
+    term = request.GET.get('str', '').strip()
+    if not key or not term:
+        return JsonResponse({'matches': [], 'parents': []})
+    loaded = load_queryset_key(key, 'treewidget.search')
+    if loaded is None:
+        return HttpResponseNotFound()
+    queryset, (lookup,) = loaded
+    model = queryset.model
+    matches = list(queryset.filter(**{lookup: term}).values_list('pk', flat=True)[:SEARCH_LIMIT])
+
+    # parents of all matches and their ancestors are to be opened
+    nodes = list(TreeQuerySet(model.objects.filter(pk__in=matches))
+                 .get_ancestors_parent_annotated(include_self=True, strategy=get_parent_strategy(model))
+                 .values_parent_annotated())
+    parents = set(parent_pk for _, parent_pk in nodes)
+    return JsonResponse({
+        'matches': matches,
+        'parents': [pk for pk, _ in nodes if pk in parents]
+    })
+
+
+def get_encoding(request):
+    """
+    Returns the preferred supported content encoding of the request.
+    """
+    accept = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    if brotli and RE_ACCEPTS_BR.search(accept):
+        return 'br'
+    if RE_ACCEPTS_GZIP.search(accept):
+        return 'gzip'
+    return ''
+
+
+def build_tree_data(queryset, settings, attr_name):
+    """
+    Builds the selection independent tree data as `(rows, disabled)`
+    the same way as the widgets do (see `formatters.SelectFormatter.get_rows`).
+    """
+    formatter_cls = settings.get('formatter') or SelectFormatter
+    strategy = settings.get('parent_strategy', PARENT_SUBQUERY)
+    if renders_values(settings):
+        values, disabled = get_drawable_values(
+            queryset, settings['label'], settings.get('filtered'), strategy, settings.get('sort'))
+        rows = list(formatter_cls(attr_name, [], disabled, settings).get_value_rows(values))
+    else:
+        qs, disabled = get_drawable_queryset(queryset, settings.get('filtered'), strategy)
+        rows = list(formatter_cls(attr_name, [], disabled, settings).get_rows(qs))
+    return rows, disabled
+
+
+def encode_tree_data(data, settings, attr_name):
+    """
+    Encodes tree data from `build_tree_data` without selected state.
+    """
+    rows, disabled = data
+    formatter = (settings.get('formatter') or SelectFormatter)(attr_name, [], disabled, settings)
+    for chunk in formatter.encode(formatter.render_rows(rows)):
+        yield chunk.encode('utf-8')
+
+
+def render_tree(queryset, settings, digest, version, attr_name):
+    """
+    Renders the tree data for `get_tree` without selected state.
+    Uses and fills the tree data cache of the widgets.
+    """
+    key = get_tree_key(queryset.model, digest, version)
+    data = get_tree_data(key)
+    if data is None:
+        data = build_tree_data(queryset, settings, attr_name)
+        set_tree_data(key, data)
+    return encode_tree_data(data, settings, attr_name)
+
+
+def compress(chunks, encoding):
+    """
+    Yields the body chunks, compressed incrementally with `encoding`.
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor()
+        for chunk in chunks:
+            yield compressor.process(chunk)
+        yield compressor.finish()
+    elif encoding == 'gzip':
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            yield compressor.compress(chunk)
+        yield compressor.flush()
+    else:
+        for chunk in chunks:
+            yield chunk
+
+
+def cache_body(tag, chunks):
+    """
+    Yields the non-empty body `chunks` and caches the body
+    for `get_tree` after the last chunk.
+    """
+    body = []
+    for chunk in chunks:
+        if chunk:
+            body.append(chunk)
+            yield chunk
+    set_body(tag, b''.join(body))
+
 
-        # need node ordering for treebeard types
-        node_order = getattr(model, 'node_order_by', None)
-        node = TreeNode(model.objects.get(pk=node_id))
-        if prev_id:
-            target = model.objects.get(pk=prev_id)
-            node.move(target, 'sorted-sibling' if node_order else 'right')
-        elif next_id:
-            target = model.objects.get(pk=next_id)
-            node.move(target, 'sorted-sibling' if node_order else 'left')
-        elif parent_id:
-            target = model.objects.get(pk=parent_id)
-            node.move(target, 'sorted-child' if node_order else 'first-child')
+def get_tree_tag(digest, version, attr_name, encoding):
+    """
+    Returns the ETag value and body cache key of `get_tree`.
+    """
+    return md5(('%s:%s:%s:%s' % (digest, version, attr_name, encoding)).encode('utf-8')).hexdigest()
+
+
+@timed_view('treewidget.get_tree')
+@login_required
+def get_tree(request):
+    """
+    Ajax view serving the tree data for `external` in settings.
+    The data is cached per tree version and does not contain the
+    selected state (applied by the widget script). Responses carry
+    an ETag of the tree version, unchanged trees are answered with 304.
+    The body is served precompressed with brotli (if installed) or gzip,
+    if the client supports it. Uncached bodies get streamed.
+    :param request:
+    :return:
+    """
+    digest = request.GET.get('key', None)
+    attr_name = request.GET.get('attr_name', None)
+    if not digest or not attr_name or get_cache() is None:
+        return HttpResponseNotFound()
+    registered = get_registered_queryset(digest)
+    if registered is None:
+        return HttpResponseNotFound()
+    queryset, settings = registered
+    version = get_version(queryset.model)
+    encoding = get_encoding(request)
+    tag = get_tree_tag(digest, version, attr_name, encoding)
+    etag = '"%s"' % tag
+
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    else:
+        body = get_body(tag)
+        if body is None:
+            # encoded and compressed while streaming, cached at the end
+            chunks = compress(render_tree(queryset, settings, digest, version, attr_name), encoding)
+            response = StreamingHttpResponse(cache_body(tag, chunks), content_type='application/json')
         else:
-            return JsonResponse(False, safe=False)
-        return JsonResponse(True, safe=False)
-    except:
-        return JsonResponse(False, safe=False)
+            response = HttpResponse(body, content_type='application/json')
+        if encoding:
+            response['Content-Encoding'] = encoding
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
+def get_move(model, node_id, parent_id, prev_id, next_id):
+    """
+    Translates a drag'n drop move of `jstree` to `(node pk, target pk, position)`
+    for `TreeQuerySet.move_nodes`. Returns `None` for incomplete moves.
+    """
+    if not node_id:
+        return None
+    # need node ordering for treebeard types
+    node_order = getattr(model, 'node_order_by', None)
+    if prev_id:
+        return node_id, prev_id, 'sorted-sibling' if node_order else 'right'
+    elif next_id:
+        return node_id, next_id, 'sorted-sibling' if node_order else 'left'
+    elif parent_id:
+        return node_id, parent_id, 'sorted-child' if node_order else 'first-child'
+    return None
+
+
+def run_moves(model, moves, version=None):
+    """
+    Executes `moves` with `TreeQuerySet.move_nodes` for the move views.
+    `version` is the tree version the moves were made on, stale moves
+    get rejected. Returns the response data, on success
+    `{'moved': True, 'version': <new tree version>}`, otherwise
+    `{'moved': False, 'error': <reason>, 'version': <current tree version>}`
+    with the reasons `'stale'` (the tree changed, the widget has to resync),
+    `'invalid'` (illegal move) and `'conflict'` (concurrent transaction,
+    e.g. a deadlock or lock timeout).
+    """
+    error = None
+    queryset = model.objects.all()
+    with measure('treewidget.moves') as record:
+        if record:
+            record.nodes = len(moves)
+        try:
+            with transaction.atomic(using=queryset.db), collect_changes(model) as pks:
+                TreeQuerySet(queryset).move_nodes(moves, lambda: check_version(model, version))
+                # bump once for all moves while the trees are locked, so waiting
+                # moves see the new version (the signals of the moves only get collected)
+                to_python = model._meta.pk.to_python
+                increment_version(model, pks | set(to_python(node) for node, _, _ in moves))
+        except StaleVersion:
+            error = 'stale'
+        except INVALID_MOVE_ERRORS:
+            error = 'invalid'
+        except DatabaseError:
+            error = 'conflict'
+    result = {
+        'moved': error is None,
+        'version': get_version(model) if get_cache() is not None else None
+    }
+    if error:
+        result['error'] = error
+    return result
+
+
+def get_move_model(appmodel):
+    """
+    Returns the tree model for `appmodel` of the move views or `None`.
+    """
+    try:
+        app_label, model_name = appmodel.split('.')
+        return apps.get_model(app_label=app_label, model_name=model_name)
+    except (ValueError, LookupError):
+        return None
+
+
+def get_request_move(request):
+    """
+    Returns the tree model and the move of a `move_node` request,
+    the move is `None` for invalid requests.
+    """
+    model = get_move_model(request.GET.get('appmodel', ''))
+    move = model and get_move(model, request.GET.get('id', None), request.GET.get('parent', None),
+                              request.GET.get('prev', None), request.GET.get('next', None))
+    return model, move
+
+
+def get_request_moves(request):
+    """
+    Returns the tree model and the moves of a `move_nodes` request,
+    the moves are empty for invalid requests.
+    """
+    model = get_move_model(request.GET.get('appmodel', ''))
+    try:
+        moves = [get_move(model, move.get('id'), move.get('parent'), move.get('prev'), move.get('next'))
+                 for move in loads(request.GET.get('moves', ''))] if model else []
+    except (ValueError, TypeError, AttributeError):
+        moves = []
+    if None in moves:
+        moves = []
+    return model, moves
+
+
+@timed_view('treewidget.move_node')
+@login_required
+def move_node(request):
+    """
+    Ajax view to evaluate and execute direct drag'n drop moves in the tree.
+    The move runs in a transaction on the locked tree, with `version`
+    the move gets rejected if the tree changed meanwhile.
+    Returns the result of `run_moves`.
+    Not used, if drag'n drop is disabled.
+    :param request:
+    :return:
+    """
+    model, move = get_request_move(request)
+    if not move:
+        return JsonResponse({'moved': False, 'error': 'invalid', 'version': None})
+    return JsonResponse(run_moves(model, [move], request.GET.get('version', None)))
+
+
+@timed_view('treewidget.move_nodes')
+@login_required
+def move_nodes(request):
+    """
+    Ajax view for batched drag'n drop moves. `moves` is a JSON list
+    of moves with `id`, `parent`, `prev` and `next` like `move_node`.
+    All moves are executed in one transaction on locked trees
+    (see `TreeQuerySet.move_nodes`), a failing move rolls back all moves.
+    Returns the result of `run_moves`.
+    Not used, if drag'n drop is disabled.
+    :param request:
+    :return:
+    """
+    model, moves = get_request_moves(request)
+    if not moves:
+        return JsonResponse({'moved': False, 'error': 'invalid', 'version': None})
+    return JsonResponse(run_moves(model, moves, request.GET.get('version', None)))
+
+
+@timed_view('treewidget.move_node')
+@login_required
+async def amove_node(request):
+    """
+    Async version of `move_node`. The move transaction
+    runs in the sync thread (`sync_to_async`).
+    :param request:
+    :return:
+    """
+    model, move = get_request_move(request)
+    if not move:
+        return JsonResponse({'moved': False, 'error': 'invalid', 'version': None})
+    return JsonResponse(await sync_to_async(run_moves)(model, [move], request.GET.get('version', None)))
+
+
+@timed_view('treewidget.move_nodes')
+@login_required
+async def amove_nodes(request):
+    """
+    Async version of `move_nodes`. The move transaction
+    runs in the sync thread (`sync_to_async`).
+    :param request:
+    :return:
+    """
+    model, moves = get_request_moves(request)
+    if not moves:
+        return JsonResponse({'moved': False, 'error': 'invalid', 'version': None})
+    return JsonResponse(await sync_to_async(run_moves)(model, moves, request.GET.get('version', None)))